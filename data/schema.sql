@@ -38,6 +38,31 @@ CREATE TABLE `presence` (
 
 -- --------------------------------------------------------
 
+--
+-- Table structure for table `privacy`
+--
+
+CREATE TABLE `privacy` (
+  `userid` char(40) NOT NULL COMMENT 'User ID',
+  `type` tinyint(1) unsigned NOT NULL COMMENT 'List type (1: whitelist, 2: blacklist)',
+  `target` varchar(100) NOT NULL COMMENT 'Listed network JID',
+  PRIMARY KEY (`userid`,`type`,`target`)
+) ENGINE=MyISAM DEFAULT CHARSET=ascii COMMENT='Privacy lists';
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `privacy_version`
+--
+
+CREATE TABLE `privacy_version` (
+  `userid` char(40) NOT NULL COMMENT 'User ID',
+  `version` bigint(20) unsigned NOT NULL COMMENT 'Privacy lists version',
+  PRIMARY KEY (`userid`)
+) ENGINE=MyISAM DEFAULT CHARSET=ascii COMMENT='Privacy lists versions of local users';
+
+-- --------------------------------------------------------
+
 --
 -- Table structure for table `servers`
 --
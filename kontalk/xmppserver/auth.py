@@ -59,12 +59,9 @@ class KontalkCertificate(object):
         self.cert = cert
 
     def check(self, fingerprint, kr, verify_cb=None):
-        _jid = None
-
         if isinstance(self.cert, OpenPGPCertificate):
             uid = self.cert.uid(0)
-            _jid = jid.JID(uid.email)
-            fpr = self.cert.fingerprint
+            return self._verify(jid.JID(uid.email), self.cert.fingerprint, verify_cb)
 
         elif isinstance(self.cert, X509):
             if keyring.verify_certificate(self.cert):
@@ -75,27 +72,32 @@ class KontalkCertificate(object):
                         uid = pkey.uid(0)
                         if uid:
                             _jid = jid.JID(uid.email)
-                            fpr = kr.check_user_key(keydata, _jid.user)
-                            if not fpr:
-                                _jid = None
-
-        if _jid:
-            def _continue(userjid):
-                return userjid
-            def _error(reason):
-                return None
-
-            # deferred to check fingerprint against resolver data
-            if verify_cb:
-                d = verify_cb(_jid, fpr)
-                d.addCallback(_continue)
-                d.addErrback(_error)
-                return d
-            else:
-                return _jid
+
+                            def _checked(fpr):
+                                if fpr:
+                                    return self._verify(_jid, fpr, verify_cb)
+
+                            d = kr.check_user_key(keydata, _jid.user)
+                            d.addCallback(_checked)
+                            return d
 
         return None
 
+    def _verify(self, _jid, fpr, verify_cb):
+        def _continue(userjid):
+            return userjid
+        def _error(reason):
+            return None
+
+        # deferred to check fingerprint against resolver data
+        if verify_cb:
+            d = verify_cb(_jid, fpr)
+            d.addCallback(_continue)
+            d.addErrback(_error)
+            return d
+        else:
+            return _jid
+
 
 class IKontalkToken(credentials.ICredentials):
 
@@ -111,13 +113,17 @@ class KontalkToken(object):
         self.decode_b64 = decode_b64
 
     def check(self, fingerprint, kr, verify_cb):
+        def _error(reason):
+            # TODO logging or throw exception back
+            log.debug("token verification failed! (%s)" % (reason.getErrorMessage(), ))
+
         try:
             if self.decode_b64:
                 data = sasl.fromBase64(self.token)
             else:
                 data = self.token
 
-            return kr.check_token(data)
+            return kr.check_token(data).addErrback(_error)
         except:
             # TODO logging or throw exception back
             import traceback
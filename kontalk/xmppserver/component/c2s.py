@@ -55,7 +55,7 @@ class XMPPServerFactory(xish_xmlstream.XmlStreamFactoryMixin, ServerFactory):
     @type streams: C{dict}
     """
 
-    protocol = xmlstream.XmlStream
+    protocol = xmlstream2.XmlStream
     manager = sm.C2SManager
 
     def __init__(self, portal, router, network, servername):
@@ -293,6 +293,18 @@ class InitialPresenceHandler(XMPPHandler):
         entity.
         """
 
+        def _vcard(uri, iq_vcard):
+            if uri:
+                vcard_key = iq_vcard.vcard.addElement((None, 'key'))
+                vcard_data = vcard_key.addElement((None, 'uri'))
+                vcard_data.addContent(uri)
+
+            self.send(iq_vcard)
+            if self.parent.logTraffic:
+                log.debug("vCard sent: %s" % (iq_vcard.toXml().encode('utf-8'), ))
+            else:
+                log.debug("vCard sent: %s" % (iq_vcard['from'], ))
+
         def _db(presence, to):
             from copy import deepcopy
             log.debug("presence: %r" % (presence, ))
@@ -353,19 +365,12 @@ class InitialPresenceHandler(XMPPHandler):
                     iq_vcard['to'] = to
 
                     # add vcard
-                    vcard = iq_vcard.addElement((xmlstream2.NS_XMPP_VCARD4, 'vcard'))
+                    iq_vcard.addElement((xmlstream2.NS_XMPP_VCARD4, 'vcard'))
                     if user['fingerprint']:
-                        pub_key = self.parent.keyring.get_key(user['userid'], user['fingerprint'])
-                        if pub_key:
-                            vcard_key = vcard.addElement((None, 'key'))
-                            vcard_data = vcard_key.addElement((None, 'uri'))
-                            vcard_data.addContent("data:application/pgp-keys;base64," + base64.b64encode(pub_key))
-
-                    self.send(iq_vcard)
-                    if self.parent.logTraffic:
-                        log.debug("vCard sent: %s" % (iq_vcard.toXml().encode('utf-8'), ))
+                        d = self.parent.keyring.get_key_uri(user['userid'], user['fingerprint'])
+                        d.addCallback(_vcard, iq_vcard)
                     else:
-                        log.debug("vCard sent: %s" % (iq_vcard['from'], ))
+                        _vcard(None, iq_vcard)
 
         d = self.parent.presencedb.get_all()
         d.addCallback(_db, to)
@@ -451,6 +456,7 @@ class PresenceProbeHandler(XMPPHandler):
 
     def connectionInitialized(self):
         self.xmlstream.addObserver("/presence[@type='probe']", self.probe, 100)
+        self.xmlstream.addObserver("/iq[@type='get']/query[@xmlns='%s']" % (xmlstream2.NS_PRESENCE_PROBE, ), self.probe_users, 100)
 
     def probe(self, stanza):
         """Handle presence probes from router."""
@@ -532,6 +538,73 @@ class PresenceProbeHandler(XMPPHandler):
         d = self.parent.presencedb.get(userid)
         d.addCallback(_db, stanza)
 
+    def probe_users(self, stanza):
+        """
+        Handle batched presence probes from resolvers: the reply is a single
+        stanza with the presence of all requested users hosted here.
+        """
+        stanza.consumed = True
+
+        # only resolvers of the network can probe our users
+        try:
+            component, host = util.jid_component(stanza['from'], util.COMPONENT_RESOLVER)
+            allowed = host in self.parent.keyring.hostlist()
+        except:
+            allowed = False
+
+        if not allowed:
+            log.debug("batched presence probe from %s denied" % (stanza['from'], ))
+            e = xmlstream.error.StanzaError('not-allowed', text='Not authorized.')
+            iq = xmlstream.toResponse(stanza, 'error')
+            iq.addChild(e.getElement())
+            self.send(iq)
+            return
+
+        def _db(presence, stanza):
+            response = xmlstream.toResponse(stanza, 'result')
+            query = response.addElement((xmlstream2.NS_PRESENCE_PROBE, 'query'))
+            host = self.xmlstream.thisEntity.host
+
+            for user in presence:
+                num_avail = 0
+                try:
+                    streams = self.parent.sfactory.streams[user['userid']]
+                    for manager in streams.itervalues():
+                        current = manager._presence
+                        if current and not current.hasAttribute('type'):
+                            item = query.addElement('presence')
+                            item['from'] = current['from']
+
+                            for child in ('status', 'show', 'priority'):
+                                e = getattr(current, child)
+                                if e:
+                                    item.addElement(child, content=unicode(e))
+
+                            num_avail += 1
+                except KeyError:
+                    pass
+
+                # no available resources - send unavailable presence
+                if not num_avail:
+                    item = query.addElement('presence')
+                    item['from'] = util.userid_to_jid(user['userid'], host).full()
+                    item['type'] = 'unavailable'
+
+                    if user['status']:
+                        item.addElement('status', content=user['status'])
+                    if user['show'] is not None:
+                        item.addElement('show', content=user['show'])
+
+                    delay = item.addElement((xmlstream2.NS_XMPP_DELAY, 'delay'))
+                    delay['stamp'] = user['timestamp'].strftime(xmlstream2.XMPP_STAMP_FORMAT)
+
+            self.send(response)
+            log.debug("batched probe result sent: %d users" % (len(presence), ))
+
+        userids = [util.jid_user(item['jid']) for item in stanza.query.elements(uri=xmlstream2.NS_PRESENCE_PROBE, name='item')]
+        d = self.parent.presencedb.get_users(userids)
+        d.addCallback(_db, stanza)
+
 
 class LastActivityHandler(XMPPHandler):
     """
@@ -840,6 +913,9 @@ class C2SComponent(xmlstream2.SocketComponent):
     """
     OFFLINE_STORE_DELAY = 10
 
+    """How many seconds to wait for responses to broadcast requests."""
+    RESPONSE_TIMEOUT = 30
+
     protocolHandlers = (
         InitialPresenceHandler,
         PresenceProbeHandler,
@@ -883,6 +959,8 @@ class C2SComponent(xmlstream2.SocketComponent):
         self.validationdb = storage.MySQLUserValidationStorage(validation_expire)
 
         self.keyring = keyring.Keyring(storage.MySQLNetworkStorage(), self.config['fingerprint'], self.network, self.servername)
+        if 'key_cache_size' in self.config:
+            self.keyring.key_cache_size = self.config['key_cache_size']
         authrealm = auth.SASLRealm("Kontalk")
         authportal = portal.Portal(authrealm, [auth.AuthKontalkChecker(self.config['fingerprint'], self.keyring, self._verify_fingerprint)])
 
@@ -917,7 +995,7 @@ class C2SComponent(xmlstream2.SocketComponent):
         return services
 
     def startService(self):
-        component.Component.startService(self)
+        xmlstream2.SocketComponent.startService(self)
 
         # register the registration provider if configured
         if 'registration' in self.config:
@@ -947,6 +1025,11 @@ class C2SComponent(xmlstream2.SocketComponent):
     def uptime(self):
         return time.time() - self.start_time
 
+    def stats(self):
+        stats = xmlstream2.SocketComponent.stats(self)
+        stats['keyring'] = self.keyring.stats()
+        return stats
+
     def upload_enabled(self):
         return 'upload' in self.config and 'enabled' in self.config['upload'] and self.config['upload']['enabled']
 
@@ -976,7 +1059,7 @@ class C2SComponent(xmlstream2.SocketComponent):
             e.makeConnection(xs)
 
     def _authd(self, xs):
-        component.Component._authd(self, xs)
+        xmlstream2.SocketComponent._authd(self, xs)
         log.debug("connected to router.")
         self.xmlstream.addObserver("/presence", self.dispatch)
         self.xmlstream.addObserver("/iq", self.iq, 50)
@@ -1011,6 +1094,22 @@ class C2SComponent(xmlstream2.SocketComponent):
         envelope.addChild(stanza)
         self.send(envelope)
 
+    def multicast_wrapped(self, stanza, sender, destinations):
+        """
+        Wraps the given stanza in a <stanza/> stanza and multicasts it to all
+        the given recipients.
+        """
+
+        envelope = domish.Element((None, 'stanza'))
+        envelope['from'] = sender
+        envelope.addChild(stanza)
+        self.multicast(envelope, destinations)
+
+    def resolver_jids(self):
+        """Returns the JIDs of all resolvers in the network."""
+        return [util.component_jid(server, util.COMPONENT_RESOLVER)
+            for server in self.keyring.hostlist()]
+
     def dispatch(self, stanza):
         """
         Stanzas from router must be intended to a server JID (e.g.
@@ -1061,7 +1160,7 @@ class C2SComponent(xmlstream2.SocketComponent):
     def _verify_fingerprint(self, userjid, fingerprint):
         """Requests a vCard to the resolver for fingerprint matching on login."""
 
-        def _response(d, fingerprint, stanza):
+        def _response(stanza, d, fingerprint):
             stanza.consumed = True
             # TODO ugly stuff
 
@@ -1080,17 +1179,19 @@ class C2SComponent(xmlstream2.SocketComponent):
 
                         if keydata.startswith(xmlstream2.DATA_PGP_PREFIX):
                             keydata = base64.b64decode(keydata[len(xmlstream2.DATA_PGP_PREFIX):])
+                            def _imported(result):
+                                if result and result[0] == fingerprint:
+                                    d.callback(userjid)
+                                else:
+                                    d.errback(Exception())
+
                             # import into keyring
-                            fpr, unused = self.keyring.import_key(keydata)
-                            if fpr == fingerprint:
-                                d.callback(userjid)
-                            else:
-                                d.errback(Exception())
+                            self.keyring.import_key(keydata).addCallback(_imported)
 
         # request vcard to the resolver for fingerprint matching
         stanzaId = util.rand_str(10)
         d = defer.Deferred()
-        self.xmlstream.addOnetimeObserver("/iq[@id='%s']" % (stanzaId, ), _response, 0, d, fingerprint)
+        self.correlator.expect(stanzaId, _response, name='iq', kwargs={'d': d, 'fingerprint': fingerprint})
 
         iq = domish.Element((None, 'iq'))
         iq['id'] = stanzaId
@@ -1163,7 +1264,8 @@ class C2SComponent(xmlstream2.SocketComponent):
         Called by SM when receiving a vCard from a local client.
         It checks vcard info (including public key) and if positive, sends the
         vCard to all resolvers.
-        @return: iq result or error stanza for the client
+        @return: iq result or error stanza for the client, or a deferred
+        firing with it if the public key needs to be checked
         """
         if self.logTraffic:
             log.debug("client sent vcard: %s" % (stanza.toXml(), ))
@@ -1197,32 +1299,35 @@ class C2SComponent(xmlstream2.SocketComponent):
                             iq.addChild(e.getElement())
                             return iq
 
-                        # check key
-                        fp = self.keyring.check_user_key(keydata, user.user)
-                        if fp:
-                            # generate response beforing tampering with the stanza
-                            response = xmlstream.toResponse(stanza, 'result')
-                            # update presencedb
-                            self.presencedb.public_key(user.user, fp)
-
-                            # send vcard to resolvers
-                            for server in self.keyring.hostlist():
+                        def _checked(fp):
+                            if fp:
+                                # generate response beforing tampering with the stanza
+                                response = xmlstream.toResponse(stanza, 'result')
+                                # update presencedb
+                                self.presencedb.public_key(user.user, fp)
+
+                                # send vcard to resolvers
                                 stanza['id'] = util.rand_str(8)
-                                stanza['to'] = util.component_jid(server, util.COMPONENT_RESOLVER)
+                                if stanza.hasAttribute('to'):
+                                    del stanza['to']
                                 # consume any response (very high priority)
-                                self.xmlstream.addOnetimeObserver("/iq[@id='%s']" % stanza['id'], self.consume, 500)
+                                self.correlator.expect(stanza['id'], self.consume, 500,
+                                    timeout=self.RESPONSE_TIMEOUT, once=False, name='iq')
 
                                 # wrap stanza in an envelope because we want errors to return to us
-                                self.send_wrapped(stanza, self.xmlstream.thisEntity.full())
+                                self.multicast_wrapped(stanza, self.xmlstream.thisEntity.full(), self.resolver_jids())
 
-                            # send response
-                            return response
-                        else:
-                            log.debug("invalid key - authorization to vCard denied")
-                            e = xmlstream.error.StanzaError('bad-request', text='Invalid public key.')
-                            iq = xmlstream.toResponse(stanza, 'error')
-                            iq.addChild(e.getElement())
-                            return iq
+                                # send response
+                                return response
+                            else:
+                                log.debug("invalid key - authorization to vCard denied")
+                                e = xmlstream.error.StanzaError('bad-request', text='Invalid public key.')
+                                iq = xmlstream.toResponse(stanza, 'error')
+                                iq.addChild(e.getElement())
+                                return iq
+
+                        # check key
+                        return self.keyring.check_user_key(keydata, user.user).addCallback(_checked)
         else:
             log.debug("authorization to vCard denied")
             e = xmlstream.error.StanzaError('not-allowed', text='Not authorized.')
@@ -1245,14 +1350,12 @@ class C2SComponent(xmlstream2.SocketComponent):
             vcard_data.addContent(xmlstream2.DATA_PGP_PREFIX + base64.b64encode(keydata))
 
         # send vcard to resolvers
-        for server in self.keyring.hostlist():
-            iq_vcard['id'] = util.rand_str(8)
-            # remote server
-            iq_vcard['to'] = util.component_jid(server, util.COMPONENT_RESOLVER)
-            # consume any response (very high priority)
-            self.xmlstream.addOnetimeObserver("/iq[@id='%s']" % iq_vcard['id'], self.consume, 500)
-            # send!
-            self.send_wrapped(iq_vcard, self.xmlstream.thisEntity.full())
+        iq_vcard['id'] = util.rand_str(8)
+        # consume any response (very high priority)
+        self.correlator.expect(iq_vcard['id'], self.consume, 500,
+            timeout=self.RESPONSE_TIMEOUT, once=False, name='iq')
+        # send!
+        self.multicast_wrapped(iq_vcard, self.xmlstream.thisEntity.full(), self.resolver_jids())
 
     def resolveJID(self, _jid):
         """Transform host attribute of JID from network name to server name."""
@@ -121,11 +121,9 @@ class XMPPNetConnectAuthenticator(xmlstream.ConnectAuthenticator):
         log.debug("%s fingerprint is %s" % (host, fingerprint, ))
 
         valid = False
-        # FIXME accessing Keyring internals
-        for fpr, fhost in self.keyring._list.iteritems():
-            if fhost == host and fpr.upper() == fingerprint:
-                log.debug("fingerprint matching (%s = %s)" % (host, fpr))
-                valid = True
+        if fingerprint in self.keyring.index.host_fingerprints.get(host, ()):
+            log.debug("fingerprint matching (%s = %s)" % (host, fingerprint))
+            valid = True
 
         if valid:
             xmlstream.ConnectAuthenticator.streamStarted(self, rootElement)
@@ -192,12 +190,10 @@ class XMPPNetListenAuthenticator(xmlstream.ListenAuthenticator):
             fingerprint = self.xmlstream.transport.getPeerCertificate().fingerprint
             log.debug("%s fingerprint is %s" % (host, fingerprint, ))
 
-            # FIXME accessing Keyring internals
-            for fpr, fhost in self.keyring._list.iteritems():
-                if fhost == host and fpr.upper() == fingerprint:
-                    log.debug("fingerprint matching (%s = %s)" % (host, fpr))
-                    self.xmlstream.otherEntity = jid.internJID(host)
-                    self.xmlstream.dispatch(self.xmlstream, xmlstream.STREAM_AUTHD_EVENT)
+            if fingerprint in self.keyring.index.host_fingerprints.get(host, ()):
+                log.debug("fingerprint matching (%s = %s)" % (host, fingerprint))
+                self.xmlstream.otherEntity = jid.internJID(host)
+                self.xmlstream.dispatch(self.xmlstream, xmlstream.STREAM_AUTHD_EVENT)
 
             if not self.xmlstream.otherEntity:
                 self.xmlstream.sendStreamError(error.StreamError('not-authorized'))
@@ -555,7 +551,7 @@ class NetComponent(xmlstream2.SocketComponent):
     """ Connection with router """
 
     def _authd(self, xs):
-        component.Component._authd(self, xs)
+        xmlstream2.SocketComponent._authd(self, xs)
         log.debug("connected to router.")
 
         # initiate outgoing connection to servers
@@ -21,8 +21,8 @@
 
 import time
 import base64
-from datetime import datetime
-from copy import deepcopy
+import functools
+from collections import deque, OrderedDict
 
 from twisted.python import failure
 from twisted.internet import defer, reactor, task
@@ -60,28 +60,13 @@ class PresenceHandler(XMPPHandler):
             component, host = util.jid_component(stanza['from'], util.COMPONENT_RESOLVER)
 
             if host != self.parent.servername and host in self.parent.keyring.hostlist():
-                self.send_privacy_lists('blocklist', self.parent.blacklists, stanza['from'])
-                self.send_privacy_lists('whitelist', self.parent.whitelists, stanza['from'])
+                self.parent.request_privacy_sync(stanza['from'])
 
         except:
             pass
 
         self.parent.broadcastSubscribers(stanza)
 
-    def send_privacy_lists(self, pname, plist, addr_from):
-        for user, wl in plist.iteritems():
-            iq = domish.Element((None, 'iq'))
-            iq['from'] = '%s@%s' % (user, self.parent.network)
-            iq['type'] = 'set'
-            iq['id'] = util.rand_str(8)
-            iq['to'] = addr_from
-            allow = iq.addElement(('urn:xmpp:blocking', pname))
-
-            for item in wl:
-                allow.addElement((None, 'item'), content=item)
-
-            self.parent.send(iq)
-
     def onPresenceUnavailable(self, stanza):
         """Handle unavailable presence stanzas."""
 
@@ -171,38 +156,55 @@ class RosterHandler(XMPPHandler):
         self.xmlstream.addObserver("/iq[@type='get']/query[@xmlns='%s']" % (xmlstream2.NS_IQ_ROSTER), self.roster, 100)
 
     def build_vcard(self, userid, iq):
-        """Adds a vCard to the given iq stanza."""
+        """
+        Adds a vCard to the given iq stanza.
+        @return: a deferred firing with the iq stanza
+        """
+        def _vcard(uri):
+            # add vcard
+            vcard = iq.addElement((xmlstream2.NS_XMPP_VCARD4, 'vcard'))
+            vcard_key = vcard.addElement((None, 'key'))
+            vcard_data = vcard_key.addElement((None, 'uri'))
+            vcard_data.addContent(uri)
+            return iq
+
         fpr = self.parent.keyring.get_fingerprint(userid)
-        keydata = self.parent.keyring.get_key(userid, fpr)
-        # add vcard
-        vcard = iq.addElement((xmlstream2.NS_XMPP_VCARD4, 'vcard'))
-        vcard_key = vcard.addElement((None, 'key'))
-        vcard_data = vcard_key.addElement((None, 'uri'))
-        vcard_data.addContent(xmlstream2.DATA_PGP_PREFIX + base64.b64encode(keydata))
-        return iq
+        return self.parent.keyring.get_key_uri(userid, fpr).addCallback(_vcard)
 
     def roster(self, stanza):
         _items = stanza.query.elements(uri=xmlstream2.NS_IQ_ROSTER, name='item')
-        requester = jid.JID(stanza['from'])
         stanza.consumed = True
 
         # items present, requesting roster lookup
+        items = [jid.internJID(item['jid']) for item in _items]
+        if items:
+            cache = self.parent.cache
+            # look for users we don't know about with a single network probe
+            missing = [itemJid for itemJid in items
+                if not cache.lookup(itemJid) and not cache.is_unknown(itemJid)]
+            if missing:
+                d = cache.find_all(missing)
+                d.addBoth(lambda unused: self.roster_lookup(stanza, items))
+                return
+
+        self.roster_lookup(stanza, items)
+
+    def roster_lookup(self, stanza, items):
+        requester = jid.JID(stanza['from'])
         response = xmlstream.toResponse(stanza, 'result')
         roster = response.addElement((xmlstream2.NS_IQ_ROSTER, 'query'))
 
         probes = []
         # this will be true if roster lookup is requested
         roster_lookup = False
-        for item in _items:
+        allowed_list = self.parent.is_presence_allowed_batch([(requester, itemJid) for itemJid in items])
+        for itemJid, allowed in zip(items, allowed_list):
             # items present, meaning roster lookup
             roster_lookup = True
 
-            itemJid = jid.internJID(item['jid'])
-
             # include the entry in the roster reply anyway
             entry = self.parent.cache.lookup(itemJid)
             if entry:
-                allowed = self.parent.is_presence_allowed(requester, itemJid)
                 if allowed != -1:
                     item = roster.addElement((None, 'item'))
                     item['jid'] = self.parent.translateJID(entry.jid).userhost()
@@ -223,7 +225,6 @@ class RosterHandler(XMPPHandler):
 
                 if i > 0:
                     for presence in presence_list:
-                        presence = deepcopy(presence)
                         presence['to'] = stanza['from']
                         group = presence.addElement((xmlstream2.NS_XMPP_STANZA_GROUP, 'group'))
                         group['id'] = gid
@@ -237,8 +238,9 @@ class RosterHandler(XMPPHandler):
                     iq['type'] = 'set'
                     iq['from'] = jid_from.userhost()
                     iq['to'] = stanza['from']
-                    self.build_vcard(jid_from.user, iq)
-                    self.send(iq)
+                    d = self.build_vcard(jid_from.user, iq)
+                    d.addCallback(self.send)
+                    d.addErrback(log.error)
 
         # no roster lookup, XMPP standard roster instead
         else:
@@ -316,8 +318,18 @@ class IQHandler(XMPPHandler):
             else:
                 # seconds ago user was last seen
                 to = jid.JID(stanza['to'])
+                cache = self.parent.cache
+
+                # user is not on the network
+                if cache.is_unknown(to):
+                    log.debug("no latest found! (unknown user)")
+                    # TODO send error
+                    return
 
                 def found_latest(latest, stanza):
+                    if not latest:
+                        cache.set_unknown(to)
+
                     if latest:
                         log.debug("found latest! %r" % (latest, ))
                         response = xmlstream.toResponse(stanza, 'result')
@@ -329,14 +341,13 @@ class IQHandler(XMPPHandler):
                         log.debug("no latest found! sending back error")
                         # TODO send error
 
-                def _abort(stanzaId, callback, data):
+                def _abort(callback, data):
                     log.debug("iq/last broadcast request timed out!")
-                    self.xmlstream.removeObserver("/iq[@id='%s']" % stanza['id'], find_latest)
                     if not callback.called:
                         #callback.errback(failure.Failure(internet_error.TimeoutError()))
                         callback.callback(data['latest'])
 
-                def find_latest(stanza, data, callback, timeout):
+                def find_latest(stanza, data, result):
                     log.debug("iq/last: %s" % (stanza.toXml(), ))
                     data['count'] += 1
                     seconds = int(stanza.query['seconds'])
@@ -346,10 +357,9 @@ class IQHandler(XMPPHandler):
 
                     if int(stanza.query['seconds']) == 0 or data['count'] >= data['max']:
                         log.debug("all replies received, stop watching iq %s" % (stanza['id'], ))
-                        timeout.cancel()
-                        self.xmlstream.removeObserver("/iq[@id='%s']" % stanza['id'], find_latest)
-                        if not callback.called:
-                            callback.callback(data['latest'])
+                        self.parent.correlator.remove(request)
+                        if not result.called:
+                            result.callback(data['latest'])
 
                 tmpTo = jid.JID(tuple=(to.user, to.host, to.resource))
                 lastIq = domish.Element((None, 'iq'))
@@ -370,16 +380,19 @@ class IQHandler(XMPPHandler):
                 # final callback
                 callback = defer.Deferred()
                 callback.addCallback(found_latest, stanza)
-                # timeout of request
-                timeout = reactor.callLater(self.parent.cache.MAX_LOOKUP_TIMEOUT, _abort, stanzaId=lastIq['id'], data=data, callback=callback)
-                # request observer
-                self.xmlstream.addObserver("/iq[@id='%s']" % lastIq['id'], find_latest, 100, data=data, callback=callback, timeout=timeout)
+                # wait for responses
+                request = self.parent.correlator.expect(lastIq['id'], find_latest, 100,
+                    timeout=self.parent.cache.MAX_LOOKUP_TIMEOUT,
+                    onTimeout=lambda: _abort(callback, data),
+                    once=False, name='iq', kwargs={'data': data, 'result': callback})
 
                 # send iq last activity to the network
+                rcpts = []
                 for server in self.parent.keyring.hostlist():
                     tmpTo.host = server
-                    lastIq['to'] = tmpTo.full()
-                    self.send(lastIq)
+                    rcpts.append(tmpTo.full())
+                self.parent.translate_sender(lastIq)
+                self.parent.multicast(lastIq, rcpts)
 
 
 class PrivacyListHandler(XMPPHandler):
@@ -401,26 +414,24 @@ class PrivacyListHandler(XMPPHandler):
         self.xmlstream.addObserver("/iq[@type='set']/unallow[@xmlns='%s']" % (xmlstream2.NS_IQ_BLOCKING), self.unallow, 100)
         self.xmlstream.addObserver("/iq[@type='set']/block[@xmlns='%s']" % (xmlstream2.NS_IQ_BLOCKING), self.block, 100)
         self.xmlstream.addObserver("/iq[@type='set']/unblock[@xmlns='%s']" % (xmlstream2.NS_IQ_BLOCKING), self.unblock, 100)
+        self.xmlstream.addObserver("/iq[@type='get']/sync[@xmlns='%s']" % (xmlstream2.NS_PRIVACY_SYNC), self.sync_request, 100)
+        self.xmlstream.addObserver("/iq[@type='set']/sync[@xmlns='%s']" % (xmlstream2.NS_PRIVACY_SYNC), self.sync, 100)
 
-    def _blacklist(self, jid_from, items, remove=False, broadcast=True):
-        if remove:
-            fn = self.parent.remove_blacklist
-        else:
-            fn = self.parent.add_blacklist
+    def _remote_resolver(self, stanza):
+        """Returns true if the stanza comes from another resolver."""
+        try:
+            unused, host = util.jid_component(stanza['from'], util.COMPONENT_RESOLVER)
+            return host != self.parent.servername and host in self.parent.keyring.hostlist()
+        except:
+            return False
 
-        for it in items:
-            jid_to = jid.JID(str(it))
-            fn(jid_from, jid_to, broadcast)
+    def _blacklist(self, jid_from, items, remove=False, broadcast=True):
+        items = [jid.JID(str(it)) for it in items]
+        self.parent.privacy_list_update(jid_from, items, self.parent.BLACKLIST, remove, broadcast)
 
     def _whitelist(self, jid_from, items, remove=False, broadcast=True):
-        if remove:
-            fn = self.parent.remove_whitelist
-        else:
-            fn = self.parent.add_whitelist
-
-        for it in items:
-            jid_to = jid.JID(str(it))
-            fn(jid_from, jid_to, broadcast)
+        items = [jid.JID(str(it)) for it in items]
+        self.parent.privacy_list_update(jid_from, items, self.parent.WHITELIST, remove, broadcast)
 
     def blacklist(self, stanza):
         jid_from = jid.JID(stanza['from'])
@@ -480,6 +491,28 @@ class PrivacyListHandler(XMPPHandler):
         if broadcast:
             self.parent.result(stanza)
 
+    def sync_request(self, stanza):
+        """A remote resolver is asking for privacy lists changed since the last sync."""
+        stanza.consumed = True
+        if not self._remote_resolver(stanza):
+            return
+
+        try:
+            since = int(stanza.sync.getAttribute('since', 0))
+        except ValueError:
+            since = 0
+
+        self.parent.result(stanza)
+        self.parent.privacy_sync(stanza['from'], since)
+
+    def sync(self, stanza):
+        """A chunk of privacy lists from a remote resolver."""
+        stanza.consumed = True
+        if not self._remote_resolver(stanza):
+            return
+
+        self.parent.privacy_sync_received(stanza['from'], stanza.sync)
+
 
 class MessageHandler(XMPPHandler):
     """
@@ -530,27 +563,103 @@ class MessageHandler(XMPPHandler):
         self.parent.send(msg)
 
 
+class ResourcePresence(object):
+    """Presence data of an available resource."""
+
+    __slots__ = ('jid', 'show', 'status', 'priority', 'delay')
+
+    def __init__(self, _jid, show, status, priority, delay):
+        self.jid = _jid
+        self.show = show
+        self.status = status
+        self.priority = priority
+        self.delay = delay
+
+    def toElement(self):
+        return _presence_element(self.jid.full(), None, self.show, self.status, self.priority, self.delay)
+
+    @classmethod
+    def fromElement(klass, _jid, e):
+        show = SHOW_VALUES.get(e.show.__str__()) if e.show else None
+        # domish returns UTF-8 encoded content
+        status = e.status.__str__() if e.status else None
+        try:
+            priority = int(e.priority.__str__())
+        except:
+            priority = 0
+        delay = xmlstream2.parse_stamp(e.delay.getAttribute('stamp')) if e.delay else None
+        return klass(_jid, show, status or None, priority, delay)
+
+
+"""Allowed show values, used to share the same string among all stubs."""
+SHOW_VALUES = dict((x, x) for x in ('away', 'xa', 'chat', 'dnd'))
+
+"""Server hosts, used to share the same string among all stubs."""
+_hosts = {}
+
+
+def _share_host(_jid):
+    """Replaces the host of the given L{JID} with the shared string."""
+    _jid.host = _hosts.setdefault(_jid.host, _jid.host)
+    return _jid
+
+
+def _presence_element(sender, ptype, show, status, priority, delay, attr='from'):
+    p = domish.Element((None, 'presence'))
+    p[attr] = sender
+    if ptype:
+        p['type'] = ptype
+
+    if show:
+        p.addElement((None, 'show'), content=show)
+    if priority != 0:
+        p.addElement((None, 'priority'), content=str(priority))
+    if status:
+        p.addElement((None, 'status'), content=status.decode('utf-8'))
+    if delay is not None:
+        d = p.addElement((xmlstream2.NS_XMPP_DELAY, 'delay'))
+        d['stamp'] = xmlstream2.format_stamp(delay)
+
+    return p
+
+
 class PresenceStub(object):
-    """VERY UNOPTIMIZED CLASS"""
+    """
+    Compact presence data of a user.
+    Presence stanzas are not kept: they are generated from the stored data
+    when needed (see L{presence}).
+    @ivar jid: bare JID of the user (server host)
+    @ivar show: interned show value (see L{SHOW_VALUES})
+    @ivar status: status message, UTF-8 encoded
+    @ivar delay: presence timestamp, in seconds since the epoch
+    @ivar _avail: available resources: {resource: L{ResourcePresence}}, None
+    if no resource is available
+    """
+
+    __slots__ = ('jid', 'type', 'show', 'status', 'priority', 'delay', '_avail')
 
     def __init__(self, _jid):
         """Creates a presence stub for a bare JID."""
         if _jid.resource:
             raise ValueError('not a bare JID.')
-        self._avail = {}
-        self.jid = _jid
-
-    def __set__(self, name, value):
+        self._avail = None
+        self.jid = _share_host(_jid)
+        self.type = None
+        self.show = None
+        self.status = None
+        self.priority = 0
+        self.delay = None
+
+    def _set(self, name, value):
         if name == 'type':
             self.type = value
         elif name == 'show':
-            if value in ['away', 'xa', 'chat', 'dnd']:
-                self.show = value
-            else:
-                self.show = None
+            self.show = SHOW_VALUES.get(value)
         elif name == 'status':
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
             if value:
-                self.status = value.encode('utf-8')
+                self.status = value
             else:
                 self.status = None
         elif name == 'priority':
@@ -559,10 +668,7 @@ class PresenceStub(object):
             except:
                 self.priority = 0
         elif name == 'delay':
-            try:
-                self.delay = datetime.strptime(value, xmlstream2.XMPP_STAMP_FORMAT)
-            except:
-                self.delay = None
+            self.delay = xmlstream2.parse_stamp(value)
         else:
             raise AttributeError(name)
 
@@ -577,21 +683,14 @@ class PresenceStub(object):
 
         delay = stanza.delay
         if delay:
-            delay = datetime.strptime(delay['stamp'], xmlstream2.XMPP_STAMP_FORMAT)
-            if self.delay:
-                diff = delay - self.delay
-                try:
-                    diff_seconds = diff.total_seconds()
-                except AttributeError:
-                    diff_seconds = (diff.microseconds + (diff.seconds + diff.days * 24 * 3600) * 10**6) / 10**6
-            else:
-                # no delay :)
-                diff_seconds = 1
+            delay = xmlstream2.parse_stamp(delay.getAttribute('stamp'))
+            if delay is None:
+                return
 
-            if diff_seconds >= 0:
+            if self.delay is None or delay >= self.delay:
                 ujid = jid.JID(stanza['from'])
                 # update local jid
-                self.jid = ujid.userhostJID()
+                self.jid = _share_host(ujid.userhostJID())
 
                 if stanza.hasAttribute('type'):
                     self.type = stanza['type']
@@ -604,7 +703,7 @@ class PresenceStub(object):
                 for child in ('status', 'show', 'priority'):
                     e = getattr(stanza, child)
                     if e:
-                        self.__set__(child, e.__str__())
+                        self._set(child, e.__str__())
 
     def push(self, stanza):
         """Push a presence to this stub."""
@@ -614,65 +713,65 @@ class PresenceStub(object):
 
         ujid = jid.JID(stanza['from'])
         # update local jid
-        self.jid = ujid.userhostJID()
-
-        # recreate presence stanza for local use
-        presence = domish.Element((None, 'presence'))
-        for attr in ('type', 'from'):
-            if stanza.hasAttribute(attr):
-                presence[attr] = stanza[attr]
+        if self.jid.host != ujid.host or self.jid.user != ujid.user:
+            self.jid = _share_host(ujid.userhostJID())
+        # resource JID will share strings with the bare JID
+        ujid.user = self.jid.user
+        ujid.host = self.jid.host
 
         if stanza.hasAttribute('type'):
             self.type = stanza['type']
         else:
             self.type = None
 
+        # keep presence data for local use
+        avail = ResourcePresence.fromElement(ujid, stanza)
         for child in ('status', 'show', 'priority', 'delay'):
-            e = getattr(stanza, child)
-            if e:
-                self.__set__(child, e.__str__())
-                presence.addChild(e)
+            if getattr(stanza, child):
+                setattr(self, child, getattr(avail, child))
 
-        self._avail[ujid.resource] = presence
+        if self._avail is None:
+            self._avail = {}
+        self._avail[ujid.resource] = avail
 
     def pop(self, resource):
         """Pop the presence for the given resource from this stub."""
         try:
-            presence = self._avail[resource]
-            del self._avail[resource]
+            presence = self._avail.pop(resource)
 
             # no more presences - resource is now unavailable
             if len(self._avail) == 0:
+                self._avail = None
                 self.type = 'unavailable'
                 # update delay with now
-                self.delay = datetime.utcnow()
+                self.delay = int(time.time())
 
-            return presence
+            return presence.toElement()
         except:
             pass
 
     def presence(self):
-        if self.available():
-            return self._avail.values()
+        """Returns presence stanzas for this user, generated on the fly."""
+        if self._avail:
+            return [avail.toElement() for avail in self._avail.itervalues()]
         else:
             return (self.toElement(), )
 
     def jids(self):
         """Returns a list of available resources from this JID."""
-        users = []
-        for avail in self._avail.itervalues():
-            users.append(jid.JID(avail['from']))
-        return users
+        if self._avail:
+            return [avail.jid for avail in self._avail.itervalues()]
+        return []
 
     def available(self):
         """Returns true if available presence count is greater than 0."""
-        return len(self._avail) > 0
+        return self._avail is not None
 
     def __str__(self, *args, **kwargs):
         return self.__repr__(*args, **kwargs)
 
     def __repr__(self, *args, **kwargs):
-        return '<PresenceStub jid=%s, avail=%r>' % (self.jid.full(), self._avail)
+        return '<PresenceStub jid=%s, avail=%r>' % (self.jid.full(), self._avail.keys() if self._avail else [])
 
     @classmethod
     def fromElement(klass, e):
@@ -696,32 +795,17 @@ class PresenceStub(object):
             delay = None
 
         p = klass(jid.JID(e['from']).userhostJID())
-        p.__set__('type', p_type)
-        p.__set__('show', show)
-        p.__set__('status', status)
-        p.__set__('priority', priority)
-        p.__set__('delay', delay)
+        p._set('type', p_type)
+        p._set('show', show)
+        p._set('status', status)
+        p._set('priority', priority)
+        p._set('delay', delay)
         if not p_type:
             p.push(e)
         return p
 
     def toElement(self, attr='from'):
-        p = domish.Element((None, 'presence'))
-        p[attr] = self.jid.full()
-        if self.type:
-            p['type'] = self.type
-
-        if self.show:
-            p.addElement((None, 'show'), content=self.show)
-        if self.priority != 0:
-            p.addElement((None, 'priority'), content=str(self.priority))
-        if self.status:
-            p.addElement((None, 'status'), content=self.status)
-        if self.delay:
-            d = p.addElement((xmlstream2.NS_XMPP_DELAY, 'delay'))
-            d['stamp'] = self.delay.strftime(xmlstream2.XMPP_STAMP_FORMAT)
-
-        return p
+        return _presence_element(self.jid.full(), self.type, self.show, self.status, self.priority, self.delay, attr)
 
 
 class JIDCache(XMPPHandler):
@@ -730,15 +814,48 @@ class JIDCache(XMPPHandler):
     An instance is kept by the L{Resolver} component.
     @ivar presence_cache: cache of presence stanzas
     @type presence_cache: C{dict} [userid]=PresenceStub
+    @ivar host_index: userids in L{presence_cache} by server host
+    @type host_index: C{dict} [host]=set(userid)
+    @ivar lookups: callers waiting for network lookups in progress
+    @type lookups: C{dict} [JID]=list(Deferred)
+    @ivar batch_lookups: batched network lookups in progress (see L{find_all})
+    @type batch_lookups: C{dict} [userid]=Deferred
+    @ivar lookup_freshness: seconds network lookup results are reused for
+    @ivar unknown: userids known not to be on the network, oldest first
+    @type unknown: C{OrderedDict} [userid]=expire time
+    @ivar unknown_ttl: seconds a userid is remembered as unknown
+    @ivar unknown_size: maximum number of userids in L{unknown}
+    @ivar unknown_hits: network lookups avoided thanks to L{unknown}
+    @ivar unknown_misses: network lookups not found in L{unknown}
     """
 
     """Seconds to wait for presence probe response from servers."""
     MAX_LOOKUP_TIMEOUT = 5
 
+    """Default seconds network lookup results are reused for."""
+    LOOKUP_FRESHNESS = 2
+
+    """Default seconds a userid is remembered as not on the network."""
+    UNKNOWN_TTL = 300
+
+    """Default maximum number of userids remembered as not on the network."""
+    UNKNOWN_SIZE = 10000
+
     def __init__(self):
         XMPPHandler.__init__(self)
         self.lookups = {}
+        self.batch_lookups = {}
+        self.lookup_freshness = self.LOOKUP_FRESHNESS
+        # recent network lookup results: [JID]=(expire time, result)
+        self._results = {}
+        self._results_expiry = deque()
+        self.unknown = OrderedDict()
+        self.unknown_ttl = self.UNKNOWN_TTL
+        self.unknown_size = self.UNKNOWN_SIZE
+        self.unknown_hits = 0
+        self.unknown_misses = 0
         self.presence_cache = {}
+        self.host_index = {}
         self._last_lookup = 0
 
         """ TEST TEST TEST
@@ -785,11 +902,8 @@ class JIDCache(XMPPHandler):
             if host in self.parent.keyring.hostlist():
                 log.debug("server %s is disconnecting, removing data from presence cache" % (host, ))
                 #log.debug("PRESENCE(1): %r" % (self.presence_cache, ))
-                keys = self.presence_cache.keys()
-                for key in keys:
-                    stub = self.presence_cache[key]
-                    if stub.jid.host == stanza['from']:
-                        del self.presence_cache[key]
+                for userid in self.host_index.pop(stanza['from'], ()):
+                    del self.presence_cache[userid]
 
                 #log.debug("PRESENCE(2): %r" % (self.presence_cache, ))
 
@@ -822,16 +936,19 @@ class JIDCache(XMPPHandler):
                 if fpr != 1:
                     raise Exception()
 
-                fpr = self.parent.keyring.get_fingerprint(jid_to.user)
-                keydata = self.parent.keyring.get_key(jid_to.user, fpr)
+                def _vcard(uri):
+                    iq = xmlstream.toResponse(stanza, 'result')
+                    # add vcard
+                    vcard = iq.addElement((xmlstream2.NS_XMPP_VCARD4, 'vcard'))
+                    vcard_key = vcard.addElement((None, 'key'))
+                    vcard_data = vcard_key.addElement((None, 'uri'))
+                    vcard_data.addContent(uri)
+                    self.send(iq)
 
-                iq = xmlstream.toResponse(stanza, 'result')
-                # add vcard
-                vcard = iq.addElement((xmlstream2.NS_XMPP_VCARD4, 'vcard'))
-                vcard_key = vcard.addElement((None, 'key'))
-                vcard_data = vcard_key.addElement((None, 'uri'))
-                vcard_data.addContent(xmlstream2.DATA_PGP_PREFIX + base64.b64encode(keydata))
-                self.send(iq)
+                fpr = self.parent.keyring.get_fingerprint(jid_to.user)
+                d = self.parent.keyring.get_key_uri(jid_to.user, fpr)
+                d.addCallback(_vcard)
+                d.addErrback(lambda failure: self.parent.error(stanza))
 
         except:
             self.parent.error(stanza)
@@ -860,11 +977,15 @@ class JIDCache(XMPPHandler):
                     keydata = base64.b64decode(keydata[len(xmlstream2.DATA_PGP_PREFIX):])
                     # import into cache keyring
                     userid = util.jid_user(stanza['from'])
-                    fpr = self.parent.keyring.check_user_key(keydata, userid)
-                    if fpr:
-                        log.debug("key cached successfully")
-                    else:
-                        log.warn("invalid key")
+                    self.unknown.pop(userid, None)
+
+                    def _checked(fpr):
+                        if fpr:
+                            log.debug("key cached successfully")
+                        else:
+                            log.warn("invalid key")
+
+                    self.parent.keyring.check_user_key(keydata, userid).addCallback(_checked)
 
         # TODO send response!!!
 
@@ -874,11 +995,9 @@ class JIDCache(XMPPHandler):
         if stub:
             data = stub.presence()
             i = len(data)
-            for x in data:
-                presence = deepcopy(x)
+            for presence in data:
                 presence['to'] = sender.full()
                 if gid:
-                    # FIXME this will duplicate group elements - actually in storage there should be no group element!!!
                     group = presence.addElement((xmlstream2.NS_XMPP_STANZA_GROUP, 'group'))
                     group['id'] = gid
                     group['count'] = str(i)
@@ -916,23 +1035,48 @@ class JIDCache(XMPPHandler):
                 # TODO include error cause?
                 self.send(response)
 
+    def _index(self, userid, old_host, new_host):
+        """Moves a userid between server hosts in L{host_index}."""
+        if old_host == new_host:
+            return
+
+        if old_host is not None:
+            users = self.host_index[old_host]
+            users.discard(userid)
+            if not users:
+                del self.host_index[old_host]
+
+        try:
+            self.host_index[new_host].add(userid)
+        except KeyError:
+            self.host_index[new_host] = set((userid, ))
+
     def user_available(self, stanza):
         """Called when receiving a presence stanza."""
         userid = util.jid_user(stanza['from'])
+        self.unknown.pop(userid, None)
+        self._forget_results(userid)
 
         try:
             stub = self.presence_cache[userid]
+            host = stub.jid.host
             stub.push(stanza)
         except KeyError:
             stub = PresenceStub.fromElement(stanza)
             self.presence_cache[userid] = stub
+            host = None
+
+        self._index(userid, host, stub.jid.host)
 
     def user_unavailable(self, stanza):
         """Called when receiving a presence unavailable stanza."""
         ujid = jid.JID(stanza['from'])
+        self.unknown.pop(ujid.user, None)
+        self._forget_results(ujid.user)
 
         try:
             stub = self.presence_cache[ujid.user]
+            host = stub.jid.host
             if ujid.resource:
                 stub.pop(ujid.resource)
             else:
@@ -942,6 +1086,15 @@ class JIDCache(XMPPHandler):
             # user not found in cache -- shouldn't happen!!
             stub = PresenceStub.fromElement(stanza)
             self.presence_cache[ujid.user] = stub
+            host = None
+
+        self._index(ujid.user, host, stub.jid.host)
+
+    def _forget_results(self, userid):
+        """Drops recent network lookup results for a user."""
+        if self._results:
+            for key in [key for key in self._results if key.user == userid]:
+                del self._results[key]
 
     def network_presence_probe(self, to):
         """
@@ -949,53 +1102,100 @@ class JIDCache(XMPPHandler):
         @return: a list of stanza IDs sent to the network that can be watched to
         for responses
         """
-        """
-        presence = domish.Element((None, 'presence'))
-        presence['type'] = 'probe'
-        presence['from'] = self.parent.network
+        # we need to be fast here: one multicast for the whole network
         idList = []
-        #to = jid.JID(tuple=(to.user, to.host, to.resource))
-        for server in self.parent.keyring.hostlist():
-            #to.host = server
-            presence['to'] = to.user + '@' + server
-            if to.resource:
-                presence['to'] += '/' + to.resource
-            presence.addUniqueId()
-            #presence['id'] = util.rand_str(8, util.CHARSBOX_AZN_LOWERCASE)
-            self.send(presence)
-            idList.append(presence['id'])
-        """
-        # we need to be fast here
-        idList = []
-        presence = "<presence type='probe' from='%s' to='%%s' id='%%s'/>" % (self.parent.network, )
+        rcpts = []
         for server in self.parent.keyring.hostlist():
             packetId = util.rand_str(8, util.CHARSBOX_AZN_LOWERCASE)
             dest = to.user + '@' + server
             if to.resource:
                 dest += '/' + to.resource
-            self.send(presence % (dest, packetId))
+            rcpts.append((dest, packetId))
             idList.append(packetId)
 
+        presence = domish.Element((None, 'presence'))
+        presence['type'] = 'probe'
+        presence['from'] = self.parent.network
+        self.parent.multicast(presence, rcpts)
+
         return idList
 
     def find(self, _jid, wait_factor=1.0):
         """
         Send a presence probe to the network and wait for responses.
+        Concurrent lookups for the same JID share the same probe, and results
+        are reused for L{lookup_freshness} seconds. Users known not to be on
+        the network are not probed at all.
         @return a L{Deferred} which will be fired with the JID of the probed
         entity.
         """
+        if self.is_unknown(_jid):
+            return defer.succeed(None)
+
+        now = time.time()
+        try:
+            expire, result = self._results[_jid]
+            if expire > now:
+                return defer.succeed(list(result) if result else None)
+        except KeyError:
+            pass
+
+        d = defer.Deferred()
+        try:
+            self.lookups[_jid].append(d)
+        except KeyError:
+            self.lookups[_jid] = [d]
+            self._probe(_jid, wait_factor).addBoth(self._found, _jid)
+        return d
+
+    def _found(self, result, _jid):
+        """Delivers the result of a network lookup to all waiting callers."""
+        waiters = self.lookups.pop(_jid)
+        if isinstance(result, failure.Failure):
+            for d in waiters:
+                d.errback(result)
+            return
+
+        # no server replied with a presence
+        if not any(result):
+            result = None
+
+        if self.lookup_freshness > 0:
+            now = time.time()
+            # purge expired results
+            while self._results_expiry and self._results_expiry[0][0] <= now:
+                expire, key = self._results_expiry.popleft()
+                if key in self._results and self._results[key][0] <= now:
+                    del self._results[key]
+
+            expire = now + self.lookup_freshness
+            self._results[_jid] = (expire, result)
+            self._results_expiry.append((expire, _jid))
+
+        if result is None:
+            self.set_unknown(_jid)
+            for d in waiters:
+                d.callback(None)
+            return
+
+        for d in waiters:
+            d.callback(list(result))
+
+    def _probe(self, _jid, wait_factor):
         idList = self.network_presence_probe(_jid)
-        def _presence(stanza, callback, timeout, buf):
+        correlator = self.parent.correlator
+
+        def _done(stanzaId):
+            correlator.cancel(stanzaId, group=True)
+            correlator.cancel(stanzaId)
+
+        def _presence(stanza, packetId, result, buf):
             # presence probe error - finish here
             if stanza.getAttribute('type') == 'error':
-                # TODO duplicated code
-                self.xmlstream.removeObserver("/presence/group[@id='%s']" % (stanza['id'], ), _presence)
-                self.xmlstream.removeObserver("/presence[@type='error'][@id='%s']" % (stanza['id'], ), _presence)
-                if not callback.called:
-                    # cancel timeout
-                    timeout.cancel()
+                _done(packetId)
+                if not result.called:
                     # fire deferred
-                    callback.callback(buf)
+                    result.callback(buf)
                 return
 
             sender = jid.JID(stanza['from'])
@@ -1006,19 +1206,14 @@ class JIDCache(XMPPHandler):
             chain = stanza.group
             # end of presence chain!!!
             if not chain or int(chain['count']) == len(buf):
-                # TODO duplicated code
-                self.xmlstream.removeObserver("/presence/group[@id='%s']" % (stanza['id'], ), _presence)
-                self.xmlstream.removeObserver("/presence[@type='error'][@id='%s']" % (stanza['id'], ), _presence)
-                if not callback.called:
-                    # cancel timeout
-                    timeout.cancel()
+                _done(packetId)
+                if not result.called:
                     # fire deferred
-                    callback.callback(buf)
+                    result.callback(buf)
 
-        def _abort(stanzaId, callback, buf):
+        def _abort(packetId, callback, buf):
             #log.debug("presence broadcast request timed out!")
-            self.xmlstream.removeObserver("/presence/group[@id='%s']" % (stanzaId, ), _presence)
-            self.xmlstream.removeObserver("/presence[@type='error'][@id='%s']" % (stanzaId, ), _presence)
+            _done(packetId)
             if not callback.called:
                 #callback.errback(failure.Failure(internet_error.TimeoutError()))
                 callback.callback(buf if len(buf) > 0 else None)
@@ -1030,17 +1225,138 @@ class JIDCache(XMPPHandler):
             # this will contain presence probe hits for this JID
             buf = []
 
-            # timeout of request
-            timeout = reactor.callLater(self.MAX_LOOKUP_TIMEOUT*wait_factor*len(idList), _abort, stanzaId=stanzaId, callback=d, buf=buf)
-
-            # add stanza group observer
-            self.xmlstream.addObserver("/presence/group[@id='%s']" % (stanzaId, ), _presence, 150, callback=d, timeout=timeout, buf=buf)
-            # routing error observer
-            self.xmlstream.addObserver("/presence[@type='error'][@id='%s']" % (stanzaId, ), _presence, 150, callback=d, timeout=timeout, buf=buf)
+            # stanza group responses (with timeout)
+            correlator.expect(stanzaId, _presence, 150,
+                timeout=self.MAX_LOOKUP_TIMEOUT*wait_factor*len(idList),
+                onTimeout=functools.partial(_abort, stanzaId, d, buf),
+                once=False, group=True, name='presence',
+                kwargs={'packetId': stanzaId, 'result': d, 'buf': buf})
+            # routing error
+            correlator.expect(stanzaId, _presence, 150, once=False, name='presence', stype='error',
+                kwargs={'packetId': stanzaId, 'result': d, 'buf': buf})
 
         # gather all returned presence from the network
         return defer.gatherResults(deferList, True)
 
+    def find_all(self, jids):
+        """
+        Look up many users at once on the network: a single probe carrying
+        all the userids is sent to every server and each server replies with
+        one stanza containing the presence of the users it hosts. Presence
+        cache is updated with the replies, while users not found anywhere are
+        remembered as unknown.
+        Users already being looked up by another call are not probed again:
+        the call waits for the lookup in progress instead.
+        @return: a L{Deferred} fired with the set of userids found when all
+        servers replied or timed out
+        """
+        userids = set(_jid.user for _jid in jids if _jid.user)
+        if not userids:
+            return defer.succeed(set())
+
+        # lookups in progress for some of the users
+        pending = []
+        probe = set()
+        for userid in userids:
+            try:
+                lookup = self.batch_lookups[userid]
+                if lookup not in pending:
+                    pending.append(lookup)
+            except KeyError:
+                probe.add(userid)
+
+        if probe:
+            pending.append(self._probe_all(probe))
+
+        def _wait(lookup):
+            # lookups are shared: do not alter their result
+            d = defer.Deferred()
+            def _fire(result):
+                if isinstance(result, failure.Failure):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+                return result
+            lookup.addBoth(_fire)
+            return d
+
+        deferList = [_wait(lookup) for lookup in pending]
+
+        def _found(results):
+            return userids & set().union(*results)
+
+        return defer.gatherResults(deferList, True).addCallback(_found)
+
+    def _probe_all(self, userids):
+        """
+        Sends a batched probe for the given userids to the network.
+        @return: a L{Deferred} fired with the set of userids found
+        """
+        lookup = defer.Deferred()
+        for userid in userids:
+            self.batch_lookups[userid] = lookup
+
+        iq = domish.Element((None, 'iq'))
+        iq['type'] = 'get'
+        iq['from'] = self.parent.network
+        query = iq.addElement((xmlstream2.NS_PRESENCE_PROBE, 'query'))
+        for userid in userids:
+            item = query.addElement('item')
+            item['jid'] = userid + '@' + self.parent.network
+        self.parent.translate_sender(iq)
+
+        correlator = self.parent.correlator
+        found = set()
+
+        def _response(stanza, result):
+            stanza.consumed = True
+            if stanza.getAttribute('type') == 'result' and stanza.query:
+                for presence in stanza.query.elements():
+                    if presence.name != 'presence':
+                        continue
+
+                    userid = util.jid_user(presence['from'])
+                    if userid not in userids:
+                        continue
+
+                    found.add(userid)
+                    if presence.getAttribute('type') == 'unavailable':
+                        self.user_unavailable(presence)
+                    else:
+                        self.user_available(presence)
+
+            if not result.called:
+                result.callback(None)
+
+        def _abort(result):
+            if not result.called:
+                result.callback(None)
+
+        deferList = []
+        rcpts = []
+        for server in self.parent.keyring.hostlist():
+            stanzaId = util.rand_str(8, util.CHARSBOX_AZN_LOWERCASE)
+            rcpts.append((server, stanzaId))
+            d = defer.Deferred()
+            deferList.append(d)
+            correlator.expect(stanzaId, _response, 150,
+                timeout=self.MAX_LOOKUP_TIMEOUT,
+                onTimeout=functools.partial(_abort, d),
+                name='iq', kwargs={'result': d})
+
+        self.parent.multicast(iq, rcpts)
+
+        def _done(unused):
+            for userid in userids:
+                self.batch_lookups.pop(userid, None)
+            for userid in userids - found:
+                if userid not in self.presence_cache:
+                    self.set_unknown(jid.JID(tuple=(userid, self.parent.network, None)))
+            return found
+
+        defer.gatherResults(deferList).addCallback(_done).chainDeferred(lookup)
+        return lookup
+
     def jid_available(self, _jid):
         """Return true if L{JID} has an available resource."""
         try:
@@ -1056,6 +1372,156 @@ class JIDCache(XMPPHandler):
         except:
             pass
 
+    def is_unknown(self, _jid):
+        """
+        Returns true if the user was recently found not to be on the network,
+        thus there is no need to look for it.
+        """
+        try:
+            expire = self.unknown[_jid.user]
+            if expire > time.time():
+                self.unknown_hits += 1
+                return True
+            del self.unknown[_jid.user]
+        except KeyError:
+            pass
+
+        self.unknown_misses += 1
+        return False
+
+    def set_unknown(self, _jid):
+        """Remembers the user as not being on the network."""
+        if self.unknown_ttl <= 0:
+            return
+
+        userid = _jid.user
+        self.unknown.pop(userid, None)
+        self.unknown[userid] = time.time() + self.unknown_ttl
+        # oldest entries expire first
+        while len(self.unknown) > self.unknown_size:
+            self.unknown.popitem(last=False)
+
+    def stats(self):
+        """Returns metrics about the cache."""
+        return {
+            'presence': len(self.presence_cache),
+            'lookups': len(self.lookups),
+            'batch_lookups': len(self.batch_lookups),
+            'unknown': len(self.unknown),
+            'unknown_hits': self.unknown_hits,
+            'unknown_misses': self.unknown_misses,
+        }
+
+
+class SubscriptionRegistry(object):
+    """
+    Presence subscriptions between users, indexed in both directions.
+    @ivar subscribers: subscribers of each watched user
+    @type subscribers: C{dict} [watched]=set(subscriber)
+    @ivar watched: users watched by each subscriber
+    @type watched: C{dict} [subscriber]=set(watched)
+    @ivar edges: total number of subscriptions
+    @ivar max_fanout: largest number of subscribers of a single user
+    """
+
+    def __init__(self):
+        self.subscribers = {}
+        self.watched = {}
+        self.edges = 0
+        self.max_fanout = 0
+        # number of watched users by subscribers count
+        self._fanouts = {}
+
+    def __len__(self):
+        """Returns the number of watched users."""
+        return len(self.subscribers)
+
+    def __contains__(self, watched):
+        return watched in self.subscribers
+
+    def get(self, watched):
+        """Returns the subscribers of the given user."""
+        return self.subscribers.get(watched, ())
+
+    def _resize(self, old, new):
+        if old:
+            count = self._fanouts[old] - 1
+            if count:
+                self._fanouts[old] = count
+            else:
+                del self._fanouts[old]
+                # fan-outs change by one, so the next largest is right below
+                if old == self.max_fanout and new < old:
+                    self.max_fanout = new
+
+        if new:
+            self._fanouts[new] = self._fanouts.get(new, 0) + 1
+            if new > self.max_fanout:
+                self.max_fanout = new
+
+    def add(self, watched, subscriber):
+        """
+        Subscribe a user to another one.
+        @return: true if the subscription was not already there
+        """
+        try:
+            subs = self.subscribers[watched]
+            if subscriber in subs:
+                return False
+            subs.add(subscriber)
+        except KeyError:
+            subs = self.subscribers[watched] = set((subscriber, ))
+
+        try:
+            self.watched[subscriber].add(watched)
+        except KeyError:
+            self.watched[subscriber] = set((watched, ))
+
+        self.edges += 1
+        self._resize(len(subs) - 1, len(subs))
+        return True
+
+    def remove(self, watched, subscriber):
+        """
+        Unsubscribe a user from another one.
+        @return: true if the subscription was found
+        """
+        try:
+            subs = self.subscribers[watched]
+            subs.remove(subscriber)
+        except KeyError:
+            return False
+
+        if not subs:
+            del self.subscribers[watched]
+
+        wlist = self.watched[subscriber]
+        wlist.discard(watched)
+        if not wlist:
+            del self.watched[subscriber]
+
+        self.edges -= 1
+        self._resize(len(subs) + 1, len(subs))
+        return True
+
+    def remove_subscriber(self, subscriber):
+        """
+        Cancel all subscriptions requested by the given user.
+        @return: the number of subscriptions removed
+        """
+        wlist = self.watched.get(subscriber)
+        if not wlist:
+            return 0
+
+        count = 0
+        for watched in list(wlist):
+            if self.remove(watched, subscriber):
+                count += 1
+        return count
+
+    def __repr__(self):
+        return '<SubscriptionRegistry edges=%d, subscribers=%r>' % (self.edges, self.subscribers)
+
 
 class Resolver(xmlstream2.SocketComponent):
     """
@@ -1064,8 +1530,8 @@ class Resolver(xmlstream2.SocketComponent):
     JIDs (prime.kontalk.net), altering the "to" attribute, then it bounces the
     stanza back to the router.
 
-    @ivar subscriptions: a map of active user subscriptions (key=watched, value=subscribers)
-    @type subscriptions: L{dict}
+    @ivar subscriptions: active user subscriptions
+    @type subscriptions: L{SubscriptionRegistry}
 
     @ivar whitelists: a map of user whitelists (key=user, value=list(allowed_users))
     @type whitelists: L{dict}
@@ -1073,6 +1539,17 @@ class Resolver(xmlstream2.SocketComponent):
     @ivar blacklists: a map of user blacklists (key=user, value=list(blocked_users))
     @type blacklists: L{dict}
 
+    @ivar privacydb: persistent storage for L{whitelists} and L{blacklists}
+    @type privacydb: L{storage.PrivacyListStorage}
+
+    @ivar privacy_versions: version of the privacy lists of users changed
+    by local clients (key=user, value=version)
+    @type privacy_versions: L{dict}
+
+    @ivar privacy_synced: last privacy lists version received from remote
+    resolvers (key=resolver JID, value=version)
+    @type privacy_synced: L{dict}
+
     @ivar cache: a local JID cache
     @type cache: L{JIDCache}
     """
@@ -1089,6 +1566,19 @@ class Resolver(xmlstream2.SocketComponent):
     WHITELIST = 1
     BLACKLIST = 2
 
+    """Users per privacy lists sync stanza."""
+    PRIVACY_SYNC_CHUNK = 100
+
+    """Seconds privacy list changes are accumulated before broadcasting."""
+    PRIVACY_BROADCAST_DELAY = 0.1
+
+    PRIVACY_OPPOSITES = {
+        'allow': 'unallow',
+        'unallow': 'allow',
+        'block': 'unblock',
+        'unblock': 'block',
+    }
+
     def __init__(self, config):
         router_cfg = config['router']
         for key in ('socket', 'host', 'port'):
@@ -1107,9 +1597,21 @@ class Resolver(xmlstream2.SocketComponent):
         storage.init(config['database'])
         self.keyring = keyring.Keyring(storage.MySQLNetworkStorage(), config['fingerprint'], self.network, self.servername, True)
 
-        self.subscriptions = {}
+        self.subscriptions = SubscriptionRegistry()
         self.whitelists = {}
         self.blacklists = {}
+        self.privacydb = storage.MySQLPrivacyListStorage()
+        self.privacy_versions = {}
+        self.privacy_synced = {}
+        self._privacy_version = 0
+        # privacy lists loading in progress (see startService)
+        self._privacy_loading = None
+        # hosts of network servers: [host]=bool (see _network_host)
+        self._network_hosts = {}
+        self._network_hosts_version = None
+        # queued privacy list broadcasts: [(user, operation)]=set(items)
+        self._privacy_broadcasts = OrderedDict()
+        self._privacy_broadcast_call = None
 
         # protocol handlers here!!
         for handler in self.protocolHandlers:
@@ -1118,11 +1620,76 @@ class Resolver(xmlstream2.SocketComponent):
                 self.cache = inst
             inst.setHandlerParent(self)
 
+        if 'lookup_freshness' in config:
+            self.cache.lookup_freshness = config['lookup_freshness']
+        if 'unknown_ttl' in config:
+            self.cache.unknown_ttl = config['unknown_ttl']
+        if 'unknown_size' in config:
+            self.cache.unknown_size = config['unknown_size']
+        if 'key_cache_size' in config:
+            self.keyring.key_cache_size = config['key_cache_size']
+
+    def startService(self):
+        xmlstream2.SocketComponent.startService(self)
+
+        # warm start: load persisted privacy lists and their versions
+        start = time.time()
+        def _loaded(result):
+            self._privacy_loading = None
+            log.debug("%d privacy list entries loaded in %.3f seconds" % (result[0], time.time() - start))
+        def _error(failure):
+            self._privacy_loading = None
+            log.error("unable to load privacy lists: %s" % (failure.value.subFailure.getErrorMessage(), ))
+
+        self._privacy_loading = defer.gatherResults([
+            self.privacydb.load(self._load_privacy_lists),
+            self.privacydb.load_versions().addCallback(self._load_privacy_versions),
+        ], consumeErrors=True)
+        self._privacy_loading.addCallbacks(_loaded, _error)
+
+    def _load_privacy_lists(self, rows):
+        """Merge a chunk of persisted privacy list entries in memory."""
+        removed = self.privacydb.removed
+        for userid, list_type, target in rows:
+            # entry removed while loading
+            if removed(userid, list_type, target):
+                continue
+
+            if list_type == self.WHITELIST:
+                data = self.whitelists
+            elif list_type == self.BLACKLIST:
+                data = self.blacklists
+            else:
+                continue
+
+            # the same JIDs appear in many lists
+            target = intern(str(target))
+            try:
+                data[userid].add(target)
+            except KeyError:
+                data[userid] = set((target, ))
+
+    def _load_privacy_versions(self, rows):
+        """Restores the persisted privacy lists versions of local users."""
+        for userid, version in rows:
+            version = int(version)
+            # lists might have been changed while loading
+            if version > self.privacy_versions.get(userid, 0):
+                self.privacy_versions[userid] = version
+            if version > self._privacy_version:
+                self._privacy_version = version
+
     def uptime(self):
         return time.time() - self.start_time
 
+    def stats(self):
+        stats = xmlstream2.SocketComponent.stats(self)
+        stats['keyring'] = self.keyring.stats()
+        stats['cache'] = self.cache.stats()
+        return stats
+
     def _authd(self, xs):
-        component.Component._authd(self, xs)
+        xmlstream2.SocketComponent._authd(self, xs)
         log.debug("connected to router")
         xs.addObserver("/iq", self.iq, 500)
         xs.addObserver("/presence", self.presence, 500)
@@ -1194,11 +1761,7 @@ class Resolver(xmlstream2.SocketComponent):
         to = jid.JID(stanza['to'])
 
         # force host in sender
-        component_jid = util.component_jid(self.servername, util.COMPONENT_RESOLVER)
-        sender = jid.JID(stanza['from'])
-        if sender.host == self.network:
-            sender.host = component_jid
-            stanza['from'] = sender.full()
+        component_jid = self.translate_sender(stanza)
 
         # stanza is intended to the network
         if to.full() == self.network or to.host == component_jid:
@@ -1272,12 +1835,22 @@ class Resolver(xmlstream2.SocketComponent):
         else:
             component.Component.send(self, stanza)
 
+    def translate_sender(self, stanza):
+        """
+        Force our component host in the sender of the given stanza if it comes
+        from the network.
+        @return: our component JID
+        """
+        component_jid = util.component_jid(self.servername, util.COMPONENT_RESOLVER)
+        sender = jid.JID(stanza['from'])
+        if sender.host == self.network:
+            sender.host = component_jid
+            stanza['from'] = sender.full()
+        return component_jid
+
     def cancelSubscriptions(self, user):
         """Cancel all subscriptions requested by the given user."""
-        for rlist in self.subscriptions.itervalues():
-            for sub in rlist:
-                if sub == user:
-                    rlist.remove(sub)
+        self.subscriptions.remove_subscriber(user)
 
     def subscribe(self, jid_from, jid_to, gid=None, send_subscribed=True):
         allowed = self.is_presence_allowed(jid_from, jid_to)
@@ -1286,27 +1859,33 @@ class Resolver(xmlstream2.SocketComponent):
             self.doSubscribe(jid_to, jid_from, gid, send_subscribed=send_subscribed)
         elif allowed == -1:
             log.debug("user is blacklisted, ignoring request")
+        elif allowed == -2 and self.cache.is_unknown(jid_to):
+            log.debug("user is not on the network, ignoring request")
         else:
             log.debug("not authorized to subscribe to user's presence, sending request")
-            try:
-                stanza = domish.Element((None, 'presence'))
-                stanza['type'] = 'subscribe'
-                stanza['from'] = jid_from.full()
-                stanza['to'] = jid_to.full()
+            stanza = domish.Element((None, 'presence'))
+            stanza['type'] = 'subscribe'
+            stanza['from'] = jid_from.full()
+            stanza['to'] = jid_to.full()
 
-                fpr = self.keyring.get_fingerprint(jid_from.user)
-                keydata = self.keyring.get_key(jid_from.user, fpr)
+            def _pubkey(uri, fpr):
                 pubkey = stanza.addElement(('urn:xmpp:pubkey:2', 'pubkey'))
 
                 # key data
                 key = pubkey.addElement((None, 'key'))
-                key.addContent(base64.b64encode(keydata))
+                key.addContent(uri[len(xmlstream2.DATA_PGP_PREFIX):])
 
                 # fingerprint
                 fprint = pubkey.addElement((None, 'print'))
                 fprint.addContent(fpr)
 
                 self.send(stanza)
+
+            try:
+                fpr = self.keyring.get_fingerprint(jid_from.user)
+                d = self.keyring.get_key_uri(jid_from.user, fpr)
+                d.addCallback(_pubkey, fpr)
+                d.addErrback(log.error)
             except:
                 import traceback
                 traceback.print_exc()
@@ -1316,11 +1895,7 @@ class Resolver(xmlstream2.SocketComponent):
         """Subscribe a given user to events from another one."""
 
         if not response_only:
-            try:
-                if subscriber not in self.subscriptions[to]:
-                    self.subscriptions[to].append(subscriber)
-            except:
-                self.subscriptions[to] = [subscriber]
+            self.subscriptions.add(to, subscriber)
 
             log.debug("subscriptions: %r" % (self.subscriptions, ))
 
@@ -1356,14 +1931,7 @@ class Resolver(xmlstream2.SocketComponent):
 
     def unsubscribe(self, to, subscriber):
         """Unsubscribe a given user from events from another one."""
-        try:
-            self.subscriptions[to].remove(subscriber)
-
-            # clean up
-            if len(self.subscriptions[to]) == 0:
-                del self.subscriptions[to]
-        except:
-            pass
+        self.subscriptions.remove(to, subscriber)
 
     def broadcastSubscribers(self, stanza):
         """Broadcast stanza to JID subscribers."""
@@ -1391,7 +1959,7 @@ class Resolver(xmlstream2.SocketComponent):
             #stanza['from'] = watched.full()
 
             removed = []
-            for sub in self.subscriptions[bareWatched]:
+            for sub in self.subscriptions.get(bareWatched):
                 if self.is_presence_allowed(sub, watched) == 1:
                     log.debug("notifying subscriber %s" % (sub, ))
                     stanza['to'] = sub.userhost()
@@ -1402,7 +1970,7 @@ class Resolver(xmlstream2.SocketComponent):
 
             # remove unauthorized users
             for e in removed:
-                self.subscriptions[bareWatched].remove(e)
+                self.subscriptions.remove(bareWatched, e)
 
     def translateJID(self, _jid, resource=True):
         """
@@ -1419,76 +1987,217 @@ class Resolver(xmlstream2.SocketComponent):
 
         return _jid if resource else _jid.userhostJID()
 
-    def _broadcast_privacy_list_change(self, dest, src, node):
-        # broadcast to all resolvers
-        iq = domish.Element((None, 'iq'))
-        iq['from'] = dest
-        iq['type'] = 'set'
-        iq['id'] = util.rand_str(8)
-        nodeElement = iq.addElement(('urn:xmpp:blocking', node))
-        nodeElement.addElement((None, 'item'), content=src)
+    def _broadcast_privacy_list_change(self, src, items, node):
+        """
+        Queue privacy list changes for broadcast to all resolvers. Changes are
+        accumulated for L{PRIVACY_BROADCAST_DELAY} seconds and sent as one
+        stanza per user and list operation.
+        """
+        pending = self._privacy_broadcasts
+        try:
+            pending[(src, node)].update(items)
+        except KeyError:
+            pending[(src, node)] = set(items)
 
-        for server in self.keyring.hostlist():
-            if server != self.servername:
-                iq['to'] = util.component_jid(server, util.COMPONENT_RESOLVER)
-                self.send(iq)
+        # last operation on an item wins
+        try:
+            pending[(src, self.PRIVACY_OPPOSITES[node])].difference_update(items)
+        except KeyError:
+            pass
+
+        if not self._privacy_broadcast_call:
+            self._privacy_broadcast_call = reactor.callLater(self.PRIVACY_BROADCAST_DELAY,
+                self._flush_privacy_broadcasts)
+
+    def _flush_privacy_broadcasts(self):
+        """Sends queued privacy list changes to all resolvers."""
+        if self._privacy_broadcast_call:
+            if self._privacy_broadcast_call.active():
+                self._privacy_broadcast_call.cancel()
+            self._privacy_broadcast_call = None
 
-    def _privacy_list_add(self, jid_to, jid_from, list_type, broadcast=True):
+        pending = self._privacy_broadcasts
+        self._privacy_broadcasts = OrderedDict()
+
+        rcpts = [util.component_jid(server, util.COMPONENT_RESOLVER)
+            for server in self.keyring.hostlist() if server != self.servername]
+        if not rcpts:
+            return
+
+        for (src, node), items in pending.iteritems():
+            if not items:
+                continue
+
+            iq = domish.Element((None, 'iq'))
+            iq['from'] = src
+            iq['type'] = 'set'
+            iq['id'] = util.rand_str(8)
+            nodeElement = iq.addElement((xmlstream2.NS_IQ_BLOCKING, node))
+            for item in items:
+                nodeElement.addElement('item', content=item)
+            self.translate_sender(iq)
+            self.multicast(iq, rcpts)
+
+    def privacy_list_update(self, jid_to, items, list_type, remove=False, broadcast=True):
+        """
+        Adds (or removes) the given JIDs to (from) a privacy list of jid_to.
+        @param broadcast: true if the change comes from a local client: it
+        will be versioned and broadcast to all resolvers
+        """
         if list_type == self.WHITELIST:
-            node = 'allow'
+            node = 'unallow' if remove else 'allow'
             data = self.whitelists
         elif list_type == self.BLACKLIST:
-            node = 'block'
+            node = 'unblock' if remove else 'block'
             data = self.blacklists
 
+        userid = jid_to.user
+        # entries might not be loaded yet: removals must reach the loader
+        loading = self._privacy_loading is not None
         try:
-            wl = data[jid_to.user]
+            wl = data[userid]
         except KeyError:
-            wl = data[jid_to.user] = set()
-
-        src = self.translateJID(jid_to, False).userhost()
-        dest = self.translateJID(jid_from, False).userhost()
-
-        wl.add(dest)
+            if remove and not loading:
+                return
+            wl = set() if remove else data.setdefault(userid, set())
+
+        dests = [self.translateJID(jid_from, False).userhost() for jid_from in items]
+        changed = False
+        for dest in dests:
+            if remove:
+                if dest in wl or loading:
+                    wl.discard(dest)
+                    self.privacydb.remove(userid, list_type, dest)
+                    changed = True
+            elif dest not in wl:
+                wl.add(dest)
+                self.privacydb.add(userid, list_type, dest)
+                changed = True
 
-        # broadcast to all resolvers
         if broadcast:
-            self._broadcast_privacy_list_change(src, dest, node)
-
-    def _privacy_list_remove(self, jid_to, jid_from, list_type, broadcast=True):
+            if changed:
+                self._privacy_list_changed(userid)
+            self._broadcast_privacy_list_change(self.translateJID(jid_to, False).userhost(), dests, node)
+
+    def _privacy_list_changed(self, userid):
+        """Assigns a new version to the privacy lists of a local user."""
+        # versions are timestamps so they keep growing across restarts
+        self._privacy_version = max(self._privacy_version + 1, int(time.time() * 1000))
+        self.privacy_versions[userid] = self._privacy_version
+        self.privacydb.set_version(userid, self._privacy_version)
+
+    def set_privacy_list(self, userid, list_type, items):
+        """Replaces a privacy list of a user."""
         if list_type == self.WHITELIST:
-            node = 'unallow'
             data = self.whitelists
         elif list_type == self.BLACKLIST:
-            node = 'unblock'
             data = self.blacklists
 
-        if jid_to.user in data:
-            wl = data[jid_to.user]
+        old = data.get(userid, set())
+        new = set(intern(str(item)) for item in items)
+        for target in old - new:
+            self.privacydb.remove(userid, list_type, target)
+        for target in new - old:
+            self.privacydb.add(userid, list_type, target)
+
+        if new:
+            data[userid] = new
+        else:
+            data.pop(userid, None)
 
-            src = self.translateJID(jid_to, False).userhost()
-            dest = self.translateJID(jid_from, False).userhost()
+    def request_privacy_sync(self, peer):
+        """Asks a remote resolver for privacy lists changed since the last sync."""
+        iq = domish.Element((None, 'iq'))
+        iq['type'] = 'get'
+        iq['id'] = util.rand_str(8)
+        iq['from'] = util.component_jid(self.servername, util.COMPONENT_RESOLVER)
+        iq['to'] = peer
+        sync = iq.addElement((xmlstream2.NS_PRIVACY_SYNC, 'sync'))
+        sync['since'] = str(self.privacy_synced.get(peer, 0))
+        self.send(iq)
 
-            wl.discard(dest)
+    def privacy_sync(self, peer, since):
+        """
+        Sends privacy lists of local users changed after the given version to
+        a remote resolver, as soon as persisted privacy lists are loaded.
+        """
+        if self._privacy_loading:
+            self._privacy_loading.addCallback(lambda unused: self.privacy_sync(peer, since))
+        else:
+            # transfer in chunks to keep the reactor responsive
+            task.cooperate(self.privacy_sync_chunks(peer, since))
 
-            # broadcast to all resolvers
-            self._broadcast_privacy_list_change(dest, src, node)
+    def privacy_sync_received(self, peer, sync):
+        """
+        Applies a chunk of privacy lists sent by a remote resolver, as soon as
+        persisted privacy lists are loaded.
+        """
+        if self._privacy_loading:
+            self._privacy_loading.addCallback(lambda unused: self.privacy_sync_received(peer, sync))
+            return
+
+        for user in sync.elements(uri=xmlstream2.NS_PRIVACY_SYNC, name='user'):
+            userid = util.jid_user(user['jid'])
+            for node, list_type in (('whitelist', self.WHITELIST), ('blocklist', self.BLACKLIST)):
+                items = []
+                for e in user.elements(uri=xmlstream2.NS_PRIVACY_SYNC, name=node):
+                    items.extend(str(it) for it in e.elements(uri=xmlstream2.NS_PRIVACY_SYNC, name='item'))
+                self.set_privacy_list(userid, list_type, items)
+
+        # last chunk: we are in sync up to this version
+        version = sync.getAttribute('version')
+        if version:
+            self.privacy_synced[peer] = int(version)
+
+    def privacy_sync_chunks(self, peer, since):
+        """
+        Sends privacy lists of local users changed after the given version to
+        a remote resolver, one chunk of L{PRIVACY_SYNC_CHUNK} users at a time.
+        The last chunk carries the version the peer is now in sync with.
+        Meant to be run by a L{task.Cooperator}.
+        """
+        version = self._privacy_version
+        users = [userid for userid, v in self.privacy_versions.iteritems() if v > since]
+        sender = util.component_jid(self.servername, util.COMPONENT_RESOLVER)
+        log.debug("sending %d privacy lists to %s" % (len(users), peer))
+
+        for i in xrange(0, max(len(users), 1), self.PRIVACY_SYNC_CHUNK):
+            iq = domish.Element((None, 'iq'))
+            iq['type'] = 'set'
+            iq['id'] = util.rand_str(8)
+            iq['from'] = sender
+            iq['to'] = peer
+            sync = iq.addElement((xmlstream2.NS_PRIVACY_SYNC, 'sync'))
+
+            for userid in users[i:i+self.PRIVACY_SYNC_CHUNK]:
+                user = sync.addElement('user')
+                user['jid'] = userid + '@' + self.network
+                for node, data in (('whitelist', self.whitelists), ('blocklist', self.blacklists)):
+                    e = user.addElement(node)
+                    for item in data.get(userid, ()):
+                        e.addElement('item', content=item)
+
+            if i + self.PRIVACY_SYNC_CHUNK >= len(users):
+                sync['version'] = str(version)
+
+            self.send(iq)
+            yield None
 
     def add_blacklist(self, jid_to, jid_from, broadcast=True):
         """Adds jid_from to jid_to's blacklist."""
-        self._privacy_list_add(jid_to, jid_from, self.BLACKLIST, broadcast)
+        self.privacy_list_update(jid_to, (jid_from, ), self.BLACKLIST, False, broadcast)
 
     def add_whitelist(self, jid_to, jid_from, broadcast=True):
         """Adds jid_from to jid_to's whitelist."""
-        self._privacy_list_add(jid_to, jid_from, self.WHITELIST, broadcast)
+        self.privacy_list_update(jid_to, (jid_from, ), self.WHITELIST, False, broadcast)
 
     def remove_blacklist(self, jid_to, jid_from, broadcast=True):
         """Removes jid_from from jid_to's blacklist."""
-        self._privacy_list_remove(jid_to, jid_from, self.BLACKLIST, broadcast)
+        self.privacy_list_update(jid_to, (jid_from, ), self.BLACKLIST, True, broadcast)
 
     def remove_whitelist(self, jid_to, jid_from, broadcast=True):
         """Removes jid_from from jid_to's whitelist."""
-        self._privacy_list_remove(jid_to, jid_from, self.WHITELIST, broadcast)
+        self.privacy_list_update(jid_to, (jid_from, ), self.WHITELIST, True, broadcast)
 
     def get_whitelist(self, _jid):
         try:
@@ -1496,44 +2205,72 @@ class Resolver(xmlstream2.SocketComponent):
         except KeyError:
             return None
 
-    def is_presence_allowed(self, jid_from, jid_to):
+    def _network_host(self, host):
         """
-        Checks if requester (from) is allowed to see a user's (to) presence.
-        @return 1 if allowed, 0 if not allowed, -1 if blacklisted, -2 if user not found
+        Returns true if host is a component of a server in the network, i.e.
+        JIDs with this host are translated to network JIDs (see
+        L{translateJID}). Results are cached until the server list changes.
         """
+        index = self.keyring.index
+        if self._network_hosts_version != index.version:
+            self._network_hosts_version = index.version
+            self._network_hosts = {}
 
-        if not self.cache.lookup(jid_to):
+        try:
+            return self._network_hosts[host]
+        except KeyError:
+            try:
+                unused, server = util.jid_component(host)
+                network = server in index.hosts
+            except (ValueError, TypeError):
+                network = False
+            self._network_hosts[host] = network
+            return network
+
+    def _presence_allowed(self, from_user, from_host, to_user, to_host):
+        """Decision path for L{is_presence_allowed}, working on JID parts."""
+        if to_user not in self.cache.presence_cache:
             return -2
 
         # servers are allowed to subscribe to user presence
-        if not jid_from.user:
+        if not from_user:
             return 1
 
-        # translate to network JID first
-        jid_from = self.translateJID(jid_from, False)
-        translated_to = self.translateJID(jid_to, False)
+        # translate to network host first
+        if from_host == self.network or self._network_host(from_host):
+            from_host = self.network
+        if to_host == self.network or self._network_host(to_host):
+            to_host = self.network
 
         # talking to ourselves :)
-        if jid_from == translated_to:
+        if from_user == to_user and from_host == to_host:
             return 1
 
-        # blacklist has priority
-        try:
-            bl = self.blacklists[jid_to.user]
-            if jid_from.userhost() in bl:
+        bl = self.blacklists.get(to_user)
+        wl = self.whitelists.get(to_user)
+        if bl or wl:
+            sender = from_user + '@' + from_host
+            # blacklist has priority
+            if bl and sender in bl:
                 return -1
-
-        except KeyError:
-            # blacklist not present for user - go ahead
-            pass
-
-        try:
-            wl = self.whitelists[jid_to.user]
-            if jid_from.userhost() in wl:
+            if wl and sender in wl:
                 return 1
 
-        except KeyError:
-            # whitelist not present for the user - not authorized
-            pass
-
+        # whitelist not present for the user - not authorized
         return 0
+
+    def is_presence_allowed(self, jid_from, jid_to):
+        """
+        Checks if requester (from) is allowed to see a user's (to) presence.
+        @return 1 if allowed, 0 if not allowed, -1 if blacklisted, -2 if user not found
+        """
+        return self._presence_allowed(jid_from.user, jid_from.host, jid_to.user, jid_to.host)
+
+    def is_presence_allowed_batch(self, pairs):
+        """
+        Like L{is_presence_allowed}, for many (from, to) pairs at once.
+        @return: a list of results, in the same order of pairs
+        """
+        allowed = self._presence_allowed
+        return [allowed(jid_from.user, jid_from.host, jid_to.user, jid_to.host)
+            for jid_from, jid_to in pairs]
@@ -19,24 +19,240 @@
 """
 
 
+import re
+
+from collections import deque, OrderedDict
+from xml.sax import saxutils
+
+from zope.interface import implements
+
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+
 from twisted.words.protocols.jabber.component import XMPPComponentServerFactory
 from twisted.words.protocols.jabber import error, xmlstream
 from twisted.words.xish import domish
 
 from wokkel import component
-from wokkel.xmppim import Presence, UnavailablePresence
 
 from kontalk.xmppserver import log, util, xmlstream2
 
 
+# any start, end or empty-element tag
+_TAG_RE = re.compile(r'<(/?)([^\s/<>!?]+)((?:[^<>"\'/]|"[^"<]*"|\'[^\'<]*\'|/(?!>))*)(/?)>')
+# a single attribute inside a tag
+_ATTR_RE = re.compile(r'([^\s=]+)\s*=\s*(?:"([^"<]*)"|\'([^\'<]*)\')')
+# whitespace between top-level elements (e.g. keepalives)
+_WHITESPACE_RE = re.compile(r'\s*')
+
+# entities that might appear in attribute values
+_ATTR_ENTITIES = {'&apos;': "'", '&quot;': '"'}
+
+
+def scan_element(data, pos=0, state=None):
+    """
+    Scan a complete top-level element in data, starting at pos, without
+    parsing it.
+    @param state: an empty list the first time an element is scanned: if the
+    element is not complete yet, the scan state is saved in it so that the
+    next call (with the same pos and more data) resumes where this one stopped
+    @return: a (end, name, attributes) tuple or None if data does not contain a
+    complete element yet
+    @raise ValueError: if data contains markup the scanner does not handle
+    (comments, CDATA sections, processing instructions, end of stream)
+    """
+    if state:
+        name, attrs, end, depth = state
+    else:
+        match = _TAG_RE.match(data, pos)
+        if not match:
+            if data.find('>', pos) >= 0:
+                raise ValueError('unsupported markup')
+            return None
+
+        if match.group(1):
+            raise ValueError('unexpected end tag')
+
+        name = match.group(2)
+        attrs = {}
+        for attr in _ATTR_RE.finditer(match.group(3)):
+            value = attr.group(2)
+            if value is None:
+                value = attr.group(3)
+            if '&' in value:
+                value = saxutils.unescape(value, _ATTR_ENTITIES)
+            attrs[attr.group(1)] = value.decode('utf-8')
+
+        if match.group(4):
+            return match.end(), name, attrs
+
+        depth = 1
+        end = match.end()
+
+    # look for the matching end tag
+    while depth > 0:
+        start = data.find('<', end)
+        if start < 0:
+            break
+        match = _TAG_RE.match(data, start)
+        if not match:
+            if data.find('>', start) >= 0:
+                raise ValueError('unsupported markup')
+            break
+
+        if match.group(1):
+            depth -= 1
+        elif not match.group(4):
+            depth += 1
+        end = match.end()
+
+    if depth > 0:
+        # incomplete element, resume from the last complete tag
+        if state is not None:
+            state[:] = [name, attrs, end, depth]
+        return None
+
+    return end, name, attrs
+
+
+class RouteQueue(object):
+    """
+    Outbound queue of a component stream.
+
+    Stanzas are written directly to the stream as long as its transport can
+    keep up. When the transport buffer fills up, the transport pauses us and
+    stanzas are queued; when the queue grows beyond the router high-water mark,
+    the streams producing traffic for this queue are paused (we stop reading
+    from them) until the queue drains below the low-water mark.
+    Urgent stanzas (bindings and component presence) have their own lane which
+    is always flushed first.
+
+    @ivar paused: true if the stream transport asked us to stop writing
+    @ivar producers: streams we paused because of our backlog
+    """
+    implements(IPushProducer)
+
+    def __init__(self, router, xs):
+        self.router = router
+        self.xs = xs
+        self.paused = False
+        self.urgent = deque()
+        self.queue = deque()
+        self.producers = set()
+
+        transport = getattr(xs, 'transport', None)
+        if transport is not None:
+            transport.registerProducer(self, True)
+
+    def __len__(self):
+        return len(self.urgent) + len(self.queue)
+
+    def send(self, obj, source=None, urgent=False):
+        if not self.paused and not self.urgent and not self.queue:
+            self.xs.send(obj)
+            return
+
+        # serialize now: the same element might be altered and sent again
+        if domish.IElement.providedBy(obj):
+            obj = obj.toXml()
+        if isinstance(obj, unicode):
+            obj = obj.encode('utf-8')
+
+        if urgent:
+            self.urgent.append(obj)
+        else:
+            self.queue.append(obj)
+            if len(self.queue) >= self.router.queue_high_water and \
+                    source is not None and source is not self.xs and \
+                    source not in self.producers:
+                log.debug("outbound queue is full (%d stanzas), pausing producer" %
+                    (len(self.queue), ))
+                self.producers.add(source)
+                self.router.pauseProducer(source)
+
+    def flush(self):
+        while not self.paused:
+            if self.urgent:
+                self.xs.send(self.urgent.popleft())
+            elif self.queue:
+                self.xs.send(self.queue.popleft())
+            else:
+                break
+
+        if len(self.queue) <= self.router.queue_low_water:
+            self.release()
+
+    def release(self):
+        """Resume all the producers we paused."""
+        producers = self.producers
+        self.producers = set()
+        for source in producers:
+            self.router.resumeProducer(source)
+
+    def close(self):
+        """Drop the queue and resume paused producers."""
+        self.paused = True
+        self.urgent.clear()
+        self.queue.clear()
+        self.release()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.flush()
+
+    def stopProducing(self):
+        self.close()
+
+
 class Router(component.Router):
     """Kontalk router."""
 
+    """
+    @ivar logTraffic: if true, log all routed stanzas
+    @type logTraffic: C{bool}
+    @ivar passthrough: if true, routable stanzas will be forwarded as raw data
+    without being parsed (see L{RouterXmlStream})
+    @type passthrough: C{bool}
+    @ivar queue_high_water: queued stanzas for a stream after which producers
+    are paused (see L{RouteQueue})
+    @type queue_high_water: C{int}
+    @ivar queue_low_water: queued stanzas for a stream under which paused
+    producers are resumed
+    @type queue_low_water: C{int}
+    @ivar advertise_delay: minimum seconds between route announcements,
+    changes in the meantime are coalesced into a single stanza for each
+    component
+    @type advertise_delay: C{float}
+    @ivar max_stanza_size: maximum size of a stanza scanned in pass-through
+    mode, streams sending larger stanzas are disconnected
+    @type max_stanza_size: C{int}
+    """
+
+    logTraffic = False
+    passthrough = False
+    queue_high_water = 1000
+    queue_low_water = 100
+    advertise_delay = 0.1
+    max_stanza_size = 262144
+
     def __init__(self):
         component.Router.__init__(self)
         self.logs = set()
         # private names: binding with those names will not be advertised
         self.private = {}
+        # outbound queues: {stream: RouteQueue}
+        self.queues = {}
+        # streams paused for backpressure: {stream: number of full queues}
+        self.paused = {}
+        # route announcements to be sent:
+        # {stream: OrderedDict((name, target): available)}
+        self.announcements = {}
+        self._announce_call = None
+        # time the last announcements were sent
+        self._announce_time = 0
         """
         # TEST TEST TEST
         from twisted.internet.task import LoopingCall
@@ -50,27 +266,146 @@ class Router(component.Router):
         LoopingCall(_print_routes).start(5)
         """
 
-    def advertise(self, host, xs=None):
-        stanza = Presence()
-        stanza['from'] = host
+    def deliver(self, xs, obj, source=None, urgent=False):
+        """
+        Send data to a stream through its outbound queue.
+        @param source: the stream which produced the data, it will be paused
+        if the destination queue is full
+        @param urgent: true to skip the queued stanzas
+        """
+        queue = self.queues.get(xs)
+        if queue is None:
+            xs.send(obj)
+        else:
+            queue.send(obj, source, urgent)
+
+    def pauseProducer(self, xs):
+        count = self.paused.get(xs, 0)
+        self.paused[xs] = count + 1
+        if count == 0:
+            xs.transport.pauseProducing()
 
+    def resumeProducer(self, xs):
+        try:
+            count = self.paused[xs] - 1
+        except KeyError:
+            return
+
+        if count > 0:
+            self.paused[xs] = count
+        else:
+            del self.paused[xs]
+            xs.transport.resumeProducing()
+
+    def is_urgent(self, name, sender):
+        """Control traffic: bindings and component presence."""
+        return name in ('bind', 'unbind') or \
+            (name == 'presence' and (not sender or '@' not in sender))
+
+    def advertise(self, host, xs=None):
         log.info("advertising component %s" % (host, ))
-        self.broadcast(stanza, xs=xs)
+        self._announce_all(host, True, xs)
 
     def unadvertise(self, host, xs=None):
-        stanza = UnavailablePresence()
-        stanza['from'] = host
         log.info("unadvertising component %s" % (host,))
-        self.broadcast(stanza, xs=xs)
+        self._announce_all(host, False, xs)
 
     def send_routes(self, host, xs):
-        stanza = Presence()
-        stanza['to'] = host
-        for h, stream in self.routes.iteritems():
+        for h, route in self.routes.iteritems():
             # ignore default route and do not send back to requesting stream
-            if h is not None and stream != xs:
-                stanza['from'] = h
-                xs.send(stanza)
+            if h is not None and route != xs:
+                self.announce(xs, h, host, True)
+
+    def _announce_all(self, host, available, xs=None):
+        """Announce a route change to every component but the sender."""
+        sender_xs = self.routes.get(host, xs)
+
+        for h, stream in self.routes.iteritems():
+            if h is not None and h != host and stream != sender_xs:
+                self.announce(stream, host, h, available)
+
+    def announce(self, xs, name, target, available):
+        """
+        Schedule a route announcement for a component. Announcements are
+        coalesced and sent together, only the last state of each route is
+        sent. Announcements are sent right away if none were sent in the last
+        L{advertise_delay} seconds, otherwise when the delay expires.
+        @param name: the route being announced
+        @param target: the name bound by the component the announcement is for
+        """
+        try:
+            pending = self.announcements[xs]
+        except KeyError:
+            pending = self.announcements[xs] = OrderedDict()
+
+        # keep only the last state, in the order of the last change
+        key = (name, target)
+        pending.pop(key, None)
+        pending[key] = available
+
+        if not self._announce_call:
+            delay = max(0, self._announce_time + self.advertise_delay - reactor.seconds())
+            self._announce_call = reactor.callLater(delay, self.flush_announcements)
+
+    def flush_announcements(self):
+        """
+        Send all pending route announcements, one stanza for each component:
+
+        <routes>
+          <route name='resolver.prime.kontalk.net' to='c2s.prime.kontalk.net'/>
+          <route name='beta.kontalk.net' to='c2s.prime.kontalk.net' type='unavailable'/>
+        </routes>
+        """
+        if self._announce_call and self._announce_call.active():
+            self._announce_call.cancel()
+        self._announce_call = None
+        self._announce_time = reactor.seconds()
+
+        announcements = self.announcements
+        self.announcements = {}
+        for xs, pending in announcements.iteritems():
+            stanza = domish.Element((None, 'routes'))
+            for (name, target), available in pending.iteritems():
+                route = stanza.addElement((None, 'route'))
+                route['name'] = name
+                route['to'] = target
+                if not available:
+                    route['type'] = 'unavailable'
+
+            self.deliver(xs, stanza, urgent=True)
+
+    def _bind_route(self, table, name, xs):
+        """
+        Bind a name to a stream in the given routing table, replacing any
+        stream bound to the name.
+        @return: true if the name was not bound before
+        """
+        try:
+            route = table[name]
+        except KeyError:
+            table[name] = xs
+            return True
+
+        if route != xs:
+            log.debug("replacing route for %s" % (name, ))
+            table[name] = xs
+        return False
+
+    def _unbind_route(self, table, name, xs):
+        """
+        Remove a stream from a name in the given routing table.
+        @return: true if the name is not bound anymore
+        """
+        try:
+            route = table[name]
+        except KeyError:
+            return True
+
+        if route == xs:
+            del table[name]
+            return True
+
+        return False
 
     def addRoute(self, destination, xs):
         """
@@ -87,38 +422,50 @@ class Router(component.Router):
         @type xs: L{EventDispatcher<utility.EventDispatcher>}.
         """
 
-        # advertise presence
-        self.advertise(destination, xs)
+        # advertise presence (only if we are not replacing a stale stream)
+        if destination not in self.routes:
+            self.advertise(destination, xs)
 
         # advertise this component about the others
         self.send_routes(destination, xs)
 
         # add route and observers
-        self.routes[destination] = xs
+        self._bind_route(self.routes, destination, xs)
+        if xs not in self.queues:
+            self.queues[xs] = RouteQueue(self, xs)
         xs.addObserver('/bind', self.bind, 100, xs = xs)
         xs.addObserver('/unbind', self.unbind, 100, xs = xs)
+        xs.addObserver('/multicast', self.multicast, 100, xs = xs)
         xs.addObserver('/*', self.route, xs = xs)
 
     def removeRoute(self, destination, xs):
         # remove route immediately
         # we assume component is disconnecting so we don't remove observers
-        component.Router.removeRoute(self, destination, xs)
+        xs.removeObserver('/*', self.route)
 
         # remove other bound names
         for host in list(self.routes.keys()):
-            if self.routes[host] == xs:
-                del self.routes[host]
+            self._unbind_route(self.routes, host, xs)
 
         # remove any private name
-        for name, stream in self.private.items():
-            if stream == xs:
-                del self.private[name]
+        for name in list(self.private.keys()):
+            self._unbind_route(self.private, name, xs)
 
         # remove log route if any
         self.logs.discard(xs)
 
-        # unadvertise component
-        self.unadvertise(destination, xs)
+        # drop outbound queue and forget about backpressure
+        queue = self.queues.pop(xs, None)
+        if queue:
+            queue.close()
+        for queue in self.queues.itervalues():
+            queue.producers.discard(xs)
+        self.paused.pop(xs, None)
+        self.announcements.pop(xs, None)
+
+        # unadvertise component if no other stream is serving it
+        if destination not in self.routes:
+            self.unadvertise(destination, xs)
 
     def route(self, stanza, xs):
         """
@@ -142,14 +489,16 @@ class Router(component.Router):
         # reset namespace
         util.resetNamespace(stanza, component.NS_COMPONENT_ACCEPT)
 
+        urgent = self.is_urgent(stanza.name, stanza.getAttribute('from'))
+
         # send stanza to logging entities
         for lg in self.logs:
-            lg.send(stanza)
+            self.deliver(lg, stanza, xs, urgent)
 
         if not stanza.hasAttribute('to'):
             if self.logTraffic:
                 log.debug("broadcasting stanza %s" % (stanza.toXml().encode('utf-8'), ))
-            self.broadcast(stanza)
+            self.broadcast(stanza, source=xs, urgent=urgent)
         else:
             """
             FIXME we have encoding problems here... (why not in other components?!?!?)
@@ -171,21 +520,145 @@ class Router(component.Router):
             if self.logTraffic:
                 log.debug("routing stanza %s" % (stanza.toXml().encode('utf-8'), ))
             try:
-                destination_host = util.jid_host(stanza['to'])
-
-                if destination_host in self.routes:
-                    self.routes[destination_host].send(stanza)
-                elif destination_host in self.private:
-                    self.private[destination_host].send(stanza)
-                else:
-                    self.routes[None].send(stanza)
+                destination = self.lookup(util.jid_host(stanza['to']))
 
             except KeyError:
                 log.warn("unroutable stanza, bouncing back to component")
                 e = error.StanzaError('service-unavailable')
-                xs.send(e.toResponse(stanza))
+                self.deliver(xs, e.toResponse(stanza))
 
-    def broadcast(self, stanza, same=False, xs=None):
+            else:
+                self.deliver(destination, stanza, xs, urgent)
+
+    def route_raw(self, data, name, attrs, xs):
+        """
+        Route a stanza without parsing it.
+
+        Only the outer element attributes are used for routing and the original
+        data is forwarded as-is to the destination stream.
+
+        @param data: the raw stanza, UTF-8 encoded
+        @type data: C{str}
+        @param name: the stanza element name
+        @param attrs: the stanza element attributes
+        @type attrs: C{dict}
+        @return: true if the stanza was routed, false if it must go through the
+        full parse path
+        """
+
+        # binding requests, broadcasts and error stanzas (error loop detection)
+        if name in ('bind', 'unbind') or ':' in name or 'to' not in attrs or \
+                attrs.get('type') == 'error':
+            return False
+
+        # foreign namespaces needs to be reset
+        ns = attrs.get('xmlns')
+        if ns is not None and ns != component.NS_COMPONENT_ACCEPT:
+            return False
+
+        try:
+            destination = self.lookup(util.jid_host(attrs['to']))
+        except KeyError:
+            # unroutable stanza: full path will bounce it back
+            return False
+
+        urgent = self.is_urgent(name, attrs.get('from'))
+
+        # send stanza to logging entities
+        for lg in self.logs:
+            self.deliver(lg, data, xs, urgent)
+
+        if self.logTraffic:
+            log.debug("routing raw stanza %s" % (data, ))
+
+        self.deliver(destination, data, xs, urgent)
+        return True
+
+    def multicast(self, stanza, xs):
+        """
+        Expand a multicast envelope, routing the payload stanza to every
+        address listed in it. The payload is serialized only once: the
+        destination (and the optional id) is inserted into the raw data of
+        each copy.
+
+        <multicast>
+          <address jid='user@prime.kontalk.net' id='optional-id'/>
+          <address jid='user@beta.kontalk.net' id='optional-id'/>
+          <presence type='probe' from='kontalk.net'/>
+        </multicast>
+        """
+        stanza.consumed = True
+
+        addresses = []
+        payload = None
+        for child in stanza.elements():
+            if child.name == 'address':
+                addresses.append((child.getAttribute('jid'), child.getAttribute('id')))
+            elif payload is None:
+                payload = child
+
+        if payload is None or not addresses:
+            log.debug("empty multicast stanza, dropping")
+            return
+
+        # reset namespace and remove the attributes we are going to insert
+        util.resetNamespace(payload, component.NS_COMPONENT_ACCEPT)
+        payload.parent = None
+        for attr in ('to', 'id'):
+            if payload.hasAttribute(attr):
+                del payload[attr]
+
+        data = payload.toXml().encode('utf-8')
+        split = len(payload.name) + 1
+        head, tail = data[:split], data[split:]
+
+        if self.logTraffic:
+            log.debug("multicasting stanza %s to %d addresses" % (data, len(addresses)))
+
+        for address, stanzaId in addresses:
+            if not address:
+                continue
+
+            attrs = " to='%s'" % (domish.escapeToXml(address, True).encode('utf-8'), )
+            if stanzaId:
+                attrs += " id='%s'" % (domish.escapeToXml(stanzaId, True).encode('utf-8'), )
+            copy = head + attrs + tail
+
+            for lg in self.logs:
+                self.deliver(lg, copy, xs)
+
+            try:
+                destination = self.lookup(util.jid_host(address))
+
+            except KeyError:
+                log.warn("unroutable multicast address %s, bouncing back to component" % (address, ))
+                payload['to'] = address
+                if stanzaId:
+                    payload['id'] = stanzaId
+                e = error.StanzaError('service-unavailable')
+                self.deliver(xs, e.toResponse(payload))
+                for attr in ('to', 'id'):
+                    if payload.hasAttribute(attr):
+                        del payload[attr]
+
+            else:
+                self.deliver(destination, copy, xs)
+
+    def lookup(self, host):
+        """
+        Return the stream bound to the given host: component routes first,
+        private names next and default route last.
+        @raise KeyError: if no route could be found
+        """
+        try:
+            return self.routes[host]
+        except KeyError:
+            try:
+                return self.private[host]
+            except KeyError:
+                return self.routes[None]
+
+    def broadcast(self, stanza, same=False, xs=None, source=None, urgent=False):
         """
         Broadcast a stanza to every component.
         This alters the to attribute in outgoing stanza for each component.
@@ -202,7 +675,7 @@ class Router(component.Router):
             if host is not None and ((host != from_host and sender_xs != xs) or same):
                 log.debug("sending to %s" % (host, ))
                 stanza['to'] = host
-                xs.send(stanza)
+                self.deliver(xs, stanza, source, urgent)
 
     def bind(self, stanza, xs):
         log.debug("binding name %s" % (stanza['name'], ))
@@ -214,7 +687,7 @@ class Router(component.Router):
             try:
                 route = stanza['name']
             except:
-                xs.send(domish.Element((None, 'bind'), attribs={'error': 'bad-request'}))
+                self.deliver(xs, domish.Element((None, 'bind'), attribs={'error': 'bad-request'}), urgent=True)
                 #xs.transport.loseConnection()
 
         response = domish.Element((None, 'bind'))
@@ -224,12 +697,10 @@ class Router(component.Router):
 
         if route not in self.routes and route not in self.private:
 
-            if stanza.private:
-                self.private[route] = xs
-            else:
-                self.routes[route] = xs
+            table = self.private if stanza.private else self.routes
+            self._bind_route(table, route, xs)
 
-            xs.send(response)
+            self.deliver(xs, response, urgent=True)
 
             if stanza.log:
                 self.logs.add(xs)
@@ -243,7 +714,7 @@ class Router(component.Router):
 
         else:
             response['error'] = 'conflict'
-            xs.send(response)
+            self.deliver(xs, response, urgent=True)
             #xs.transport.loseConnection()
 
     def unbind(self, stanza, xs):
@@ -256,26 +727,126 @@ class Router(component.Router):
 
         # remove any normal route
         if route in self.routes:
-            del self.routes[route]
+            self._unbind_route(self.routes, route, xs)
 
         if route in self.private:
-            del self.private[route]
+            self._unbind_route(self.private, route, xs)
 
         else:
             # remove any private name
-            for name, stream in self.private.items():
-                if stream == xs:
-                    del self.private[name]
+            for name in list(self.private.keys()):
+                self._unbind_route(self.private, name, xs)
 
             # unadvertise binding
             self.unadvertise(route, xs)
 
 
+class RouterXmlStream(xmlstream.XmlStream):
+    """
+    Router-side component stream supporting header-only pass-through routing.
+
+    After authentication, if the router has L{Router.passthrough} enabled,
+    incoming data is scanned for top-level elements without parsing them.
+    Stanzas that can be routed by looking at the outer element only are
+    forwarded as raw data by L{Router.route_raw}; anything else is fed to the
+    XML parser as usual, one complete element at a time.
+    If something unusual comes in (comments, CDATA sections, stream end, etc.)
+    the stream goes back to full parsing for the rest of the connection.
+    """
+
+    # scanning mode: waiting for the next element boundary
+    _rawPending = False
+    # scanning mode: enabled
+    _rawMode = False
+    _rawBuffer = ''
+    # scan state of the incomplete element at the start of _rawBuffer
+    _rawState = None
+
+    def connectionMade(self):
+        xmlstream.XmlStream.connectionMade(self)
+        self.addOnetimeObserver(xmlstream.STREAM_AUTHD_EVENT, self._onAuthd)
+
+    def _onAuthd(self, xs):
+        self._rawPending = self.factory.router.passthrough
+
+    def dataReceived(self, data):
+        if self._rawMode:
+            self._rawDataReceived(data)
+        else:
+            xmlstream.XmlStream.dataReceived(self, data)
+
+            # switch to scanning mode only between top-level elements
+            if self._rawPending and self.stream is not None and \
+                    self.stream.currElem is None:
+                self._rawPending = False
+                self._rawMode = True
+
+    def _rawDataReceived(self, data):
+        buf = self._rawBuffer + data
+        router = self.factory.router
+        pos = 0
+        if self._rawState is None:
+            self._rawState = []
+
+        while True:
+            pos = _WHITESPACE_RE.match(buf, pos).end()
+            if pos >= len(buf):
+                break
+
+            try:
+                if buf[pos] != '<':
+                    raise ValueError('unexpected text')
+                element = scan_element(buf, pos, self._rawState)
+            except ValueError:
+                # go back to full parsing for good
+                self._rawMode = False
+                self._rawBuffer = ''
+                self._rawState = None
+                xmlstream.XmlStream.dataReceived(self, buf[pos:])
+                return
+
+            if element is None:
+                if len(buf) - pos > router.max_stanza_size:
+                    log.warn("stanza too big, disconnecting")
+                    self._rawMode = False
+                    self._rawBuffer = ''
+                    self._rawState = None
+                    self.sendStreamError(error.StreamError('policy-violation'))
+                    return
+
+                # wait for more data
+                break
+
+            if self._rawState:
+                self._rawState = []
+
+            end, name, attrs = element
+            stanza = buf[pos:end]
+            if router.route_raw(stanza, name, attrs, self):
+                if self.rawDataInFn:
+                    self.rawDataInFn(stanza)
+            else:
+                xmlstream.XmlStream.dataReceived(self, stanza)
+
+            pos = end
+
+            # stream might have been closed meanwhile
+            if self.stream is None:
+                return
+
+        if self._rawState:
+            # scan state is relative to the buffer start
+            self._rawState[2] -= pos
+        self._rawBuffer = buf[pos:]
+
+
 class XMPPRouterFactory(XMPPComponentServerFactory):
     """
     XMPP Component Server factory implementing a routing protocol.
     """
 
+    protocol = RouterXmlStream
+
     def __init__(self, router, secret='secret'):
         XMPPComponentServerFactory.__init__(self, router, secret)
 
@@ -210,7 +210,7 @@ class S2SComponent(xmlstream2.SocketComponent):
     """ Connection with router """
 
     def _authd(self, xs):
-        component.Component._authd(self, xs)
+        xmlstream2.SocketComponent._authd(self, xs)
         log.debug("connected to router.")
 
         # bind to the default route
@@ -21,35 +21,61 @@
 
 import base64
 
-from twisted.internet import reactor
+from twisted.internet import defer
 from twisted.words.protocols.jabber import error, jid, component, xmlstream
-from twisted.words.protocols.jabber.xmlstream import XMPPHandler
-from twisted.words.xish import domish
+from twisted.words.xish import domish, xpath
 
 from wokkel import xmppim
 
 from gnutls.constants import OPENPGP_FMT_RAW, OPENPGP_FMT_BASE64
 
-from kontalk.xmppserver import log, xmlstream2, version, util, push, upload, keyring
+from kontalk.xmppserver import log, xmlstream2, version, util, push, upload, keyring, timer
 
 
-class PresenceHandler(XMPPHandler):
+class SessionState(object):
     """
-    Handle presence stanzas and client disconnection.
-    @type parent: L{C2SManager}
+    Per-session state of a client connection.
+    @ivar presence: last available presence received from the client
+    @ivar initial: true if the initial presence has been received
+    @ivar compatibility_mode: true if the client requested the roster (XMPP
+    compatibility mode)
+    @ivar keepalive: keepalive timer (next ping request or ping timeout)
+    @type keepalive: L{timer.Timer}
     """
 
-    def connectionInitialized(self):
-        # initial presence is... well, initial :)
-        self.xmlstream.addOnetimeObserver("/presence[not(@type)]", self.initialPresence)
-        self.xmlstream.addObserver("/presence[not(@type)]", self.presence)
-        self.xmlstream.addObserver("/presence[@type='unavailable']", self.unavailablePresence)
+    __slots__ = ('presence', 'initial', 'compatibility_mode', 'keepalive')
 
-    def connectionLost(self, reason):
-        if self.xmlstream and self.xmlstream.otherEntity is not None:
-            stanza = xmppim.UnavailablePresence()
-            stanza['from'] = self.xmlstream.otherEntity.full()
-            self.parent.forward(stanza, True)
+    def __init__(self):
+        self.presence = None
+        self.initial = False
+        self.compatibility_mode = False
+        self.keepalive = None
+
+
+class SessionHandler(object):
+    """
+    Base class for stanza handlers shared by all client sessions.
+    Handlers are created once by L{HandlerTable}, which calls L{setup} to let
+    them register their observers. Observers are called with the stanza and
+    the L{C2SManager} of the session the stanza was received from.
+    @ivar parent: the handler table
+    @type parent: L{HandlerTable}
+    """
+
+    def __init__(self, parent):
+        self.parent = parent
+
+    def setup(self):
+        """Register observers in the handler table."""
+        pass
+
+    def connectionInitialized(self, manager):
+        """Called when a client session has been authenticated."""
+        pass
+
+    def connectionLost(self, manager, reason):
+        """Called when a client session has been disconnected."""
+        pass
 
     def features(self):
         pass
@@ -57,29 +83,48 @@ class PresenceHandler(XMPPHandler):
     def items(self):
         pass
 
-    def unavailablePresence(self, stanza):
+
+class PresenceHandler(SessionHandler):
+    """Handle presence stanzas and client disconnection."""
+
+    def setup(self):
+        self.parent.addObserver("/presence[not(@type)]", self.presence)
+        self.parent.addObserver("/presence[@type='unavailable']", self.unavailablePresence)
+
+    def connectionLost(self, manager, reason):
+        if manager.xmlstream and manager.xmlstream.otherEntity is not None:
+            stanza = xmppim.UnavailablePresence()
+            stanza['from'] = manager.xmlstream.otherEntity.full()
+            manager.forward(stanza, True)
+
+    def unavailablePresence(self, stanza, manager):
         # notify c2s about unavailable presence
         if not stanza.hasAttribute('to'):
-            self.parent.router.local_presence(self.xmlstream.otherEntity, stanza)
+            self.parent.router.local_presence(manager.xmlstream.otherEntity, stanza)
             # TODO disconnection should be triggered immediately
 
-    def presence(self, stanza):
+    def presence(self, stanza, manager):
         # store presence stanza in the stream manager
-        self.parent._presence = stanza
+        manager.session.presence = stanza
+
+        # initial presence is... well, initial :)
+        if not manager.session.initial:
+            manager.session.initial = True
+            self.initialPresence(stanza, manager)
 
-    def initialPresence(self, stanza):
+    def initialPresence(self, stanza, manager):
         """
         This initial presence is from the client connection. We just notify c2s
         which will do the rest.
         """
         if not stanza.hasAttribute('to'):
-            self.parent.router.local_presence(self.xmlstream.otherEntity, stanza)
+            self.parent.router.local_presence(manager.xmlstream.otherEntity, stanza)
 
             # this will do the necessary checks with public key
-            self.parent.public_key_presence(self.xmlstream)
+            manager.public_key_presence(manager.xmlstream)
 
 
-class PingHandler(XMPPHandler):
+class PingHandler(SessionHandler):
     """
     XEP-0199: XMPP Ping
     http://xmpp.org/extensions/xep-0199.html
@@ -88,80 +133,87 @@ class PingHandler(XMPPHandler):
     PING_DELAY = 240
     PING_TIMEOUT = 240
 
-    def __init__(self):
-        XMPPHandler.__init__(self)
-        self.ping_timeout = None
-        self.pinger = None
+    def __init__(self, parent):
+        SessionHandler.__init__(self, parent)
+        # keepalive timers of all sessions
+        self.wheel = timer.TimerWheel()
 
-    def connectionInitialized(self):
+    def setup(self):
         """
         This is a special case: ping to network is handled by us because it's
         a local issue, no need to forward to resolver.
         """
-        self.xmlstream.addObserver("/iq[@type='get']/ping[@xmlns='%s']" % (xmlstream2.NS_XMPP_PING, ), self.ping, 600)
+        self.parent.addObserver("/iq[@type='get']/ping[@xmlns='%s']" % (xmlstream2.NS_XMPP_PING, ), self.ping, 600)
+
+    def connectionInitialized(self, manager):
         # first ping request
-        self.pinger = reactor.callLater(self.PING_DELAY, self._ping)
-
-    def connectionLost(self, reason):
-        XMPPHandler.connectionLost(self, reason)
-        # stop pinger
-        if self.pinger:
-            self.pinger.cancel()
-        # stop ping timeout
-        if self.ping_timeout:
-            self.ping_timeout.cancel()
-
-    def _ping(self):
-        """Sends a ping request to client."""
+        manager.session.keepalive = self.wheel.schedule(self.PING_DELAY, self._ping, manager)
+
+    def connectionLost(self, manager, reason):
+        # stop pinger or ping timeout
+        if manager.session.keepalive:
+            manager.session.keepalive.cancel()
+            manager.session.keepalive = None
+
+    def _idle(self, manager):
+        """Returns how many seconds ago data was received from the client."""
+        return self.wheel.clock.seconds() - manager.xmlstream.lastReceived
+
+    def _ping(self, manager):
+        """Sends a ping request to client unless it has been active recently."""
+        idle = self._idle(manager)
+        if idle < self.PING_DELAY:
+            manager.session.keepalive = self.wheel.schedule(self.PING_DELAY - idle, self._ping, manager)
+            return
+
         ping = domish.Element((None, 'iq'))
         ping['from'] = self.parent.network
         ping['type'] = 'get'
         ping['id'] = util.rand_str(8, util.CHARSBOX_AZN_LOWERCASE)
         ping.addElement((xmlstream2.NS_XMPP_PING, 'ping'))
-        self.send(ping)
+        manager.send(ping)
         # setup ping timeout
-        self.pinger = None
-        self.ping_timeout = reactor.callLater(self.PING_TIMEOUT, self._timeout)
+        manager.session.keepalive = self.wheel.schedule(self.PING_TIMEOUT, self._timeout,
+            manager, ping['id'], self.wheel.clock.seconds())
         # observe pong
-        self.xmlstream.addObserver("/iq[@type='result'][@id='%s']" % (ping['id'], ), self.pong, 600)
+        manager.correlator.expect(ping['id'], self.pong, 600, name='iq', stype='result')
+
+    def _timeout(self, manager, pingId, sent):
+        # client sent something after our ping: it's alive
+        if manager.xmlstream.lastReceived >= sent:
+            idle = self._idle(manager)
+            manager.correlator.cancel(pingId)
+            manager.session.keepalive = self.wheel.schedule(self.PING_DELAY - idle, self._ping, manager)
+            return
 
-    def _timeout(self):
-        self.ping_timeout = None
+        manager.session.keepalive = None
         # send stream error
-        self.xmlstream.sendStreamError(error.StreamError('connection-timeout'))
+        manager.xmlstream.sendStreamError(error.StreamError('connection-timeout'))
         # refuse to process any more stanzas
-        self.xmlstream.setDispatchFn(None)
+        manager.xmlstream.setDispatchFn(None)
         # broadcast unavailable presence
-        if self.xmlstream.otherEntity is not None:
+        if manager.xmlstream.otherEntity is not None:
             stanza = xmppim.UnavailablePresence()
-            stanza['from'] = self.xmlstream.otherEntity.full()
-            self.parent.forward(stanza, True)
+            stanza['from'] = manager.xmlstream.otherEntity.full()
+            manager.forward(stanza, True)
 
-    def ping(self, stanza):
+    def ping(self, stanza, manager):
         if not stanza.hasAttribute('to') or stanza['to'] == self.parent.network:
             # reply with same stanza
-            self.parent.bounce(stanza)
+            manager.bounce(stanza)
         else:
-            self.parent.forward(stanza)
+            manager.forward(stanza)
 
     def pong(self, stanza):
-        """Client replied to ping: abort timeout."""
-        if self.ping_timeout:
-            self.ping_timeout.cancel()
-            self.ping_timeout = None
-        # unobserve pong
-        self.xmlstream.removeObserver("/iq[@type='result'][@id='%s']" % (stanza['id'], ), self.pong)
-        # consume stanza
+        """
+        Client replied to ping: just consume the stanza, the ping timeout will
+        notice the client activity and restart the pinger.
+        """
         stanza.consumed = True
-        # restart pinger
-        self.pinger = reactor.callLater(self.PING_DELAY, self._ping)
 
     def features(self):
         return (xmlstream2.NS_XMPP_PING, )
 
-    def items(self):
-        pass
-
 
 class ServerListCommand():
     def __init__(self, handler):
@@ -174,32 +226,32 @@ class ServerListCommand():
             'name': 'Retrieve server list',
         }, )
 
-    def execute(self, stanza):
+    def execute(self, stanza, manager):
         # TODO actually implement the command :)
         stanza.consumed = True
         res = xmlstream.toResponse(stanza, 'result')
         cmd = res.addElement((xmlstream2.NS_PROTO_COMMANDS, 'command'))
         cmd['node'] = stanza.command['node']
         cmd['status'] = 'completed'
-        self.handler.send(res)
+        manager.send(res)
 
 
-class PushNotificationsHandler(XMPPHandler):
+class PushNotificationsHandler(SessionHandler):
     """Support for push notifications."""
 
     pushHandlers = (
         push.GCMPushNotifications,
     )
 
-    def __init__(self):
-        XMPPHandler.__init__(self)
+    def __init__(self, parent):
+        SessionHandler.__init__(self, parent)
         # push handler for items quick access
         self.handler_items = []
         # push handlers
         self.push_handlers = {}
 
-    def connectionInitialized(self):
-        self.xmlstream.addObserver("/presence/c[@xmlns='%s']" % (xmlstream2.NS_PRESENCE_PUSH), self.push_regid, 100)
+    def setup(self):
+        self.parent.addObserver("/presence/c[@xmlns='%s']" % (xmlstream2.NS_PRESENCE_PUSH), self.push_regid, 100)
 
         for h in self.pushHandlers:
             inst = h(self)
@@ -208,14 +260,14 @@ class PushNotificationsHandler(XMPPHandler):
             for c in nodes:
                 self.push_handlers[c['node']] = inst
 
-    def push_regid(self, stanza):
+    def push_regid(self, stanza, manager):
         for child in stanza.children:
             if child.name == 'c' and child.uri == xmlstream2.NS_PRESENCE_PUSH:
                 regid = str(child)
                 provider = child.getAttribute('provider')
                 if regid and provider:
-                    log.debug("registering %s using %s with %s" % (self.xmlstream.otherEntity, provider, regid))
-                    self.parent.router.push_manager.register(self.xmlstream.otherEntity, provider, regid)
+                    log.debug("registering %s using %s with %s" % (manager.xmlstream.otherEntity, provider, regid))
+                    self.parent.router.push_manager.register(manager.xmlstream.otherEntity, provider, regid)
 
     def features(self):
         return (xmlstream2.NS_PRESENCE_PUSH, )
@@ -224,7 +276,7 @@ class PushNotificationsHandler(XMPPHandler):
         return ({'node': xmlstream2.NS_PRESENCE_PUSH, 'items': self.handler_items }, )
 
 
-class CommandsHandler(XMPPHandler):
+class CommandsHandler(SessionHandler):
     """
     XEP-0050: Ad-Hoc Commands
     http://xmpp.org/extensions/xep-0050.html
@@ -234,15 +286,15 @@ class CommandsHandler(XMPPHandler):
         ServerListCommand,
     )
 
-    def __init__(self):
-        XMPPHandler.__init__(self)
+    def __init__(self, parent):
+        SessionHandler.__init__(self, parent)
         # command list for quick access
         self.commands = []
         # command handlers for execution
         self.cmd_handlers = {}
 
-    def connectionInitialized(self):
-        self.xmlstream.addObserver("/iq[@type='set'][@to='%s']/command[@xmlns='%s']" % (self.parent.network, xmlstream2.NS_PROTO_COMMANDS), self.command, 100)
+    def setup(self):
+        self.parent.addObserver("/iq[@type='set'][@to='%s']/command[@xmlns='%s']" % (self.parent.network, xmlstream2.NS_PROTO_COMMANDS), self.command, 100)
 
         for h in self.commandHandlers:
             cmd = h(self)
@@ -251,7 +303,7 @@ class CommandsHandler(XMPPHandler):
             for c in cmdlist:
                 self.cmd_handlers[c['node']] = cmd
 
-    def command(self, stanza):
+    def command(self, stanza, manager):
         node = stanza.command.getAttribute('node')
         action = stanza.command.getAttribute('action')
         log.debug("command received: %s/%s" % (node, action))
@@ -259,11 +311,11 @@ class CommandsHandler(XMPPHandler):
             try:
                 func = getattr(self.cmd_handlers[node], action)
                 log.debug("found command handler %s" % (func, ))
-                func(stanza)
+                func(stanza, manager)
             except:
-                self.parent.error(stanza)
+                manager.error(stanza)
         else:
-            self.parent.error(stanza)
+            manager.error(stanza)
 
     def features(self):
         return (xmlstream2.NS_PROTO_COMMANDS, )
@@ -272,7 +324,7 @@ class CommandsHandler(XMPPHandler):
         return ({'node': xmlstream2.NS_PROTO_COMMANDS, 'items': self.commands }, )
 
 
-class UploadHandler(XMPPHandler):
+class UploadHandler(SessionHandler):
     """
     Upload media extension.
     """
@@ -281,12 +333,12 @@ class UploadHandler(XMPPHandler):
         upload.KontalkBoxUploadService,
     )
 
-    def __init__(self):
-        XMPPHandler.__init__(self)
+    def __init__(self, parent):
+        SessionHandler.__init__(self, parent)
         self.services = []
         self.serv_handlers = {}
 
-    def connectionInitialized(self):
+    def setup(self):
         for h in self.uploadHandlers:
             name = h.name
             try:
@@ -302,19 +354,19 @@ class UploadHandler(XMPPHandler):
 
         # add observer only if at least one service is enabled
         if len(self.services):
-            self.xmlstream.addObserver("/iq[@type='get'][@to='%s']/upload[@xmlns='%s']" % (self.parent.network, xmlstream2.NS_MESSAGE_UPLOAD), self.upload, 100)
+            self.parent.addObserver("/iq[@type='get'][@to='%s']/upload[@xmlns='%s']" % (self.parent.network, xmlstream2.NS_MESSAGE_UPLOAD), self.upload, 100)
 
-    def upload(self, stanza):
+    def upload(self, stanza, manager):
         node = stanza.upload.getAttribute('node')
         log.debug("upload request received: %s" % (node, ))
         if node and node in self.serv_handlers:
             try:
-                return self.serv_handlers[node].upload(stanza)
+                return self.serv_handlers[node].upload(stanza, manager)
             except:
                 import traceback
                 traceback.print_exc()
 
-        self.parent.error(stanza)
+        manager.error(stanza)
 
     def features(self):
         return (xmlstream2.NS_MESSAGE_UPLOAD, )
@@ -323,96 +375,96 @@ class UploadHandler(XMPPHandler):
         return ({'node': xmlstream2.NS_MESSAGE_UPLOAD, 'items': self.services }, )
 
 
-class PrivacyListHandler(XMPPHandler):
+class PrivacyListHandler(SessionHandler):
     """Handles IQ urn:xmpp:blocking stanzas."""
 
-    def connectionInitialized(self):
-        self.xmlstream.addObserver("/iq[@type='set']/allow[@xmlns='%s']" % (xmlstream2.NS_IQ_BLOCKING), self.forward, 100)
-        self.xmlstream.addObserver("/iq[@type='set']/unallow[@xmlns='%s']" % (xmlstream2.NS_IQ_BLOCKING), self.forward, 100)
-        self.xmlstream.addObserver("/iq[@type='set']/block[@xmlns='%s']" % (xmlstream2.NS_IQ_BLOCKING), self.forward, 100)
-        self.xmlstream.addObserver("/iq[@type='set']/unblock[@xmlns='%s']" % (xmlstream2.NS_IQ_BLOCKING), self.forward, 100)
+    def setup(self):
+        self.parent.addObserver("/iq[@type='set']/allow[@xmlns='%s']" % (xmlstream2.NS_IQ_BLOCKING), self.forward, 100)
+        self.parent.addObserver("/iq[@type='set']/unallow[@xmlns='%s']" % (xmlstream2.NS_IQ_BLOCKING), self.forward, 100)
+        self.parent.addObserver("/iq[@type='set']/block[@xmlns='%s']" % (xmlstream2.NS_IQ_BLOCKING), self.forward, 100)
+        self.parent.addObserver("/iq[@type='set']/unblock[@xmlns='%s']" % (xmlstream2.NS_IQ_BLOCKING), self.forward, 100)
 
-    def forward(self, stanza):
+    def forward(self, stanza, manager):
         # enforce destination (resolver)
         stanza['to'] = self.parent.network
 
         # forward to resolver
-        self.parent.forward(stanza)
+        manager.forward(stanza)
 
     def features(self):
         return (xmlstream2.NS_IQ_BLOCKING, )
 
-    def items(self):
-        pass
 
-
-class RosterHandler(XMPPHandler):
+class RosterHandler(SessionHandler):
     """Handles the roster and XMPP compatibility mode."""
 
-    def connectionInitialized(self):
-        self.xmlstream.addObserver("/iq[@type='get']/query[@xmlns='%s']" % (xmlstream2.NS_IQ_ROSTER), self.roster, 100)
+    def setup(self):
+        self.parent.addObserver("/iq[@type='get']/query[@xmlns='%s']" % (xmlstream2.NS_IQ_ROSTER), self.roster, 100)
 
-    def roster(self, stanza):
+    def roster(self, stanza, manager):
         # enforce destination (resolver)
         stanza['to'] = self.parent.network
 
         if not xmlstream2.has_element(stanza.query, uri=xmlstream2.NS_IQ_ROSTER, name='item'):
             # requesting initial roster - enter XMPP compatibility mode
-            self.parent.compatibility_mode = True
+            manager.session.compatibility_mode = True
 
         # forward to resolver
-        self.parent.forward(stanza)
+        manager.forward(stanza)
 
     def features(self):
         return (xmlstream2.NS_IQ_ROSTER, )
 
-    def items(self):
-        pass
-
 
-class IQHandler(XMPPHandler):
+class IQHandler(SessionHandler):
     """Handles various iq stanzas."""
 
-    def connectionInitialized(self):
-        self.xmlstream.addObserver("/iq/query[@xmlns='%s']" % (xmlstream2.NS_IQ_LAST), self.forward_check, 100,
-            fn=self.parent.forward, componentfn=self.last_activity)
-        self.xmlstream.addObserver("/iq/query[@xmlns='%s']" % (xmlstream2.NS_IQ_VERSION), self.forward_check, 100,
-            fn=self.parent.forward, componentfn=self.version)
-        self.xmlstream.addObserver("/iq[@type='set']/query[@xmlns='%s']" % (xmlstream2.NS_IQ_REGISTER), self.register, 100)
-        self.xmlstream.addObserver("/iq[@type='result']", self.parent.forward, 100)
-        self.xmlstream.addObserver("/iq[@type='set']/vcard[@xmlns='%s']" % (xmlstream2.NS_XMPP_VCARD4, ), self.vcard_set, 100)
-        self.xmlstream.addObserver("/iq[@type='get']/vcard[@xmlns='%s']" % (xmlstream2.NS_XMPP_VCARD4, ), self.vcard_get, 100)
+    def setup(self):
+        self.parent.addObserver("/iq/query[@xmlns='%s']" % (xmlstream2.NS_IQ_LAST), self.forward_check, 100,
+            componentfn=self.last_activity)
+        self.parent.addObserver("/iq/query[@xmlns='%s']" % (xmlstream2.NS_IQ_VERSION), self.forward_check, 100,
+            componentfn=self.version)
+        self.parent.addObserver("/iq[@type='set']/query[@xmlns='%s']" % (xmlstream2.NS_IQ_REGISTER), self.register, 100)
+        self.parent.addObserver("/iq[@type='result']", self.forward, 100)
+        self.parent.addObserver("/iq[@type='set']/vcard[@xmlns='%s']" % (xmlstream2.NS_XMPP_VCARD4, ), self.vcard_set, 100)
+        self.parent.addObserver("/iq[@type='get']/vcard[@xmlns='%s']" % (xmlstream2.NS_XMPP_VCARD4, ), self.vcard_get, 100)
 
         # fallback: service unavailable
-        self.xmlstream.addObserver("/iq", self.parent.error, 50)
+        self.parent.addObserver("/iq", self.error, 50)
+
+    def forward(self, stanza, manager):
+        manager.forward(stanza)
 
-    def forward_check(self, stanza, fn, componentfn):
+    def error(self, stanza, manager):
+        manager.error(stanza)
+
+    def forward_check(self, stanza, manager, componentfn):
         if not stanza.consumed:
             if stanza['to'] == util.component_jid(self.parent.servername, util.COMPONENT_C2S):
-                return componentfn(stanza)
+                return componentfn(stanza, manager)
             else:
-                return fn(stanza)
+                return manager.forward(stanza)
 
-    def last_activity(self, stanza):
+    def last_activity(self, stanza, manager):
         stanza.consumed = True
         seconds = self.parent.router.uptime()
         response = xmlstream.toResponse(stanza, 'result')
         response.addChild(domish.Element((xmlstream2.NS_IQ_LAST, 'query'), attribs={'seconds': str(int(seconds))}))
-        self.send(response)
+        manager.send(response)
 
-    def version(self, stanza):
+    def version(self, stanza, manager):
         stanza.consumed = True
         response = xmlstream.toResponse(stanza, 'result')
         query = domish.Element((xmlstream2.NS_IQ_VERSION, 'query'))
         query.addElement((None, 'name'), content=version.NAME + '-c2s')
         query.addElement((None, 'version'), content=version.VERSION)
         response.addChild(query)
-        self.send(response)
+        manager.send(response)
 
-    def register(self, stanza):
+    def register(self, stanza, manager):
         """This is actually used for key regeneration."""
         if not self.parent.router.registration:
-            return self.parent.error(stanza, text='Registration not available.')
+            return manager.error(stanza, text='Registration not available.')
 
         log.debug("client requested key regeneration: %s" % (stanza.toXml(), ))
         stanza.consumed = True
@@ -431,63 +483,68 @@ class IQHandler(XMPPHandler):
         if var_pkey:
 
             def _send_signed(userid, var_pkey):
-                # verify and link key
-                pkey = base64.b64decode(var_pkey.value.__str__().encode('utf-8'))
-                signed_pkey = self.parent.link_public_key(pkey, userid)
-                if signed_pkey:
-                    iq = xmlstream.toResponse(stanza, 'result')
-                    query = iq.addElement((xmlstream2.NS_IQ_REGISTER, 'query'))
+                def _signed(signed_pkey):
+                    if signed_pkey:
+                        iq = xmlstream.toResponse(stanza, 'result')
+                        query = iq.addElement((xmlstream2.NS_IQ_REGISTER, 'query'))
 
-                    form = query.addElement(('jabber:x:data', 'x'))
-                    form['type'] = 'form'
+                        form = query.addElement(('jabber:x:data', 'x'))
+                        form['type'] = 'form'
 
-                    hidden = form.addElement((None, 'field'))
-                    hidden['type'] = 'hidden'
-                    hidden['var'] = 'FORM_TYPE'
-                    hidden.addElement((None, 'value'), content='http://kontalk.org/protocol/register#key')
+                        hidden = form.addElement((None, 'field'))
+                        hidden['type'] = 'hidden'
+                        hidden['var'] = 'FORM_TYPE'
+                        hidden.addElement((None, 'value'), content='http://kontalk.org/protocol/register#key')
 
-                    signed = form.addElement((None, 'field'))
-                    signed['type'] = 'text-single'
-                    signed['label'] = 'Signed public key'
-                    signed['var'] = 'publickey'
-                    signed.addElement((None, 'value'), content=base64.b64encode(signed_pkey))
+                        signed = form.addElement((None, 'field'))
+                        signed['type'] = 'text-single'
+                        signed['label'] = 'Signed public key'
+                        signed['var'] = 'publickey'
+                        signed.addElement((None, 'value'), content=base64.b64encode(signed_pkey))
 
-                    self.parent.send(iq, True)
+                        manager.send(iq, True)
 
-                else:
-                    # key not signed or verified
-                    self.parent.error(stanza, 'forbidden', 'Invalid public key.')
+                    else:
+                        # key not signed or verified
+                        manager.error(stanza, 'forbidden', 'Invalid public key.')
+
+                # verify and link key
+                pkey = base64.b64decode(var_pkey.value.__str__().encode('utf-8'))
+                manager.link_public_key(pkey, userid).addCallback(_signed)
 
             def _continue(presence, userid, var_pkey, var_revoked, stanza):
                 if presence and presence['fingerprint']:
                     # user already has a key, check if fingerprint matches and
                     # check the revocation certificate
                     rkeydata = base64.b64decode(var_revoked.value.__str__().encode('utf-8'))
-                    # import key and verify revocation certificate
-                    rkey_fpr, rkey = self.parent.router.keyring.import_key(rkeydata)
 
-                    if rkey_fpr == presence['fingerprint']:
+                    def _imported(result):
+                        rkey_fpr, rkey = result or (None, None)
+                        if rkey_fpr == presence['fingerprint']:
+
+                            if rkey and rkey.revoked:
+                                log.debug("old key has been revoked, accepting new key")
+                                # old key has been revoked, ok to accept new one
+                                _send_signed(userid, var_pkey)
 
-                        if rkey and rkey.revoked:
-                            log.debug("old key has been revoked, accepting new key")
-                            # old key has been revoked, ok to accept new one
-                            _send_signed(userid, var_pkey)
+                            else:
+                                # key not valid or not revoked
+                                log.debug("old key is not revoked, refusing to proceed")
+                                manager.error(stanza, 'forbidden', 'Old key has not been revoked.')
 
                         else:
-                            # key not valid or not revoked
-                            log.debug("old key is not revoked, refusing to proceed")
-                            self.parent.error(stanza, 'forbidden', 'Old key has not been revoked.')
+                            # old key fingerprint not matching
+                            log.debug("old key does not match current fingerprint, refusing to proceed")
+                            manager.error(stanza, 'forbidden', 'Revoked key does not match.')
 
-                    else:
-                        # old key fingerprint not matching
-                        log.debug("old key does not match current fingerprint, refusing to proceed")
-                        self.parent.error(stanza, 'forbidden', 'Revoked key does not match.')
+                    # import key and verify revocation certificate
+                    self.parent.router.keyring.import_key(rkeydata).addCallback(_imported)
 
                 else:
                     # user has no key, accept it
                     _send_signed(userid, var_pkey)
 
-            userid = self.parent.xmlstream.otherEntity.user
+            userid = manager.xmlstream.otherEntity.user
 
             # check if user has already a key
             # this is used for users coming from version 2.x (no key back then)
@@ -496,16 +553,17 @@ class IQHandler(XMPPHandler):
 
         else:
             # bad request
-            self.parent.error(stanza, 'bad-request')
+            manager.error(stanza, 'bad-request')
 
-    def vcard_set(self, stanza):
+    def vcard_set(self, stanza, manager):
         # let c2s handle this
-        self.send(self.parent.router.local_vcard(self.xmlstream.otherEntity, stanza))
+        d = defer.maybeDeferred(self.parent.router.local_vcard, manager.xmlstream.otherEntity, stanza)
+        d.addCallback(manager.send)
 
-    def vcard_get(self, stanza):
+    def vcard_get(self, stanza, manager):
         if not stanza.hasAttribute('to'):
-            stanza['to'] = self.xmlstream.otherEntity.userhost()
-        self.parent.forward(stanza)
+            stanza['to'] = manager.xmlstream.otherEntity.userhost()
+        manager.forward(stanza)
 
     def features(self):
         ft = [
@@ -519,58 +577,50 @@ class IQHandler(XMPPHandler):
 
         return ft
 
-    def items(self):
-        pass
-
 
-class MessageHandler(XMPPHandler):
+class MessageHandler(SessionHandler):
     """Message stanzas handler."""
 
-    def connectionInitialized(self):
+    def setup(self):
         # messages for the server
-        #self.xmlstream.addObserver("/message[@to='%s']" % (self.parent.servername), self.parent.error, 100)
+        #self.parent.addObserver("/message[@to='%s']" % (self.parent.servername), self.error, 100)
         # ack is above stanza processing rules
-        self.xmlstream.addObserver("/message/ack[@xmlns='%s']" % (xmlstream2.NS_XMPP_SERVER_RECEIPTS), self.ack, 600)
+        self.parent.addObserver("/message/ack[@xmlns='%s']" % (xmlstream2.NS_XMPP_SERVER_RECEIPTS), self.ack, 600)
         # this is for replying with <ack/> immediately
-        self.xmlstream.addObserver("/message/received[@xmlns='%s']" % (xmlstream2.NS_XMPP_SERVER_RECEIPTS), self.received, 600)
+        self.parent.addObserver("/message/received[@xmlns='%s']" % (xmlstream2.NS_XMPP_SERVER_RECEIPTS), self.received, 600)
 
-    def received(self, stanza):
+    def received(self, stanza, manager):
         ack = xmlstream.toResponse(stanza, stanza['type'])
         ack.addElement((xmlstream2.NS_XMPP_SERVER_RECEIPTS, 'ack'))
-        self.send(ack)
+        manager.send(ack)
         # proceed with processing
 
-    def ack(self, stanza):
+    def ack(self, stanza, manager):
         stanza.consumed = True
         msgId = stanza.ack.getAttribute('id')
         if msgId:
             try:
                 to = jid.JID(stanza['to'])
-                sender = self.xmlstream.otherEntity
+                sender = manager.xmlstream.otherEntity
                 if to.host == self.parent.network and sender.host == self.parent.network:
                     self.parent.router.message_offline_delete(msgId, stanza.name, to.user, sender.user)
             except:
                 pass
 
-    def features(self):
-        pass
-
-    def items(self):
-        pass
 
-
-class DiscoveryHandler(XMPPHandler):
+class DiscoveryHandler(SessionHandler):
     """Handle iq stanzas for discovery."""
 
-    def __init__(self):
+    def __init__(self, parent):
+        SessionHandler.__init__(self, parent)
         self.post_handlers = []
         self.supportedFeatures = []
         # key is node attribute of <query/>
         self.items = {}
 
-    def connectionInitialized(self):
-        self.xmlstream.addObserver("/iq[@type='get'][@to='%s']/query[@xmlns='%s']" % (self.parent.network, xmlstream2.NS_DISCO_ITEMS), self.onDiscoItems, 100)
-        self.xmlstream.addObserver("/iq[@type='get'][@to='%s']/query[@xmlns='%s']" % (self.parent.network, xmlstream2.NS_DISCO_INFO), self.onDiscoInfo, 100)
+    def setup(self):
+        self.parent.addObserver("/iq[@type='get'][@to='%s']/query[@xmlns='%s']" % (self.parent.network, xmlstream2.NS_DISCO_ITEMS), self.onDiscoItems, 100)
+        self.parent.addObserver("/iq[@type='get'][@to='%s']/query[@xmlns='%s']" % (self.parent.network, xmlstream2.NS_DISCO_INFO), self.onDiscoInfo, 100)
         # add items now
         for h in self.post_handlers:
             items = h.items()
@@ -581,7 +631,7 @@ class DiscoveryHandler(XMPPHandler):
                         self.items[node] = []
                     self.items[node].extend(i['items'])
 
-    def onDiscoItems(self, stanza):
+    def onDiscoItems(self, stanza, manager):
         if not stanza.consumed:
             stanza.consumed = True
             response = xmlstream.toResponse(stanza, 'result')
@@ -596,9 +646,9 @@ class DiscoveryHandler(XMPPHandler):
                         n['node'] = item['node']
                         n['name'] = item['name']
 
-            self.send(response)
+            manager.send(response)
 
-    def onDiscoInfo(self, stanza):
+    def onDiscoInfo(self, stanza, manager):
         if not stanza.consumed:
             stanza.consumed = True
             response = xmlstream.toResponse(stanza, 'result')
@@ -607,7 +657,88 @@ class DiscoveryHandler(XMPPHandler):
 
             for feature in self.supportedFeatures:
                 query.addChild(domish.Element((None, 'feature'), attribs={'var': feature }))
-            self.send(response)
+            manager.send(response)
+
+
+class HandlerTable(object):
+    """
+    Stanza handlers and observers shared by all client sessions of a c2s
+    instance. Handlers are instantiated and their XPath queries compiled only
+    once; each session registers a single observer for every priority level
+    in use, which then runs the matching handlers.
+
+    @ivar router: the c2s component
+    @type router: L{C2SComponent}
+    @ivar handlers: handler instances (discovery handler is the last one)
+    @type handlers: C{list}
+    @ivar observers: compiled observers by priority:
+    {priority: [(query, callback, kwargs)]}
+    @type observers: C{dict}
+    """
+
+    def __init__(self, router, network, servername, init_handlers, disco_handler):
+        self.router = router
+        self.network = network
+        self.servername = servername
+        self.handlers = []
+        self.observers = {}
+
+        """
+        Register the discovery handler first so it can process features from
+        the other handlers.
+        """
+        disco = disco_handler(self)
+
+        for handler in init_handlers:
+            # skip push notifications handler if no push manager is registered
+            if handler == PushNotificationsHandler and not self.router.push_manager:
+                continue
+            # skip upload handler if disabled
+            if handler == UploadHandler and not self.router.upload_enabled():
+                continue
+
+            h = handler(self)
+            h.setup()
+            info = h.features()
+            if info:
+                disco.supportedFeatures.extend(info)
+            # we will use this later
+            disco.post_handlers.append(h)
+            self.handlers.append(h)
+
+        # disco is added at last element so setup will be called last
+        disco.setup()
+        self.handlers.append(disco)
+
+    def addObserver(self, event, observerfn, priority=0, **kwargs):
+        """Add a stanza observer shared by all sessions."""
+        query = xpath.internQuery(event)
+        try:
+            self.observers[priority].append((query, observerfn, kwargs))
+        except KeyError:
+            self.observers[priority] = [(query, observerfn, kwargs)]
+
+    def dispatch(self, stanza, manager, level):
+        """Run observers of the given priority level matching the stanza."""
+        for query, observerfn, kwargs in self.observers[level]:
+            if query.matches(stanza):
+                try:
+                    observerfn(stanza, manager, **kwargs)
+                except:
+                    import traceback
+                    traceback.print_exc()
+
+    def connectionInitialized(self, manager):
+        xs = manager.xmlstream
+        for priority in self.observers:
+            xs.addObserver('/*', self.dispatch, priority, manager=manager, level=priority)
+
+        for h in self.handlers:
+            h.connectionInitialized(manager)
+
+    def connectionLost(self, manager, reason):
+        for h in self.handlers:
+            h.connectionLost(manager, reason)
 
 
 class C2SManager(xmlstream2.StreamManager):
@@ -617,6 +748,10 @@ class C2SManager(xmlstream2.StreamManager):
 
     @param router: the connection with the router
     @type router: L{xmlstream.StreamManager}
+    @ivar table: handlers shared by all sessions
+    @type table: L{HandlerTable}
+    @ivar session: per-session handlers state
+    @type session: L{SessionState}
     """
 
     namespace = 'jabber:client'
@@ -634,39 +769,45 @@ class C2SManager(xmlstream2.StreamManager):
         MessageHandler,
     )
 
+    """Handler tables by (manager class, router, network, servername)."""
+    _tables = {}
+
     def __init__(self, xs, factory, router, network, servername):
         self.factory = factory
-        self.router = router
-        self.network = network
-        self.servername = servername
-        self._presence = None
-        self.compatibility_mode = False
+        self.table = self.handler_table(router, network, servername)
+        self.session = SessionState()
         xmlstream2.StreamManager.__init__(self, xs)
 
-        """
-        Register the discovery handler first so it can process features from
-        the other handlers.
-        """
-        disco = self.disco_handler()
-
-        for handler in self.init_handlers:
-            # skip push notifications handler if no push manager is registered
-            if handler == PushNotificationsHandler and not self.router.push_manager:
-                continue
-            # skip upload handler if disabled
-            if handler == UploadHandler and not self.router.upload_enabled():
-                continue
-
-            h = handler()
-            h.setHandlerParent(self)
-            info = h.features()
-            if info:
-                disco.supportedFeatures.extend(info)
-            # we will use this later
-            disco.post_handlers.append(h)
-
-        # disco is added at last element so onConnectionInitialized will be called last
-        disco.setHandlerParent(self)
+    @classmethod
+    def handler_table(cls, router, network, servername):
+        """Returns the handler table for the given c2s instance, creating it if needed."""
+        key = (cls, router, network, servername)
+        try:
+            return cls._tables[key]
+        except KeyError:
+            table = HandlerTable(router, network, servername, cls.init_handlers, cls.disco_handler)
+            cls._tables[key] = table
+            return table
+
+    @property
+    def router(self):
+        return self.table.router
+
+    @property
+    def network(self):
+        return self.table.network
+
+    @property
+    def servername(self):
+        return self.table.servername
+
+    @property
+    def _presence(self):
+        return self.session.presence
+
+    @property
+    def compatibility_mode(self):
+        return self.session.compatibility_mode
 
     def _connected(self, xs):
         xmlstream2.StreamManager._connected(self, xs)
@@ -697,6 +838,7 @@ class C2SManager(xmlstream2.StreamManager):
         xs.removeObserver("/presence", self._unauthorized)
         xs.removeObserver("/message", self._unauthorized)
         self.factory.connectionInitialized(xs)
+        self.table.connectionInitialized(self)
 
         # stanza server processing rules - before they are sent to handlers
         xs.addObserver('/iq', self.iq, 500)
@@ -759,6 +901,7 @@ class C2SManager(xmlstream2.StreamManager):
 
     def _disconnected(self, reason):
         self.factory.connectionLost(self.xmlstream, reason)
+        self.table.connectionLost(self, reason)
         xmlstream2.StreamManager._disconnected(self, reason)
 
     def error(self, stanza, condition='service-unavailable', errtype='cancel', text=None):
@@ -877,20 +1020,23 @@ class C2SManager(xmlstream2.StreamManager):
         """
         Link the provided public key to a userid.
         @param publickey: public key in DER format
-        @return: the signed public key, in DER binary format.
+        @return: a deferred firing with the signed public key, in DER binary
+        format.
         """
-        # import public key and sign it
-        fp, keydata = self.router.keyring.sign_public_key(publickey, userid)
+        def _signed(result):
+            fp, keydata = result or (None, None)
+            if fp and keydata:
+                # signed public key to presence table
+                self.router.presencedb.public_key(userid, fp)
 
-        if fp and keydata:
-            # signed public key to presence table
-            self.router.presencedb.public_key(userid, fp)
+                # broadcast public key
+                self.router.broadcast_public_key(userid, keydata)
 
-            # broadcast public key
-            self.router.broadcast_public_key(userid, keydata)
+                # return signed public key
+                return keydata
 
-            # return signed public key
-            return keydata
+        # import public key and sign it
+        return self.router.keyring.sign_public_key(publickey, userid).addCallback(_signed)
 
     def public_key_presence(self, xs):
         """
@@ -18,9 +18,15 @@
  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import time
 import base64
+import hashlib
+import threading
+from collections import OrderedDict
 import gpgme, gpgme.editutil
 
+from twisted.internet import defer, reactor, threads
+from twisted.python import threadpool
 from twisted.words.protocols.jabber import jid
 
 from gnutls.crypto import OpenPGPCertificate
@@ -29,7 +35,6 @@ from gnutls.constants import OPENPGP_FMT_RAW
 from OpenSSL import crypto
 from OpenSSL.crypto import X509
 
-from subprocess import Popen, PIPE
 from pyasn1.codec.der import decoder
 
 try:
@@ -37,25 +42,89 @@ try:
 except ImportError:
     from StringIO import StringIO as BytesIO
 
-import util, log
+import util, log, xmlstream2
 
 
-def dump_publickey(cert):
-    """Ugly hack to extract the public key from a certificate."""
-    dump = crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
-    p = Popen(['openssl', 'x509', '-pubkey', '-noout'], stdout=PIPE, stdin=PIPE)
-    (stdout, unused) = p.communicate(dump)
-    return stdout
+"""Maximum number of certificate verification results remembered."""
+CERTIFICATE_CACHE_SIZE = 10000
 
-def convert_publickey(keydata, keyid=None):
-    """Another ugly hack to convert a PGP public key into PEM."""
-    cmd = ['openpgp2spki']
-    if keyid:
-        cmd.append(keyid)
+# certificate verification results: [sha1(certificate)]=bool
+_certificates = OrderedDict()
 
-    p = Popen(cmd, stdout=PIPE, stdin=PIPE)
-    (stdout, unused) = p.communicate(keydata)
-    return stdout
+"""OpenPGP public-key algorithms for RSA keys."""
+OPENPGP_ALGO_RSA = (1, 2, 3)
+
+"""Object identifier of RSA public keys in X.509 certificates."""
+OID_RSA_ENCRYPTION = '1.2.840.113549.1.1.1'
+
+
+def x509_rsa_publickey(cert):
+    """
+    Extracts the RSA public key from a certificate.
+    @return: (modulus, exponent), None if not an RSA key
+    """
+    spki = decoder.decode(crypto.dump_publickey(crypto.FILETYPE_ASN1, cert.get_pubkey()))[0]
+    if str(spki[0][0]) != OID_RSA_ENCRYPTION:
+        return None
+
+    key = decoder.decode(''.join(util.bitlist_to_chars(spki[1])))[0]
+    return long(key[0]), long(key[1])
+
+def openpgp_rsa_publickey(keydata):
+    """
+    Extracts the RSA public key from the primary key packet of an OpenPGP
+    public key block.
+    @return: (modulus, exponent), None if not an RSA key
+    """
+    data = bytearray(keydata)
+    ctb = data[0]
+    if not ctb & 0x80:
+        return None
+
+    if ctb & 0x40:
+        # new format packet
+        tag = ctb & 0x3f
+        if data[1] < 192:
+            offset = 2
+        elif data[1] < 224:
+            offset = 3
+        elif data[1] == 255:
+            offset = 6
+        else:
+            # partial body length, not allowed for key packets
+            return None
+    else:
+        # old format packet
+        tag = (ctb >> 2) & 0x0f
+        offset = 1 + (1, 2, 4, 0)[ctb & 0x03]
+
+    # public key packet
+    if tag != 6:
+        return None
+
+    version = data[offset]
+    if version == 4:
+        # version, creation time, algorithm
+        offset += 5
+    elif version in (2, 3):
+        # version, creation time, validity, algorithm
+        offset += 7
+    else:
+        return None
+
+    if data[offset] not in OPENPGP_ALGO_RSA:
+        return None
+    offset += 1
+
+    # modulus and exponent MPIs
+    key = []
+    for i in range(2):
+        length = ((data[offset] << 8 | data[offset + 1]) + 7) / 8
+        offset += 2
+        key.append(long(str(data[offset:offset + length]).encode('hex') or '0', 16))
+        offset += length
+
+    return tuple(key)
 
 def get_pgp_publickey_extension(cert):
     """Retrieves the custom extension containing the PGP public key block."""
@@ -90,25 +159,93 @@ def verify_certificate(cert):
     """
     Verify that a certificate is signed by the same key owning the PGP public
     key block contained in the custom X.509 extension.
+    Results are remembered by certificate, so the same certificate is
+    verified only once.
     """
-
-    # dump public key from certificate
-    pubkey = dump_publickey(cert)
-
+    key = hashlib.sha1(crypto.dump_certificate(crypto.FILETYPE_ASN1, cert)).digest()
+    try:
+        result = _certificates.pop(key)
+    except KeyError:
+        result = _verify_certificate(cert)
+        # oldest entries expire first
+        while len(_certificates) >= CERTIFICATE_CACHE_SIZE:
+            _certificates.popitem(last=False)
+
+    # most recently used entries last
+    _certificates[key] = result
+    return result
+
+def _verify_certificate(cert):
     # dump custom extension from certificate
     pubkey_ext = get_pgp_publickey_extension(cert)
 
-    if pubkey and pubkey_ext:
-        # WARNING this goes "internal error" sometimes
-        pubkey2 = convert_publickey(pubkey_ext, get_key_fingerprint(pubkey_ext))
-
-        # compare public keys
-        return pubkey == pubkey2
+    if pubkey_ext:
+        try:
+            # compare public keys
+            pubkey = x509_rsa_publickey(cert)
+            return pubkey is not None and pubkey == openpgp_rsa_publickey(pubkey_ext)
+        except:
+            import traceback
+            traceback.print_exc()
 
     return False
 
 
-class Keyring:
+class KeyInfo:
+    """
+    Parsed metadata of a public key.
+    @ivar fingerprint: key fingerprint
+    @ivar keyids: ids of the key and of its subkeys
+    @ivar revoked: true if the key has been revoked
+    @ivar uids: list of L{UserIdInfo}
+    """
+
+    def __init__(self, fingerprint, keyids, revoked, uids):
+        self.fingerprint = fingerprint
+        self.keyids = keyids
+        self.revoked = revoked
+        self.uids = uids
+
+
+class UserIdInfo:
+    """
+    Parsed metadata of a key user id.
+    @ivar signers: frozenset of fingerprints of the keys that signed the uid
+    """
+
+    def __init__(self, email, comment, revoked, signers):
+        self.email = email
+        self.comment = comment
+        self.revoked = revoked
+        self.signers = signers
+
+
+class ServerIndex:
+    """
+    Index of the servers in the network, built from the server list.
+    Instances are never modified: a new index is built when the list changes.
+    @ivar version: increased every time the list is reloaded, consumers can
+    use it to cache data derived from the index
+    @ivar hosts: frozenset of server hosts
+    @ivar fingerprints: frozenset of server fingerprints
+    @ivar host_fingerprints: frozensets of server fingerprints by host (the
+    same host might have more keys, e.g. during a key rollover)
+    """
+
+    def __init__(self, servers, version):
+        """
+        @param servers: { fingerprint: host }
+        """
+        self.version = version
+        self.hosts = frozenset(servers.itervalues())
+        self.fingerprints = frozenset(servers.iterkeys())
+        fingerprints = {}
+        for fpr, host in servers.iteritems():
+            fingerprints.setdefault(host, set()).add(fpr)
+        self.host_fingerprints = dict((host, frozenset(fprs)) for host, fprs in fingerprints.iteritems())
+
+
+class Keyring(object):
     '''Handles all keyring releated functions.'''
 
     '''Percentages of server signatures needed to obtain privileges.'''
@@ -118,55 +255,270 @@ class Keyring:
         'messages' : (0, 100)
     }
 
+    '''Maximum number of worker threads running GnuPG operations.'''
+    WORKERS = 4
+
+    '''Seconds a verified token is remembered.'''
+    TOKEN_CACHE_TTL = 3600
+    '''Maximum number of verified tokens remembered.'''
+    TOKEN_CACHE_SIZE = 10000
+
+    '''Maximum number of parsed keys remembered.'''
+    KEY_INDEX_SIZE = 100000
+    '''Default maximum number of exported public keys remembered.'''
+    KEY_CACHE_SIZE = 1000
+
     def __init__(self, db, fingerprint, network, servername, disable_signers=False):
         self._db = db
         self.fingerprint = str(fingerprint).upper()
         self.network = network
         self.servername = servername
         self._list = {}
+        self.index = ServerIndex(self._list, 0)
         # cache of locally discovered fingerprints (userid: fingerprint)
         self._fingerprints = {}
 
-        # gpgme context
-        self.ctx = gpgme.Context()
-        self.ctx.armor = False
-        self.ctx.keylist_mode = gpgme.KEYLIST_MODE_SIGS
-        # signing key (optional)
-        if not disable_signers:
-            self.ctx.signers = [self.ctx.get_key(self.fingerprint, True)]
+        # gpgme contexts, one for every thread (see _context)
+        self._disable_signers = disable_signers
+        self._local = threading.local()
+        self._context()
+
+        # worker pool for GnuPG operations (see _defer)
+        self._pool = None
+        self._queued = 0
+        self._completed = 0
+
+        # parsed key metadata: [fingerprint]=KeyInfo, [keyid]=fingerprint
+        self._keys = OrderedDict()
+        self._keyids = {}
+        self._keys_lock = threading.Lock()
+        # signer keyids not in the keyring, until the server list changes
+        self._unknown_signers = set()
+        self._unknown_signers_version = None
+        # exported public keys: [fingerprint]=(keydata, data URI)
+        self._exported = OrderedDict()
+        # last invalidation of exported keys: [fingerprint]=generation
+        self._export_generation = {}
+        self._generation = 0
+        self.key_cache_size = self.KEY_CACHE_SIZE
+        self.key_hits = 0
+        self.key_misses = 0
+        # server trust matrix and the server list version it was computed
+        # for: (version, [server fingerprint]=frozenset(signer servers))
+        self._trust = (None, {})
+        self._trust_lock = threading.Lock()
+
+        # verified tokens: [sha1(token)]=(userid, signer fingerprint, expire)
+        self._tokens = OrderedDict()
+        self.token_hits = 0
+        self.token_misses = 0
 
         self._reload()
 
+    def _context(self):
+        """
+        Returns the gpgme context of the current thread. Contexts are not
+        thread-safe, so every worker has its own, all using the same keyring.
+        """
+        try:
+            return self._local.ctx
+        except AttributeError:
+            ctx = gpgme.Context()
+            ctx.armor = False
+            ctx.keylist_mode = gpgme.KEYLIST_MODE_SIGS
+            # signing key (optional)
+            if not self._disable_signers:
+                ctx.signers = [ctx.get_key(self.fingerprint, True)]
+            self._local.ctx = ctx
+            return ctx
+
+    ctx = property(_context)
+
+    def _defer(self, method, *args):
+        """
+        Runs a GnuPG operation in the worker pool, keeping the reactor thread
+        free for routing stanzas.
+        @return: a deferred firing with the result of the operation
+        """
+        if self._pool is None:
+            self._pool = threadpool.ThreadPool(1, self.WORKERS, 'keyring')
+            self._pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', self._pool.stop)
+
+        self._queued += 1
+        d = threads.deferToThreadPool(reactor, self._pool, method, *args)
+        d.addBoth(self._done)
+        return d
+
+    def _done(self, result):
+        self._queued -= 1
+        self._completed += 1
+        return result
+
+    def stats(self):
+        """Returns metrics about the worker pool."""
+        return {
+            'workers': self.WORKERS,
+            'queued': self._queued,
+            'completed': self._completed,
+            'tokens': len(self._tokens),
+            'token_hits': self.token_hits,
+            'token_misses': self.token_misses,
+            'keys': len(self._exported),
+            'key_hits': self.key_hits,
+            'key_misses': self.key_misses,
+        }
+
     def itervalues(self):
         '''Wrapper for itervalues() of internal server list.'''
         return self._list.itervalues()
 
     def _reload(self):
+        old = self.index.fingerprints
         self._list = self._db.get_list()
+        self.index = ServerIndex(self._list, self.index.version + 1)
+
+        # forget tokens signed by servers not trusted anymore
+        if self.index.fingerprints != old:
+            trusted = self.index.fingerprints
+            for key, (userid, fpr, expire) in self._tokens.items():
+                if fpr != self.fingerprint and fpr not in trusted:
+                    del self._tokens[key]
 
     def host(self, fingerprint):
         return self._list[fingerprint]
 
-    def get_server_trust(self, fingerprint):
+    def _index_key(self, key):
         """
-        Verifies signatures on the given server public key and returns the
-        list of servers (actually fingerprints) that has signed it.
+        Parses the metadata of a gpgme key into the key index, replacing any
+        previous data for the same key (e.g. new signatures).
+        @return: L{KeyInfo}
         """
-        trusted_by = []
-
-        key = self.ctx.get_key(fingerprint, False)
+        fpr = str(key.subkeys[0].fpr).upper()
+        keyids = [str(subkey.keyid).upper() for subkey in key.subkeys]
+        with self._keys_lock:
+            # known before parsing signatures, so self-signatures resolve
+            for keyid in keyids:
+                self._keyids[keyid] = fpr
+
+        uids = []
         for uid in key.uids:
+            signers = set()
             for sign in uid.signatures:
-                skey = self.ctx.get_key(sign.keyid, False)
-                fpr = str(skey.subkeys[0].fpr).upper()
-                #print "found signature from %s" % fpr
-                #print fpr in self._list.keys()
-                #print fpr != fingerprint
-                # make sure key is actually in the keyring and the sign is not self-made
-                if fpr in self._list.keys() and fpr != fingerprint:
-                    trusted_by.append(fpr)
+                signer = self._signer(sign.keyid)
+                if signer:
+                    signers.add(signer)
+            uids.append(UserIdInfo(uid.email, uid.comment, uid.revoked, frozenset(signers)))
+
+        info = KeyInfo(fpr, keyids, key.revoked, uids)
+        with self._keys_lock:
+            # key might have changed (e.g. revoked), export it again
+            self._exported.pop(fpr, None)
+            # exports in progress are outdated too
+            self._generation += 1
+            self._export_generation[fpr] = self._generation
+            self._keys.pop(fpr, None)
+            self._keys[fpr] = info
+            # oldest entries expire first
+            while len(self._keys) > self.KEY_INDEX_SIZE:
+                unused, old = self._keys.popitem(last=False)
+                self._export_generation.pop(old.fingerprint, None)
+                for keyid in old.keyids:
+                    if self._keyids.get(keyid) == old.fingerprint:
+                        del self._keyids[keyid]
+        return info
+
+    def _key_info(self, fingerprint):
+        """
+        Returns the parsed metadata of a key, parsing it from the keyring if
+        needed.
+        @return: L{KeyInfo}, None if the key is not in the keyring
+        """
+        try:
+            return self._keys[fingerprint]
+        except KeyError:
+            try:
+                return self._index_key(self.ctx.get_key(fingerprint, False))
+            except gpgme.GpgmeError:
+                return None
+
+    def _signer(self, keyid):
+        """Returns the fingerprint of a signer key, None if not in the keyring."""
+        keyid = str(keyid).upper()
+        try:
+            return self._keyids[keyid]
+        except KeyError:
+            pass
+
+        version = self.index.version
+        with self._keys_lock:
+            if self._unknown_signers_version != version:
+                self._unknown_signers = set()
+                self._unknown_signers_version = version
+            elif keyid in self._unknown_signers:
+                return None
+
+        try:
+            return self._index_key(self.ctx.get_key(keyid, False)).fingerprint
+        except gpgme.GpgmeError:
+            with self._keys_lock:
+                if self._unknown_signers_version == version:
+                    # keep memory bounded, signatures might come from any key
+                    if len(self._unknown_signers) >= self.KEY_INDEX_SIZE:
+                        self._unknown_signers.clear()
+                    self._unknown_signers.add(keyid)
+            return None
+
+    def _trusted_by(self, fingerprint):
+        """Returns the servers that signed the given key."""
+        info = self._key_info(fingerprint)
+        if not info:
+            return frozenset()
+
+        signers = set()
+        for uid in info.uids:
+            signers.update(uid.signers)
+        # make sure key is actually in the keyring and the sign is not self-made
+        signers.intersection_update(self.index.fingerprints)
+        signers.discard(fingerprint)
+        return frozenset(signers)
+
+    def _server_trust(self):
+        """
+        Returns the server trust matrix, computed again from the keyring
+        only when the server list has been reloaded.
+        """
+        index = self.index
+        version, trust = self._trust
+        if version == index.version:
+            return trust
+
+        # called by worker threads: compute it only once
+        with self._trust_lock:
+            version, trust = self._trust
+            if version != index.version:
+                trust = {}
+                for fpr in index.fingerprints:
+                    # signatures might have changed since last time
+                    try:
+                        self._index_key(self.ctx.get_key(fpr, False))
+                    except gpgme.GpgmeError:
+                        pass
+                    trust[fpr] = self._trusted_by(fpr)
 
-        return trusted_by
+                self._trust = (index.version, trust)
+
+        return trust
+
+    def get_server_trust(self, fingerprint):
+        """
+        Verifies signatures on the given server public key and returns the
+        list of servers (actually fingerprints) that has signed it.
+        """
+        try:
+            return list(self._server_trust()[fingerprint])
+        except KeyError:
+            return list(self._trusted_by(fingerprint))
 
     def has_privilege(self, fingerprint, priv):
         #print "checking permissions for %s" % fingerprint
@@ -182,7 +534,7 @@ class Keyring:
             return True
 
         # key is not in fingerprint
-        if fingerprint not in self._list.keys():
+        if fingerprint not in self.index.fingerprints:
             #print "fingerprint not in keyring"
             return False
 
@@ -217,8 +569,8 @@ class Keyring:
         return self._list.iterkeys()
 
     def hostlist(self):
-        """List of host servers."""
-        return self._list.values()
+        """Set of host servers."""
+        return self.index.hosts
 
     def get_fingerprint(self, userid):
         """Used only by the resolver."""
@@ -228,12 +580,20 @@ class Keyring:
             raise KeyNotFoundException(userid)
 
     def import_key(self, keydata):
-        """Imports a key without checking."""
+        """
+        Imports a key without checking.
+        @return: a deferred firing with (fingerprint, key), or False on error
+        """
+        return self._defer(self._import_key, keydata)
+
+    def _import_key(self, keydata):
         try:
             # import key
             result = self.ctx.import_(BytesIO(keydata))
             fp = str(result.imports[0][0])
-            return fp, self.ctx.get_key(fp)
+            key = self.ctx.get_key(fp)
+            self._index_key(key)
+            return fp, key
         except:
             import traceback
             traceback.print_exc()
@@ -242,15 +602,58 @@ class Keyring:
     def get_key(self, userid, fingerprint):
         """
         Retrieves a user's key from the cache keyring.
-        @return keydata on success, None otherwise
+        @return: a deferred firing with keydata on success, None otherwise
+        """
+        return self._exported_key(userid, fingerprint).addCallback(lambda result: result and result[0])
+
+    def get_key_uri(self, userid, fingerprint):
+        """
+        Retrieves a user's key from the cache keyring, as a data URI.
+        @return: a deferred firing with the data URI on success, None otherwise
+        """
+        return self._exported_key(userid, fingerprint).addCallback(lambda result: result and result[1])
+
+    def _exported_key(self, userid, fingerprint):
         """
+        Exported keys are remembered until they are imported again, up to
+        L{key_cache_size} keys.
+        @return: a deferred firing with (keydata, data URI)
+        """
+        fpr = str(fingerprint).upper()
+        with self._keys_lock:
+            try:
+                # most recently used entries last
+                result = self._exported.pop(fpr)
+                self._exported[fpr] = result
+                self.key_hits += 1
+                return defer.succeed(result)
+            except KeyError:
+                self.key_misses += 1
+            generation = self._export_generation.get(fpr)
+
+        def _exported(result):
+            if result:
+                with self._keys_lock:
+                    # key imported again while exporting
+                    if self._export_generation.get(fpr) != generation:
+                        return result
+                    self._exported[fpr] = result
+                    # oldest entries expire first
+                    while len(self._exported) > self.key_cache_size:
+                        self._exported.popitem(last=False)
+            return result
+
+        return self._defer(self._get_key, userid, fingerprint).addCallback(_exported)
+
+    def _get_key(self, userid, fingerprint):
         # retrieve the requested key
         try:
             key = self.ctx.get_key(fingerprint)
             if key:
                 keydata = BytesIO()
                 self.ctx.export(str(key.subkeys[0].fpr), keydata)
-                return keydata.getvalue()
+                keydata = keydata.getvalue()
+                return keydata, xmlstream2.DATA_PGP_PREFIX + base64.b64encode(keydata)
         except:
             import traceback
             traceback.print_exc()
@@ -261,8 +664,17 @@ class Keyring:
         and if uid matches.
         FIXME this method has the side effect of importing the key into the
         keyring and leaving it there.
-        @return: key fingerprint on success, None otherwise
+        @return: a deferred firing with the key fingerprint on success, None
+        otherwise
         """
+        def _checked(fp):
+            if fp:
+                self._fingerprints[userid] = fp
+            return fp
+
+        return self._defer(self._check_user_key, keydata, userid).addCallback(_checked)
+
+    def _check_user_key(self, keydata, userid):
         try:
             # TODO this should remove the key from the keyring when it's done
 
@@ -271,12 +683,13 @@ class Keyring:
             #for d in dir(result):
             #    print d, getattr(result, d)
             fp = str(result.imports[0][0]).upper()
-            key = self.ctx.get_key(fp)
+            key = self._index_key(self.ctx.get_key(fp))
 
             # revoked key!
             if key.revoked:
                 return None
 
+            trust = self._server_trust()
             # check that at least one of the key uids is userid@network
             check_email = '%s@%s' % (userid, self.network)
             for uid in key.uids:
@@ -287,37 +700,61 @@ class Keyring:
                     if uid.revoked:
                         return None
 
-                    for sig in uid.signatures:
-                        try:
-                            #log.debug("found signature by [KEYID-%s]" % (sig.keyid, ))
-                            mkey = self.ctx.get_key(sig.keyid)
-                            if mkey:
-                                # signer key revoked!
-                                if mkey.revoked:
-                                    continue
-
-                                fpr = str(mkey.subkeys[0].fpr).upper()
-
-                                #log.debug("found signature by %s" % (fpr, ))
-                                # signature made by us
-                                if fpr == self.fingerprint:
-                                    self._fingerprints[userid] = fp
-                                    return fp
-
-                                # check against keyring
-                                for rkey in self._list.iterkeys():
-                                    # fingerprint is a match: check if server is trusted
-                                    if fpr == rkey and self.fingerprint in self.get_server_trust(rkey):
-                                        self._fingerprints[userid] = fp
-                                        return fp
-                        except:
-                            pass
+                    for fpr in uid.signers:
+                        mkey = self._key_info(fpr)
+                        # signer key revoked!
+                        if not mkey or mkey.revoked:
+                            continue
+
+                        #log.debug("found signature by %s" % (fpr, ))
+                        # signature made by us
+                        if fpr == self.fingerprint:
+                            return fp
+
+                        # check against keyring: check if server is trusted
+                        if self.fingerprint in trust.get(fpr, ()):
+                            return fp
         except:
             import traceback
             traceback.print_exc()
 
     def check_token(self, token_data):
-        """Checks a Kontalk token. Data must be already base64-decoded."""
+        """
+        Checks a Kontalk token. Data must be already base64-decoded.
+        Verified tokens are remembered for L{TOKEN_CACHE_TTL} seconds, so
+        clients reconnecting with the same token are not verified again.
+        @return: a deferred firing with the userid, None if token is not valid
+        """
+        key = hashlib.sha1(token_data).digest()
+        try:
+            userid, fpr, expire = self._tokens[key]
+            if expire > time.time():
+                self.token_hits += 1
+                return defer.succeed(userid)
+            del self._tokens[key]
+        except KeyError:
+            pass
+
+        self.token_misses += 1
+
+        def _verified(result):
+            if result:
+                userid, fpr = result
+                # token might have been verified by a concurrent login
+                self._tokens.pop(key, None)
+                self._tokens[key] = (userid, fpr, time.time() + self.TOKEN_CACHE_TTL)
+                # oldest entries expire first
+                while len(self._tokens) > self.TOKEN_CACHE_SIZE:
+                    self._tokens.popitem(last=False)
+                return userid
+
+        return self._defer(self._check_token, token_data).addCallback(_verified)
+
+    def _check_token(self, token_data):
+        """
+        Verifies a Kontalk token signature.
+        @return: (userid, signer fingerprint), None if token is not valid
+        """
         cipher = BytesIO(token_data)
         plain = BytesIO()
 
@@ -338,13 +775,13 @@ class Keyring:
                 return None
 
             # compare with own fingerprint
-            if sign.fpr.upper() == self.fingerprint.upper():
-                return userid
+            fpr = sign.fpr.upper()
+            if fpr == self.fingerprint.upper():
+                return userid, fpr
 
             # no match - compare with keyring
-            for rkey in self._list.iterkeys():
-                if sign.fpr.upper() == rkey.upper():
-                    return userid
+            if fpr in self.index.fingerprints:
+                return userid, fpr
 
     """
     TODO this is not safe. We risk importing unwanted keys and a bunch of other
@@ -354,8 +791,11 @@ class Keyring:
     def check_key(self, keydata):
         """
         Checks a public key for server signatures.
-        @return: JID, fingerprint
+        @return: a deferred firing with (JID, fingerprint)
         """
+        return self._defer(self._check_key, keydata)
+
+    def _check_key(self, keydata):
         data = BytesIO(keydata)
 
         result = self.ctx.import_(data)
@@ -363,34 +803,30 @@ class Keyring:
         if result and (result.imported == 1 or result.unchanged == 1):
             fpr = str(result.imports[0][0])
             key = self.ctx.get_key(fpr, False)
+            info = self._index_key(key)
             # take the first uid
-            uid = key.uids[0]
+            uid = info.uids[0]
 
             jabberid = jid.JID(uid.email)
             if jabberid.host == self.network:
                 jabberid.resource = uid.comment
 
-                for sig in uid.signatures:
-                    try:
-                        mkey = self.ctx.get_key(sig.keyid, False)
-                        if mkey:
-                            fpr = mkey.subkeys[0].fpr.upper()
-
-                            if fpr == self.fingerprint.upper():
-                                return (jabberid, key.subkeys[0].fpr)
-
-                            # no direct match - compare with keyring
-                            for rkey in self._list.iterkeys():
-                                if fpr == rkey.upper():
-                                    return (jabberid, key.subkeys[0].fpr)
-                    except:
-                        pass
+                for fpr in uid.signers:
+                    if fpr == self.fingerprint:
+                        return (jabberid, key.subkeys[0].fpr)
+
+                    # no direct match - compare with keyring
+                    if fpr in self.index.fingerprints:
+                        return (jabberid, key.subkeys[0].fpr)
 
     def check_signature(self, signature, text, fingerprint):
         """
         Checks the given signature against key identified by fingerprint.
-        @return: fingerprint
+        @return: a deferred firing with the fingerprint
         """
+        return self._defer(self._check_signature, signature, text, fingerprint)
+
+    def _check_signature(self, signature, text, fingerprint):
         try:
             cipher = BytesIO(signature)
             plain = BytesIO()
@@ -419,8 +855,11 @@ class Keyring:
         """
         Signs the provided public key with our server private key.
         At least one uid in the public key must match this form: userid@network
-        @return: fingerprint, signed_keydata
+        @return: a deferred firing with (fingerprint, signed_keydata)
         """
+        return self._defer(self._sign_public_key, keydata, userid)
+
+    def _sign_public_key(self, keydata, userid):
         try:
             # import key
             result = self.ctx.import_(BytesIO(keydata))
@@ -441,6 +880,7 @@ class Keyring:
             if check:
                 # sign key
                 gpgme.editutil.edit_sign(self.ctx, keyfp, check=0)
+                self._index_key(self.ctx.get_key(fp))
 
                 # export signed key
                 keydata = BytesIO()
@@ -452,7 +892,13 @@ class Keyring:
             traceback.print_exc()
 
     def generate_user_token(self, userid):
-        """Generates a user token."""
+        """
+        Generates a user token.
+        @return: a deferred firing with the token
+        """
+        return self._defer(self._generate_user_token, userid)
+
+    def _generate_user_token(self, userid):
 
         """
         A token is made up of the hashed phone number (the user id)
@@ -186,33 +186,35 @@ class SMSRegistrationProvider(XMPPRegistrationProvider):
             d = self.component.validationdb.validate(code)
 
             def _continue(userid):
-                pkey = base64.b64decode(var_pkey.value.__str__().encode('utf-8'))
-                signed_pkey = manager.link_public_key(pkey, userid)
-                if signed_pkey:
-                    iq = xmlstream.toResponse(stanza, 'result')
-                    query = iq.addElement((xmlstream2.NS_IQ_REGISTER, 'query'))
+                def _signed(signed_pkey):
+                    if signed_pkey:
+                        iq = xmlstream.toResponse(stanza, 'result')
+                        query = iq.addElement((xmlstream2.NS_IQ_REGISTER, 'query'))
 
-                    form = query.addElement(('jabber:x:data', 'x'))
-                    form['type'] = 'form'
+                        form = query.addElement(('jabber:x:data', 'x'))
+                        form['type'] = 'form'
 
-                    hidden = form.addElement((None, 'field'))
-                    hidden['type'] = 'hidden'
-                    hidden['var'] = 'FORM_TYPE'
-                    hidden.addElement((None, 'value'), content='http://kontalk.org/protocol/register#code')
+                        hidden = form.addElement((None, 'field'))
+                        hidden['type'] = 'hidden'
+                        hidden['var'] = 'FORM_TYPE'
+                        hidden.addElement((None, 'value'), content='http://kontalk.org/protocol/register#code')
 
-                    signed = form.addElement((None, 'field'))
-                    signed['type'] = 'text-single'
-                    signed['label'] = 'Signed public key'
-                    signed['var'] = 'publickey'
-                    signed.addElement((None, 'value'), content=base64.b64encode(signed_pkey))
+                        signed = form.addElement((None, 'field'))
+                        signed['type'] = 'text-single'
+                        signed['label'] = 'Signed public key'
+                        signed['var'] = 'publickey'
+                        signed.addElement((None, 'value'), content=base64.b64encode(signed_pkey))
 
-                    return manager.send(iq, True)
+                        return manager.send(iq, True)
 
-                else:
-                    e = error.StanzaError('bad-request', 'modify', 'Invalid public key.')
-                    iq = xmlstream.toResponse(stanza, 'error')
-                    iq.addChild(e.getElement())
-                    manager.send(iq, True)
+                    else:
+                        e = error.StanzaError('bad-request', 'modify', 'Invalid public key.')
+                        iq = xmlstream.toResponse(stanza, 'error')
+                        iq.addChild(e.getElement())
+                        manager.send(iq, True)
+
+                pkey = base64.b64decode(var_pkey.value.__str__().encode('utf-8'))
+                return manager.link_public_key(pkey, userid).addCallback(_signed)
 
             def _error(failure):
                 log.debug("error: %s" % (failure, ))
@@ -83,6 +83,10 @@ class PresenceStorage:
         """Retrieve info about all users."""
         pass
 
+    def get_users(self, userids):
+        """Retrieve info about the given users."""
+        pass
+
     def presence(self, stanza):
         """Persist a presence."""
         pass
@@ -100,6 +104,37 @@ class PresenceStorage:
         pass
 
 
+class PrivacyListStorage:
+    """Privacy lists storage."""
+
+    def load(self, callback):
+        """
+        Retrieve all privacy list entries, calling callback with chunks of
+        (userid, list type, target) tuples.
+        """
+        pass
+
+    def add(self, userid, list_type, target):
+        """Add an entry to a privacy list."""
+        pass
+
+    def remove(self, userid, list_type, target):
+        """Remove an entry from a privacy list."""
+        pass
+
+    def load_versions(self):
+        """Retrieve all privacy lists versions as (userid, version) tuples."""
+        pass
+
+    def set_version(self, userid, version):
+        """Set the version of the privacy lists of a user."""
+        pass
+
+    def flush(self):
+        """Write pending changes."""
+        pass
+
+
 class NetworkStorage:
     """Network info storage."""
 
@@ -422,6 +457,29 @@ class MySQLPresenceStorage(PresenceStorage):
         query = 'SELECT `userid`, `timestamp`, `status`, `show`, `priority`, `fingerprint` FROM presence WHERE `timestamp` IS NOT NULL'
         return dbpool.runInteraction(_fetchall, query)
 
+    def get_users(self, userids):
+        def _fetchall(tx, query, args):
+            tx.execute(query, args)
+            out = []
+            rows = tx.fetchall()
+            for data in rows:
+                out.append({
+                    'userid': data[0],
+                    'timestamp': data[1],
+                    'status': base64.b64decode(data[2]).decode('utf-8') if data[2] is not None else '',
+                    'show': data[3],
+                    'priority': data[4],
+                    'fingerprint': data[5],
+                })
+            return out
+
+        args = tuple(userid[:util.USERID_LENGTH] for userid in userids)
+        if not args:
+            return defer.succeed([])
+
+        query = 'SELECT `userid`, `timestamp`, `status`, `show`, `priority`, `fingerprint` FROM presence WHERE userid IN (%s) AND `timestamp` IS NOT NULL' % (', '.join(('?', ) * len(args)), )
+        return dbpool.runInteraction(_fetchall, query, args)
+
     def presence(self, stanza):
         global dbpool
         userid = util.jid_user(stanza['from'])
@@ -456,6 +514,161 @@ class MySQLPresenceStorage(PresenceStorage):
         return dbpool.runOperation('DELETE FROM presence WHERE userid = ?', (userid, ))
 
 
+class MySQLPrivacyListStorage(PrivacyListStorage):
+    """
+    Privacy lists storage with write-behind: changes are buffered and written
+    in batches, the last change to an entry superseding the previous ones.
+    """
+
+    """Seconds changes are buffered before being written."""
+    FLUSH_DELAY = 2
+
+    """Number of buffered changes causing an immediate write."""
+    FLUSH_SIZE = 1000
+
+    """Number of entries retrieved per query when loading."""
+    LOAD_CHUNK = 10000
+
+    def __init__(self):
+        # pending changes: [(userid, list type, target)]=True if added
+        self._pending = {}
+        # pending versions: [userid]=version
+        self._versions = {}
+        self._flush_call = None
+        # last write in progress, next writes wait for it
+        self._flushing = None
+        # entries removed while loading (None if not loading)
+        self._removed = None
+        # write pending changes before exiting
+        reactor.addSystemEventTrigger('during', 'shutdown', self.flush)
+
+    def pending(self, userid, list_type, target):
+        """
+        Returns True if the entry is going to be added, False if it's going
+        to be removed, None if there are no pending changes for it.
+        """
+        return self._pending.get((userid, list_type, target))
+
+    def removed(self, userid, list_type, target):
+        """Returns True if the entry has been removed since load() started."""
+        return self._removed is not None and (userid, list_type, target) in self._removed
+
+    def load(self, callback):
+        result = defer.Deferred()
+        query = 'SELECT `userid`, `type`, `target` FROM privacy %sORDER BY `userid`, `type`, `target` LIMIT %d'
+        first = query % ('', self.LOAD_CHUNK)
+        # resume from last entry of the previous chunk (spelled out so the
+        # primary key range can be used also by older MySQL versions)
+        following = query % ('WHERE `userid` > ? OR (`userid` = ? AND (`type` > ? OR (`type` = ? AND `target` > ?))) ', self.LOAD_CHUNK)
+
+        self._removed = set()
+        def _finished(result):
+            self._removed = None
+            return result
+        result.addBoth(_finished)
+
+        def _chunk(rows, count):
+            if rows:
+                callback(rows)
+                count += len(rows)
+
+            if len(rows) < self.LOAD_CHUNK:
+                result.callback(count)
+            else:
+                userid, list_type, target = rows[-1]
+                d = dbpool.runQuery(following, (userid, userid, list_type, list_type, target))
+                d.addCallbacks(_chunk, result.errback, callbackArgs=(count, ))
+
+        dbpool.runQuery(first).addCallbacks(_chunk, result.errback, callbackArgs=(0, ))
+        return result
+
+    def add(self, userid, list_type, target):
+        key = (userid, list_type, target)
+        if self._removed is not None:
+            self._removed.discard(key)
+        self._change(key, True)
+
+    def remove(self, userid, list_type, target):
+        key = (userid, list_type, target)
+        if self._removed is not None:
+            self._removed.add(key)
+        self._change(key, False)
+
+    def load_versions(self):
+        return dbpool.runQuery('SELECT `userid`, `version` FROM privacy_version')
+
+    def set_version(self, userid, version):
+        self._versions[userid] = version
+        self._schedule()
+
+    def _change(self, key, value):
+        self._pending[key] = value
+        self._schedule()
+
+    def _schedule(self):
+        if len(self._pending) + len(self._versions) >= self.FLUSH_SIZE:
+            self.flush()
+        elif not self._flush_call:
+            self._flush_call = reactor.callLater(self.FLUSH_DELAY, self.flush)
+
+    def flush(self):
+        if self._flush_call:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+
+        if not self._pending and not self._versions:
+            return defer.succeed(None)
+
+        changes = self._pending
+        self._pending = {}
+        versions = self._versions
+        self._versions = {}
+        added = [key for key, value in changes.iteritems() if value]
+        removed = [key for key, value in changes.iteritems() if not value]
+
+        def _entries(tx):
+            if added:
+                tx.executemany('INSERT IGNORE INTO privacy (`userid`, `type`, `target`) VALUES (?, ?, ?)', added)
+            if removed:
+                tx.executemany('DELETE FROM privacy WHERE `userid` = ? AND `type` = ? AND `target` = ?', removed)
+            if versions:
+                tx.executemany('INSERT INTO privacy_version (`userid`, `version`) VALUES (?, ?) ON DUPLICATE KEY UPDATE `version` = VALUES(`version`)',
+                    versions.items())
+
+        def _write(unused):
+            return dbpool.runInteraction(_entries)
+
+        def _failed(failure):
+            log.error("unable to write privacy lists: %s" % (failure.getErrorMessage(), ))
+            # try again later, unless entries have been changed in the meantime
+            for key, value in changes.iteritems():
+                if key not in self._pending:
+                    self._pending[key] = value
+            for userid, version in versions.iteritems():
+                if userid not in self._versions:
+                    self._versions[userid] = version
+            if not self._flush_call:
+                self._flush_call = reactor.callLater(self.FLUSH_DELAY, self.flush)
+
+        def _done(unused):
+            if self._flushing is d:
+                self._flushing = None
+
+        d = defer.Deferred()
+        d.addCallback(_write)
+        d.addErrback(_failed)
+        d.addCallback(_done)
+
+        # wait for the previous write to complete, to keep changes in order
+        previous, self._flushing = self._flushing, d
+        if previous:
+            previous.addCallback(lambda unused: d.callback(None))
+        else:
+            d.callback(None)
+        return d
+
+
 class MySQLUserValidationStorage(UserValidationStorage):
     """User validation storage."""
 
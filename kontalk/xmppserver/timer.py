@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Hashed timer wheel."""
+"""
+  Kontalk XMPP server
+  Copyright (C) 2014 Kontalk Devteam <devteam@kontalk.org>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import math
+
+from twisted.internet import reactor, task
+
+
+class Timer(object):
+    """A timer armed in a L{TimerWheel}."""
+
+    __slots__ = ('wheel', 'slot', 'rounds', 'callback', 'args')
+
+    def __init__(self, wheel, slot, rounds, callback, args):
+        self.wheel = wheel
+        self.slot = slot
+        self.rounds = rounds
+        self.callback = callback
+        self.args = args
+
+    def active(self):
+        return self.slot is not None
+
+    def cancel(self):
+        self.wheel.cancel(self)
+
+
+class TimerWheel(object):
+    """
+    A hashed timer wheel for large numbers of coarse timers (e.g. keepalives).
+    Timers are kept in a ring of slots, each one visited once every
+    L{resolution} seconds by a single reactor timer; arming and cancelling a
+    timer costs a set operation regardless of how many timers are armed.
+    Timers fire up to L{resolution} seconds late.
+
+    @ivar resolution: seconds between ticks
+    @ivar slots: timers by slot
+    @type slots: C{list}
+    @ivar fired: number of timers fired so far
+    """
+
+    def __init__(self, resolution=1.0, size=512, clock=reactor):
+        self.resolution = resolution
+        self.clock = clock
+        self.slots = [set() for i in xrange(size)]
+        self.cursor = 0
+        self.fired = 0
+        self._count = 0
+        self._time = None
+        self._loop = None
+
+    def __len__(self):
+        """Returns the number of armed timers."""
+        return self._count
+
+    def schedule(self, delay, callback, *args):
+        """
+        Arm a timer calling callback with args after delay seconds.
+        @return: the L{Timer}
+        """
+        if not self._loop:
+            self._time = self.clock.seconds()
+            self._loop = task.LoopingCall(self._tick)
+            self._loop.clock = self.clock
+            self._loop.start(self.resolution, now=False)
+
+        # slots are counted from the last tick, not from now
+        elapsed = self.clock.seconds() - self._time
+        ticks = max(1, int(math.ceil((delay + elapsed) / self.resolution - 1e-6)))
+        size = len(self.slots)
+        slot = (self.cursor + ticks) % size
+        timer = Timer(self, slot, (ticks - 1) // size, callback, args)
+        self.slots[slot].add(timer)
+        self._count += 1
+
+        return timer
+
+    def cancel(self, timer):
+        """Disarm a timer."""
+        if timer.slot is not None:
+            self.slots[timer.slot].discard(timer)
+            timer.slot = None
+            self._count -= 1
+            self._stop()
+
+    def _stop(self):
+        if not self._count and self._loop:
+            self._loop.stop()
+            self._loop = None
+
+    def _tick(self):
+        now = self.clock.seconds()
+        # catch up with ticks we might have missed
+        while self._time + self.resolution <= now + 1e-6:
+            self._time += self.resolution
+            self.cursor = (self.cursor + 1) % len(self.slots)
+            self._advance(self.slots[self.cursor])
+
+        self._stop()
+
+    def _advance(self, bucket):
+        for timer in list(bucket):
+            # cancelled by an earlier callback in this tick
+            if timer.slot is None:
+                continue
+
+            if timer.rounds:
+                timer.rounds -= 1
+                continue
+
+            bucket.discard(timer)
+            timer.slot = None
+            self._count -= 1
+            self.fired += 1
+            try:
+                timer.callback(*timer.args)
+            except:
+                import traceback
+                traceback.print_exc()
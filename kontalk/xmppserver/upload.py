@@ -27,8 +27,8 @@ import xmlstream2
 class UploadService():
     """Interface for upload service classes."""
 
-    def upload(self, stanza):
-        """Process an incoming upload info request."""
+    def upload(self, stanza, manager):
+        """Process an incoming upload info request from a client session."""
         pass
 
     def info(self):
@@ -45,14 +45,14 @@ class KontalkBoxUploadService(UploadService):
         self.handler = handler
         self.config = config
 
-    def upload(self, stanza):
+    def upload(self, stanza, manager):
         stanza.consumed = True
         # TODO check for <media/> tag and supported MIME types
         iq = xmlstream.toResponse(stanza, 'result')
         upload = iq.addElement((xmlstream2.NS_MESSAGE_UPLOAD, 'upload'))
         upload['node'] = self.name
         upload.addElement((None, 'uri'), content=self.config['uri'])
-        self.handler.send(iq)
+        manager.send(iq)
 
     def info(self):
         return {
@@ -19,13 +19,16 @@
 """
 
 
+import calendar
 import copy
+import re
+import time
 
 from twisted.cred import error as cred_error
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, task
 from twisted.words.protocols.jabber import client, ijabber, xmlstream, sasl, error
 from twisted.words.protocols.jabber.error import NS_XMPP_STANZAS
-from twisted.words.xish import domish
+from twisted.words.xish import domish, utility
 
 from wokkel import component
 
@@ -58,6 +61,8 @@ NS_XMPP_SERVER_RECEIPTS = 'urn:xmpp:server-receipts'
 NS_XMPP_STORAGE = 'urn:xmpp:storage'
 
 NS_PRESENCE_PUSH = 'http://kontalk.org/extensions/presence#push'
+NS_PRESENCE_PROBE = 'http://kontalk.org/extensions/presence#probe'
+NS_PRIVACY_SYNC = 'http://kontalk.org/extensions/privacy#sync'
 NS_MESSAGE_UPLOAD = 'http://kontalk.org/extensions/message#upload'
 
 XMPP_STAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
@@ -65,6 +70,25 @@ XMPP_STAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 DATA_PGP_PREFIX = 'data:application/pgp-keys;base64,'
 
 
+def parse_stamp(stamp):
+    """
+    Parses a timestamp in L{XMPP_STAMP_FORMAT} format.
+    @return: seconds since the epoch or None if stamp is not valid
+    """
+    try:
+        if len(stamp) != 20 or stamp[4] != '-' or stamp[7] != '-' or stamp[10] != 'T' or stamp[19] != 'Z':
+            return None
+        return calendar.timegm((int(stamp[0:4]), int(stamp[5:7]), int(stamp[8:10]),
+            int(stamp[11:13]), int(stamp[14:16]), int(stamp[17:19])))
+    except (TypeError, ValueError):
+        return None
+
+
+def format_stamp(seconds):
+    """Formats seconds since the epoch in L{XMPP_STAMP_FORMAT} format."""
+    return time.strftime(XMPP_STAMP_FORMAT, time.gmtime(seconds))
+
+
 def strip_server_receipt(stanza):
     """
     Strips server receipt elements from the given stanza.
@@ -588,6 +612,373 @@ class SASLMechanismError(sasl.SASLError):
     """
 
 
+# first location step of a XPath query: name and predicates
+_XPATH_STEP_RE = re.compile(r'/([^/\[\]]+)((?:\[(?:[^\]\'"]|\'[^\']*\'|"[^"]*")*\])*)')
+# a single predicate
+_XPATH_PREDICATE_RE = re.compile(r'\[((?:[^\]\'"]|\'[^\']*\'|"[^"]*")*)\]')
+# an attribute value predicate
+_XPATH_ATTRIB_RE = re.compile(r'^@(type|id|xmlns)\s*=\s*(?:\'([^\']*)\'|"([^"]*)")$')
+
+# index key for stanzas without a type attribute
+_NO_TYPE = intern('//notype')
+
+
+def _xpath_index_key(query):
+    """
+    Extracts the index key (element name, type, child namespace, id) from a
+    XPath query. Each part of the key is a necessary condition for a match;
+    None means that part can't be used for indexing.
+    """
+    name = stype = ns = sid = None
+    queryStr = getattr(query, 'queryStr', None)
+    if not queryStr or queryStr.startswith('//'):
+        return name, stype, ns, sid
+
+    match = _XPATH_STEP_RE.match(queryStr)
+    if not match:
+        return name, stype, ns, sid
+
+    if match.group(1) != '*':
+        name = match.group(1)
+    for pred in _XPATH_PREDICATE_RE.findall(match.group(2)):
+        pred = pred.strip()
+        if pred == 'not(@type)':
+            stype = _NO_TYPE
+        else:
+            attr = _XPATH_ATTRIB_RE.match(pred)
+            if attr:
+                value = attr.group(2) if attr.group(2) is not None else attr.group(3)
+                if attr.group(1) == 'type':
+                    stype = value
+                elif attr.group(1) == 'id':
+                    sid = value
+
+    # namespace of a child element
+    child = _XPATH_STEP_RE.match(queryStr, match.end())
+    if child:
+        for pred in _XPATH_PREDICATE_RE.findall(child.group(2)):
+            attr = _XPATH_ATTRIB_RE.match(pred.strip())
+            if attr and attr.group(1) == 'xmlns':
+                ns = attr.group(2) if attr.group(2) is not None else attr.group(3)
+
+    return name, stype, ns, sid
+
+
+class IndexedDispatcherMixin:
+    """
+    L{utility.EventDispatcher} mixin indexing XPath observers by element name,
+    type attribute, child namespace and id attribute.
+
+    When dispatching, only observers whose index key is compatible with the
+    stanza are matched against it, so the cost of a dispatch does not depend
+    on the number of registered observers. Queries (or parts of them) which
+    can't be indexed are still evaluated as XPath on every candidate.
+    """
+
+    # {name: {type: {child namespace: {id: set([(priority, query)])}}}}
+    _xpathIndex = None
+
+    def _addObserver(self, onetime, event, observerfn, priority, *args, **kwargs):
+        deferred = self._dispatchDepth > 0
+        utility.EventDispatcher._addObserver(self, onetime, event, observerfn, priority, *args, **kwargs)
+
+        if not deferred:
+            event, observers = self._getEventAndObservers(event)
+            if observers is self._xpathObservers:
+                self._indexObserver(priority, event)
+
+    def removeObserver(self, event, observerfn):
+        deferred = self._dispatchDepth > 0
+        utility.EventDispatcher.removeObserver(self, event, observerfn)
+
+        if not deferred:
+            event, observers = self._getEventAndObservers(event)
+            if observers is self._xpathObservers:
+                for priority in list(self._xpathIndexed(event)):
+                    if event not in observers.get(priority, ()):
+                        self._unindexObserver(priority, event)
+
+    def _xpathIndexed(self, query):
+        name, stype, ns, sid = _xpath_index_key(query)
+        try:
+            entries = self._xpathIndex[name][stype][ns][sid]
+        except (KeyError, TypeError):
+            return ()
+        return [entry[0] for entry in entries if entry[1] == query]
+
+    def _indexObserver(self, priority, query):
+        if self._xpathIndex is None:
+            self._xpathIndex = {}
+
+        name, stype, ns, sid = _xpath_index_key(query)
+        byType = self._xpathIndex.setdefault(name, {})
+        byNs = byType.setdefault(stype, {})
+        byId = byNs.setdefault(ns, {})
+        byId.setdefault(sid, set()).add((priority, query))
+
+    def _unindexObserver(self, priority, query):
+        name, stype, ns, sid = _xpath_index_key(query)
+        try:
+            byType = self._xpathIndex[name]
+            byNs = byType[stype]
+            byId = byNs[ns]
+            entries = byId[sid]
+        except (KeyError, TypeError):
+            return
+
+        entries.discard((priority, query))
+        # clean up empty branches
+        if not entries:
+            del byId[sid]
+            if not byId:
+                del byNs[ns]
+                if not byNs:
+                    del byType[stype]
+                    if not byType:
+                        del self._xpathIndex[name]
+
+    def _xpathCandidates(self, obj):
+        """Returns the (priority, query) entries that could match obj."""
+        found = []
+        if not self._xpathIndex:
+            return found
+
+        attrs = obj.attributes
+        stype = attrs.get('type', _NO_TYPE)
+        sid = attrs.get('id')
+        namespaces = [None]
+        for child in obj.elements():
+            if child.uri not in namespaces:
+                namespaces.append(child.uri)
+
+        for name in (obj.name, None):
+            byType = self._xpathIndex.get(name)
+            if not byType:
+                continue
+            for t in (stype, None):
+                byNs = byType.get(t)
+                if not byNs:
+                    continue
+                for ns in namespaces:
+                    byId = byNs.get(ns)
+                    if not byId:
+                        continue
+                    entries = byId.get(None)
+                    if entries:
+                        found.extend(entries)
+                    if sid is not None:
+                        entries = byId.get(sid)
+                        if entries:
+                            found.extend(entries)
+
+        return found
+
+    def dispatch(self, obj, event=None):
+        if event is not None:
+            return utility.EventDispatcher.dispatch(self, obj, event)
+
+        foundTarget = False
+
+        self._dispatchDepth += 1
+
+        candidates = self._xpathCandidates(obj)
+        candidates.sort(key=lambda entry: entry[0], reverse=True)
+
+        emptyLists = []
+        for priority, query in candidates:
+            callbacklist = self._xpathObservers[priority][query]
+            if query.matches(obj):
+                callbacklist.callback(obj)
+                foundTarget = True
+                if callbacklist.isEmpty():
+                    emptyLists.append((priority, query))
+
+        for priority, query in emptyLists:
+            del self._xpathObservers[priority][query]
+            self._unindexObserver(priority, query)
+
+        self._dispatchDepth -= 1
+
+        # process updates queued while dispatching
+        if self._dispatchDepth == 0:
+            for f in self._updateQueue:
+                f()
+            self._updateQueue = []
+
+        return foundTarget
+
+
+class XmlStream(IndexedDispatcherMixin, xmlstream.XmlStream):
+    """
+    XMPP stream with indexed observer dispatching.
+    @ivar lastReceived: time data was last received from the peer
+    @type lastReceived: C{float}
+    """
+
+    lastReceived = None
+
+    def connectionMade(self):
+        self.lastReceived = reactor.seconds()
+        xmlstream.XmlStream.connectionMade(self)
+
+    def dataReceived(self, data):
+        self.lastReceived = reactor.seconds()
+        xmlstream.XmlStream.dataReceived(self, data)
+
+
+class _PendingRequest(object):
+    """An outstanding request waiting for responses."""
+
+    __slots__ = ('key', 'callback', 'args', 'kwargs', 'priority', 'once', 'name', 'stype', 'timeout', 'onTimeout')
+
+    def __init__(self, key, callback, args, kwargs, priority, once, name, stype, onTimeout):
+        self.key = key
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.once = once
+        self.name = name
+        self.stype = stype
+        self.timeout = None
+        self.onTimeout = onTimeout
+
+
+class StanzaCorrelator(object):
+    """
+    Correlates incoming responses with outstanding requests by stanza id.
+
+    Pending requests are kept in a dictionary keyed by id and a single stream
+    observer is registered for each priority level in use, so correlating a
+    response costs a dictionary lookup regardless of the number of requests
+    waiting for a response.
+
+    @ivar pending: outstanding requests: {(group, id): [request]}
+    @type pending: C{dict}
+    @ivar responses: number of responses correlated so far
+    @ivar timeouts: number of requests expired so far
+    """
+
+    __slots__ = ('xmlstream', 'pending', 'responses', 'timeouts', '_count', '_groups', '_priorities')
+
+    def __init__(self, xs):
+        self.xmlstream = xs
+        self.pending = {}
+        self.responses = 0
+        self.timeouts = 0
+        self._count = 0
+        self._groups = 0
+        self._priorities = set()
+
+    def __len__(self):
+        return self._count
+
+    def stats(self):
+        """Returns metrics about pending requests."""
+        return {
+            'pending': self._count,
+            'responses': self.responses,
+            'timeouts': self.timeouts,
+        }
+
+    def expect(self, stanzaId, callback, priority=0, timeout=None, onTimeout=None,
+            once=True, group=False, name=None, stype=None, args=(), kwargs=None):
+        """
+        Wait for responses to the request with the given id.
+        @param callback: called with every response, followed by args and
+        kwargs
+        @param priority: the observer priority responses are handled with
+        @param timeout: seconds after which the request is dropped
+        @param onTimeout: called when the request times out
+        @param once: drop the request after the first response
+        @param group: match the id of a stanza group element (see
+        L{NS_XMPP_STANZA_GROUP}) instead of the stanza id
+        @param name: only responses with this element name will match
+        @param stype: only responses with this type will match
+        @param args: additional positional arguments for callback
+        @param kwargs: additional keyword arguments for callback
+        @return: the pending request, to be used with L{remove}
+        """
+        if priority not in self._priorities:
+            self._priorities.add(priority)
+            self.xmlstream.addObserver('/*', self._onStanza, priority, level=priority)
+
+        key = (group, stanzaId)
+        request = _PendingRequest(key, callback, args, kwargs or {}, priority, once, name, stype, onTimeout)
+        try:
+            self.pending[key].append(request)
+        except KeyError:
+            self.pending[key] = [request]
+
+        self._count += 1
+        if group:
+            self._groups += 1
+
+        if timeout is not None:
+            request.timeout = reactor.callLater(timeout, self._expired, request)
+        return request
+
+    def cancel(self, stanzaId, group=False):
+        """Drop all requests waiting for the given id."""
+        requests = self.pending.get((group, stanzaId))
+        if requests:
+            for request in list(requests):
+                self.remove(request)
+
+    def remove(self, request):
+        """Drop a pending request."""
+        try:
+            requests = self.pending[request.key]
+            requests.remove(request)
+        except (KeyError, ValueError):
+            return
+
+        if not requests:
+            del self.pending[request.key]
+
+        self._count -= 1
+        if request.key[0]:
+            self._groups -= 1
+
+        if request.timeout is not None:
+            if request.timeout.active():
+                request.timeout.cancel()
+            request.timeout = None
+
+    def _expired(self, request):
+        request.timeout = None
+        self.remove(request)
+        self.timeouts += 1
+        if request.onTimeout:
+            request.onTimeout()
+
+    def _onStanza(self, stanza, level):
+        stanzaId = stanza.getAttribute('id')
+        if stanzaId is not None:
+            requests = self.pending.get((False, stanzaId))
+            if requests:
+                self._dispatch(requests, stanza, level)
+
+        if self._groups:
+            for child in stanza.elements():
+                if child.name == 'group' and child.hasAttribute('id'):
+                    requests = self.pending.get((True, child['id']))
+                    if requests:
+                        self._dispatch(requests, stanza, level)
+
+    def _dispatch(self, requests, stanza, level):
+        for request in list(requests):
+            if request.priority != level or \
+                    (request.name and request.name != stanza.name) or \
+                    (request.stype and request.stype != stanza.getAttribute('type')):
+                continue
+
+            if request.once:
+                self.remove(request)
+            self.responses += 1
+            request.callback(stanza, *request.args, **request.kwargs)
+
+
 class StreamManager(xmlstream.XMPPHandlerCollection):
     """
     Business logic representing a managed XMPP connection.
@@ -600,6 +991,8 @@ class StreamManager(xmlstream.XMPPHandlerCollection):
 
     @ivar xmlstream: currently managed XML stream
     @type xmlstream: L{XmlStream}
+    @ivar correlator: responses to requests sent through the stream
+    @type correlator: L{StanzaCorrelator}
     @ivar logTraffic: if true, log all traffic.
     @type logTraffic: C{bool}
     @ivar _initialized: Whether the stream represented by L{xmlstream} has
@@ -617,6 +1010,7 @@ class StreamManager(xmlstream.XMPPHandlerCollection):
         self.xmlstream = None
         self._packetQueue = []
         self._initialized = False
+        self.correlator = StanzaCorrelator(xs)
 
         xs.addObserver(xmlstream.STREAM_CONNECTED_EVENT, self._connected)
         xs.addObserver(xmlstream.STREAM_AUTHD_EVENT, self._authd)
@@ -732,12 +1126,84 @@ class StreamManager(xmlstream.XMPPHandlerCollection):
 
 
 class SocketComponent(component.Component):
+
+    """Seconds between statistics dumps to the debug log."""
+    STATS_INTERVAL = 300
+
     def __init__(self, socket, host, port, jid, password):
         component.Component.__init__(self, host, port, jid, password)
+        self.factory.protocol = XmlStream
         self.socket = socket
+        self.correlator = None
+        self._stats_call = None
+
+    def startService(self):
+        component.Component.startService(self)
+        self._stats_call = task.LoopingCall(self.log_stats)
+        self._stats_call.start(self.STATS_INTERVAL, now=False)
+
+    def stopService(self):
+        if self._stats_call and self._stats_call.running:
+            self._stats_call.stop()
+        self._stats_call = None
+        component.Component.stopService(self)
+
+    def stats(self):
+        """Returns metrics about the component: {subsystem: {name: value}}."""
+        stats = {}
+        if self.correlator is not None:
+            stats['correlator'] = self.correlator.stats()
+        return stats
+
+    def log_stats(self):
+        for name, values in sorted(self.stats().iteritems()):
+            log.debug("%s stats: %s" % (name, ', '.join('%s=%s' % item for item in sorted(values.iteritems()))))
 
     def _getConnection(self):
         if self.socket:
             return reactor.connectUNIX(self.socket, self.factory)
         else:
             return reactor.connectTCP(self.host, self.port, self.factory)
+
+    def _authd(self, xs):
+        component.Component._authd(self, xs)
+        # responses to our requests
+        self.correlator = StanzaCorrelator(xs)
+        # route announcements from the router
+        xs.addObserver('/routes', self.onRoutes, 1000)
+
+    def onRoutes(self, stanza):
+        """
+        Expands a route announcement from the router into the equivalent
+        component presence stanzas and dispatches them to our stream.
+        """
+        stanza.consumed = True
+        for route in stanza.elements(uri=stanza.uri, name='route'):
+            presence = domish.Element((component.NS_COMPONENT_ACCEPT, 'presence'))
+            presence['from'] = route['name']
+            presence['to'] = route['to']
+            if route.getAttribute('type') == 'unavailable':
+                presence['type'] = 'unavailable'
+            self.xmlstream.dispatch(presence)
+
+    def multicast(self, stanza, recipients):
+        """
+        Send a single copy of stanza to the router, asking it to deliver it to
+        all the given recipients.
+        @param stanza: the stanza to be delivered; its to attribute is ignored
+        @type stanza: L{domish.Element}
+        @param recipients: list of JIDs, or (JID, stanza id) tuples to deliver
+        each copy with a different id
+        """
+        envelope = domish.Element((None, 'multicast'))
+        for rcpt in recipients:
+            address = envelope.addElement((None, 'address'))
+            if isinstance(rcpt, tuple):
+                address['jid'], stanzaId = rcpt
+                if stanzaId:
+                    address['id'] = stanzaId
+            else:
+                address['jid'] = rcpt
+
+        envelope.addChild(stanza)
+        component.Component.send(self, envelope)
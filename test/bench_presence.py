@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Memory footprint of the resolver presence cache."""
+
+import sys
+import gc
+import resource
+
+from twisted.words.xish import domish
+
+from kontalk.xmppserver.component.resolver import PresenceStub
+from kontalk.xmppserver import xmlstream2
+
+
+def presence(userid):
+    p = domish.Element((None, 'presence'))
+    p['from'] = '%s@prime.kontalk.net/resource' % (userid, )
+    p.addElement((None, 'show'), content='away')
+    p.addElement((None, 'status'), content=u'Hey there! I am using Kontalk.')
+    p.addElement((None, 'priority'), content='0')
+    d = p.addElement((xmlstream2.NS_XMPP_DELAY, 'delay'))
+    d['stamp'] = '2014-02-03T04:05:06Z'
+    return p
+
+
+def main(count=100000):
+    gc.collect()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    cache = {}
+    for i in xrange(count):
+        userid = '%040x' % (i, )
+        cache[userid] = PresenceStub.fromElement(presence(userid))
+    gc.collect()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+
+    print "users: %d" % (count, )
+    print "max RSS per million users: %d MB" % (rss * 1000000 / count / 1024, )
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
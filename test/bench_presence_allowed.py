@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Presence authorization checks per second."""
+
+import sys
+import time
+
+from twisted.words.protocols.jabber import jid
+
+from kontalk.xmppserver import keyring
+from kontalk.xmppserver.component import resolver
+
+
+class FakeKeyring(object):
+
+    def __init__(self, servers):
+        self._list = dict(('%040X' % (i, ), host) for i, host in enumerate(servers))
+        self.index = keyring.ServerIndex(self._list, 1)
+
+    def hostlist(self):
+        return self.index.hosts
+
+
+def main(users=10000, checks=1000000):
+    inst = resolver.Resolver.__new__(resolver.Resolver)
+    inst.network = 'kontalk.net'
+    inst.keyring = FakeKeyring(['prime.kontalk.net', 'beta.kontalk.net', 'gamma.kontalk.net'])
+    inst.cache = resolver.JIDCache()
+    inst.whitelists = {}
+    inst.blacklists = {}
+    inst._network_hosts = {}
+    inst._network_hosts_version = None
+
+    userids = ['user%d' % (i, ) for i in xrange(users)]
+    for i, userid in enumerate(userids):
+        inst.cache.presence_cache[userid] = object()
+        # half of the users have a whitelist
+        if i % 2:
+            inst.whitelists[userid] = set(userids[j % users] + '@kontalk.net' for j in xrange(i, i + 70, 7))
+
+    # senders come from every server, recipients are network JIDs
+    hosts = ['c2s.prime.kontalk.net', 'c2s.beta.kontalk.net', 'kontalk.net']
+    pairs = [(jid.internJID('%s@%s/res' % (userids[(i * 7) % users], hosts[i % 3])),
+        jid.internJID('%s@kontalk.net' % (userids[i % users], )))
+        for i in xrange(users)]
+    pairs = (pairs * (checks / users + 1))[:checks]
+
+    allowed = inst.is_presence_allowed
+    start = time.time()
+    for jid_from, jid_to in pairs:
+        allowed(jid_from, jid_to)
+    elapsed = time.time() - start
+    print "is_presence_allowed: %.0f checks/s (%.2f us per check)" % (checks / elapsed, elapsed * 1e6 / checks)
+
+    if hasattr(inst, 'is_presence_allowed_batch'):
+        start = time.time()
+        inst.is_presence_allowed_batch(pairs)
+        elapsed = time.time() - start
+        print "is_presence_allowed_batch: %.0f checks/s (%.2f us per check)" % (checks / elapsed, elapsed * 1e6 / checks)
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Memory usage and load time of persisted privacy lists."""
+
+import sys
+import time
+import hashlib
+import resource
+
+from kontalk.xmppserver import storage
+from kontalk.xmppserver.component import resolver
+
+
+def userid(i):
+    return hashlib.sha1(str(i)).hexdigest()
+
+
+def chunks(users, per_user, chunk):
+    """Generates privacy list rows as returned by the database, in chunks."""
+    rows = []
+    for i in xrange(users):
+        uid = userid(i)
+        for j in xrange(per_user):
+            # contacts are other users of the network
+            target = userid((i + j * 7919 + 1) % users) + '@kontalk.net'
+            # one entry out of 10 is a blacklist entry
+            list_type = resolver.Resolver.BLACKLIST if j == 0 else resolver.Resolver.WHITELIST
+            rows.append((uid, list_type, unicode(target)))
+            if len(rows) == chunk:
+                yield rows
+                rows = []
+    if rows:
+        yield rows
+
+
+def main(entries=10000000, per_user=10):
+    users = entries / per_user
+    inst = resolver.Resolver.__new__(resolver.Resolver)
+    inst.whitelists = {}
+    inst.blacklists = {}
+    inst.privacydb = storage.MySQLPrivacyListStorage()
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    elapsed = 0
+    for rows in chunks(users, per_user, storage.MySQLPrivacyListStorage.LOAD_CHUNK):
+        start = time.time()
+        inst._load_privacy_lists(rows)
+        elapsed += time.time() - start
+    del rows
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+
+    count = sum(len(v) for v in inst.whitelists.itervalues()) + \
+        sum(len(v) for v in inst.blacklists.itervalues())
+    print "entries: %d (%d users)" % (count, users)
+    print "load time: %.1f s (%.0f entries/s)" % (elapsed, count / elapsed)
+    print "memory (max RSS): %d MB (%d bytes per entry)" % (rss / 1024, rss * 1024 / count)
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
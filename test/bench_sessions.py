@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Memory footprint of idle authenticated client sessions."""
+
+import sys
+import gc
+import types
+import resource
+
+from twisted.internet import reactor
+from twisted.test import proto_helpers
+from twisted.words.protocols.jabber import jid, xmlstream
+
+from kontalk.xmppserver import xmlstream2
+from kontalk.xmppserver.component import sm
+
+
+class FakeRouter(object):
+
+    logTraffic = False
+    push_manager = None
+    registration = None
+    config = {}
+
+    def upload_enabled(self):
+        return False
+
+
+class FakeTransport(proto_helpers.StringTransport):
+
+    def getPeerCertificate(self):
+        return None
+
+
+class FakeFactory(object):
+
+    def connectionInitialized(self, xs):
+        pass
+
+    def connectionLost(self, xs, reason):
+        pass
+
+
+SHARED_TYPES = (type, types.ClassType, types.ModuleType, types.FunctionType,
+    types.BuiltinFunctionType, types.CodeType)
+
+
+def connect(router, factory, userid):
+    xs = xmlstream2.XmlStream(xmlstream.Authenticator())
+    xs.manager = sm.C2SManager(xs, factory, router, 'kontalk.net', 'prime.kontalk.net')
+    xs.makeConnection(FakeTransport())
+    xs.otherEntity = jid.JID('%s@kontalk.net/bench' % (userid, ))
+    xs.dispatch(xs, xmlstream.STREAM_AUTHD_EVENT)
+    return xs
+
+
+def session_size(xs, shared):
+    """Sums the size of all objects reachable only from a session."""
+    seen = set(id(o) for o in shared)
+    stack = [xs]
+    size = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, SHARED_TYPES):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return size
+
+
+def main(count=10000):
+    router = FakeRouter()
+    factory = FakeFactory()
+
+    gc.collect()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    streams = [connect(router, factory, 'user%d' % (i, )) for i in xrange(count)]
+    gc.collect()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+
+    # objects shared by all sessions
+    shared = [router, factory, reactor]
+    table = getattr(streams[0].manager, 'table', None)
+    if table:
+        shared.append(table)
+        for h in table.handlers:
+            shared.append(h)
+            shared.extend(vars(h).values())
+    size = session_size(streams[-1], shared + [streams[0]])
+
+    print "sessions: %d" % (count, )
+    print "bytes per idle session (object graph): %d" % (size, )
+    print "bytes per idle session (max RSS): %d" % (rss * 1024 / count, )
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
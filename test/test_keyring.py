@@ -0,0 +1,394 @@
+import unittest
+import struct
+import threading
+
+import gpgme
+from OpenSSL import crypto
+from pyasn1.codec.der import decoder
+from twisted.internet import defer
+
+from kontalk.xmppserver import keyring
+
+
+class FakeNetworkStorage(object):
+    """A server list kept in memory."""
+
+    def __init__(self, servers):
+        self.servers = servers
+
+    def get_list(self):
+        return dict(self.servers)
+
+
+class TestServerIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeNetworkStorage({'A' * 40: 'prime.kontalk.net', 'B' * 40: 'beta.kontalk.net'})
+        self.keyring = keyring.Keyring(self.db, 'A' * 40, 'kontalk.net', 'prime.kontalk.net', True)
+
+    def testIndex(self):
+        """Tests the server index reflects the server list."""
+        index = self.keyring.index
+        self.assertEqual(index.hosts, frozenset(['prime.kontalk.net', 'beta.kontalk.net']))
+        self.assertEqual(index.fingerprints, frozenset(['A' * 40, 'B' * 40]))
+        self.assertEqual(index.host_fingerprints['beta.kontalk.net'], frozenset(['B' * 40]))
+        self.assertIs(self.keyring.hostlist(), index.hosts)
+        self.assertEqual(len(self.keyring), 2)
+
+    def testReload(self):
+        """Tests a new index is built when the server list is reloaded."""
+        index = self.keyring.index
+        self.db.servers = {'C' * 40: 'gamma.kontalk.net'}
+        self.keyring._reload()
+
+        self.assertIsNot(self.keyring.index, index)
+        self.assertGreater(self.keyring.index.version, index.version)
+        self.assertEqual(self.keyring.hostlist(), frozenset(['gamma.kontalk.net']))
+        self.assertNotIn('A' * 40, self.keyring.index.fingerprints)
+        # old index is unchanged
+        self.assertIn('beta.kontalk.net', index.hosts)
+
+    def testRollover(self):
+        """Tests hosts with more than one key."""
+        self.db.servers['C' * 40] = 'beta.kontalk.net'
+        self.keyring._reload()
+        index = self.keyring.index
+        self.assertEqual(index.hosts, frozenset(['prime.kontalk.net', 'beta.kontalk.net']))
+        self.assertEqual(index.host_fingerprints['beta.kontalk.net'], frozenset(['B' * 40, 'C' * 40]))
+        self.assertEqual(index.host_fingerprints['prime.kontalk.net'], frozenset(['A' * 40]))
+
+    def testPrivilege(self):
+        """Tests fingerprints not in the server list have no privileges."""
+        self.assertTrue(self.keyring.has_privilege('A' * 40, 'token'))
+        self.assertFalse(self.keyring.has_privilege('C' * 40, 'token'))
+
+
+class FakeThreads(object):
+    """Collects operations instead of running them in threads."""
+
+    def __init__(self):
+        self.calls = []
+
+    def deferToThreadPool(self, reactor, pool, f, *args):
+        d = defer.Deferred()
+        self.calls.append((d, f, args))
+        return d
+
+
+class TestWorkers(unittest.TestCase):
+
+    def setUp(self):
+        db = FakeNetworkStorage({'A' * 40: 'prime.kontalk.net', 'B' * 40: 'beta.kontalk.net'})
+        self.keyring = keyring.Keyring(db, 'A' * 40, 'kontalk.net', 'prime.kontalk.net', True)
+        self.threads = keyring.threads
+        keyring.threads = FakeThreads()
+
+    def tearDown(self):
+        keyring.threads = self.threads
+        if self.keyring._pool:
+            self.keyring._pool.stop()
+
+    def testQueue(self):
+        """Tests operations are run in the worker pool."""
+        calls = keyring.threads.calls
+        token = []
+        self.keyring.check_token('token').addCallback(token.append)
+        self.keyring.check_user_key('keydata', 'user1')
+        self.assertEqual([(f, args) for d, f, args in calls], [
+            (self.keyring._check_token, ('token', )),
+            (self.keyring._check_user_key, ('keydata', 'user1')),
+        ])
+        self.assertEqual(self.keyring.stats()['queued'], 2)
+
+        calls[0][0].callback(('user1', 'A' * 40))
+        self.assertEqual(token, ['user1'])
+        self.assertEqual(self.keyring.stats()['queued'], 1)
+        self.assertEqual(self.keyring.stats()['completed'], 1)
+
+        # fingerprint cache is updated on the reactor thread
+        self.assertRaises(keyring.KeyNotFoundException, self.keyring.get_fingerprint, 'user1')
+        calls[1][0].callback('C' * 40)
+        self.assertEqual(self.keyring.get_fingerprint('user1'), 'C' * 40)
+        self.assertEqual(self.keyring.stats()['queued'], 0)
+
+    def testContext(self):
+        """Tests every thread has its own gpgme context."""
+        contexts = []
+        worker = threading.Thread(target=lambda: contexts.append(self.keyring.ctx))
+        worker.start()
+        worker.join()
+        self.assertIs(self.keyring.ctx, self.keyring.ctx)
+        self.assertIsNot(contexts[0], self.keyring.ctx)
+
+    def testTokenCache(self):
+        """Tests verified tokens are not verified again."""
+        calls = keyring.threads.calls
+        result = []
+        self.keyring.check_token('token1').addCallback(result.append)
+        calls[-1][0].callback(('user1', 'A' * 40))
+        self.keyring.check_token('token2').addCallback(result.append)
+        calls[-1][0].callback(('user2', 'B' * 40))
+        # invalid tokens are not remembered
+        self.keyring.check_token('token3').addCallback(result.append)
+        calls[-1][0].callback(None)
+        self.assertEqual(len(calls), 3)
+
+        self.keyring.check_token('token1').addCallback(result.append)
+        self.keyring.check_token('token3').addCallback(result.append)
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(result, ['user1', 'user2', None, 'user1'])
+        self.assertEqual(self.keyring.token_hits, 1)
+
+        # expired token
+        self.keyring.TOKEN_CACHE_TTL = -1
+        self.keyring.check_token('token4')
+        calls[-1][0].callback(('user4', 'A' * 40))
+        self.keyring.check_token('token4')
+        self.assertEqual(len(calls), 6)
+
+        # server not trusted anymore
+        self.keyring._db.servers = {'A' * 40: 'prime.kontalk.net'}
+        self.keyring._reload()
+        self.assertEqual([v[0] for v in self.keyring._tokens.values()], ['user1'])
+        self.keyring._db.servers = {'C' * 40: 'gamma.kontalk.net'}
+        self.keyring._reload()
+        # tokens signed by us are still valid
+        self.assertEqual([v[0] for v in self.keyring._tokens.values()], ['user1'])
+
+    def testKeyCache(self):
+        """Tests exported keys are cached until imported again."""
+        calls = keyring.threads.calls
+        self.keyring._local.ctx = FakeContext([])
+        result = []
+        self.keyring.get_key_uri('user1', '1' * 40).addCallback(result.append)
+        calls[-1][0].callback(('keydata', 'data:application/pgp-keys;base64,a2V5ZGF0YQ=='))
+        self.keyring.get_key('user1', '1' * 40).addCallback(result.append)
+        self.assertEqual(result, ['data:application/pgp-keys;base64,a2V5ZGF0YQ==', 'keydata'])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.keyring.key_hits, 1)
+
+        # key not found is not cached
+        self.keyring.get_key('user2', '2' * 40).addCallback(result.append)
+        calls[-1][0].callback(None)
+        self.assertIs(result[-1], None)
+        self.keyring.get_key('user2', '2' * 40)
+        self.assertEqual(len(calls), 3)
+
+        # key imported again
+        self.keyring._index_key(FakeKey('1' * 40, 'user1@kontalk.net'))
+        self.keyring.get_key('user1', '1' * 40)
+        self.assertEqual(len(calls), 4)
+
+        self.keyring.key_cache_size = 1
+        calls[-1][0].callback(('keydata1', 'uri1'))
+        calls[-2][0].callback(('keydata2', 'uri2'))
+        self.assertEqual(self.keyring._exported.keys(), ['2' * 40])
+
+        # key imported again while exporting
+        self.keyring.key_cache_size = 10
+        self.keyring.get_key_uri('user1', '1' * 40).addCallback(result.append)
+        self.keyring._index_key(FakeKey('1' * 40, 'user1@kontalk.net'))
+        calls[-1][0].callback(('stale', 'stale uri'))
+        self.assertEqual(result[-1], 'stale uri')
+        self.assertNotIn('1' * 40, self.keyring._exported)
+
+
+class FakeSubkey(object):
+
+    def __init__(self, fpr):
+        self.fpr = fpr
+        self.keyid = fpr[-16:]
+
+
+class FakeSignature(object):
+
+    def __init__(self, fpr):
+        self.keyid = fpr[-16:]
+
+
+class FakeUid(object):
+
+    def __init__(self, email, signers, revoked=False):
+        self.email = email
+        self.comment = None
+        self.revoked = revoked
+        self.signatures = [FakeSignature(fpr) for fpr in signers]
+
+
+class FakeKey(object):
+
+    def __init__(self, fpr, email, signers=(), revoked=False):
+        self.subkeys = [FakeSubkey(fpr)]
+        self.uids = [FakeUid(email, (fpr, ) + tuple(signers))]
+        self.revoked = revoked
+
+
+class FakeImportResult(object):
+
+    def __init__(self, fpr):
+        self.imports = [(fpr, None, 0)]
+        self.imported = 1
+        self.unchanged = 0
+
+
+class FakeContext(object):
+    """A keyring in memory. Imported key data is the key fingerprint."""
+
+    def __init__(self, keys):
+        self.keys = {}
+        for key in keys:
+            self.add(key)
+        self.lookups = 0
+
+    def add(self, key):
+        self.keys[key.subkeys[0].fpr] = key
+        self.keys[key.subkeys[0].keyid] = key
+
+    def get_key(self, fpr, secret=False):
+        self.lookups += 1
+        try:
+            return self.keys[fpr]
+        except KeyError:
+            raise gpgme.GpgmeError()
+
+    def import_(self, data):
+        return FakeImportResult(data.read())
+
+
+class TestKeyIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeNetworkStorage({'A' * 40: 'prime.kontalk.net', 'B' * 40: 'beta.kontalk.net', 'C' * 40: 'gamma.kontalk.net'})
+        self.keyring = keyring.Keyring(self.db, 'A' * 40, 'kontalk.net', 'prime.kontalk.net', True)
+        self.ctx = self.keyring._local.ctx = FakeContext([
+            FakeKey('A' * 40, 'prime.kontalk.net', ['B' * 40]),
+            # we trust B, C trusts B
+            FakeKey('B' * 40, 'beta.kontalk.net', ['A' * 40, 'C' * 40]),
+            FakeKey('C' * 40, 'gamma.kontalk.net'),
+            FakeKey('D' * 40, 'delta.kontalk.net', revoked=True),
+        ])
+
+    def user(self, userid, signer, fpr):
+        self.ctx.add(FakeKey(fpr, '%s@kontalk.net' % (userid, ), [signer]))
+        return self.keyring._check_user_key(fpr, userid)
+
+    def testTrustMatrix(self):
+        """Tests server trust is computed once per server list."""
+        self.assertEqual(sorted(self.keyring.get_server_trust('B' * 40)), ['A' * 40, 'C' * 40])
+        self.assertEqual(self.keyring.get_server_trust('C' * 40), [])
+        self.assertEqual(self.keyring.get_server_trust('A' * 40), ['B' * 40])
+
+        lookups = self.ctx.lookups
+        self.assertEqual(self.keyring.get_server_trust('B' * 40), self.keyring.get_server_trust('B' * 40))
+        self.assertEqual(self.ctx.lookups, lookups)
+
+        # C is not a server anymore
+        del self.db.servers['C' * 40]
+        self.keyring._reload()
+        self.assertEqual(self.keyring.get_server_trust('B' * 40), ['A' * 40])
+
+    def testCheckUserKey(self):
+        """Tests user key checks use the key index."""
+        # signed by us
+        self.assertEqual(self.user('user1', 'A' * 40, '1' * 40), '1' * 40)
+        # signed by a server we trust
+        self.assertEqual(self.user('user2', 'B' * 40, '2' * 40), '2' * 40)
+        # signed by a server we don't trust
+        self.assertIsNone(self.user('user3', 'C' * 40, '3' * 40))
+        # signed by a revoked key
+        self.assertIsNone(self.user('user4', 'D' * 40, '4' * 40))
+        # uid not matching
+        self.ctx.add(FakeKey('5' * 40, 'user5@kontalk.net', ['A' * 40]))
+        self.assertIsNone(self.keyring._check_user_key('5' * 40, 'user6'))
+
+        # one lookup for the user key only
+        lookups = self.ctx.lookups
+        self.assertEqual(self.user('user7', 'B' * 40, '7' * 40), '7' * 40)
+        self.assertEqual(self.ctx.lookups, lookups + 1)
+
+        info = self.keyring._keys['7' * 40]
+        self.assertEqual(info.uids[0].email, 'user7@kontalk.net')
+        self.assertEqual(info.uids[0].signers, frozenset(['7' * 40, 'B' * 40]))
+
+    def testUnknownSigner(self):
+        """Tests signer keys not in the keyring are not looked up again."""
+        self.assertEqual(self.user('user1', 'E' * 40, '1' * 40), None)
+        lookups = self.ctx.lookups
+        self.assertIsNone(self.keyring._signer('E' * 16))
+        self.assertEqual(self.ctx.lookups, lookups)
+
+        # server list changed: look it up again
+        self.ctx.add(FakeKey('E' * 40, 'epsilon.kontalk.net'))
+        self.db.servers['E' * 40] = 'epsilon.kontalk.net'
+        self.keyring._reload()
+        self.assertEqual(self.keyring._signer('E' * 16), 'E' * 40)
+
+    def testRevoked(self):
+        """Tests imported keys replace previous metadata."""
+        self.assertEqual(self.user('user1', 'B' * 40, '1' * 40), '1' * 40)
+        self.ctx.add(FakeKey('B' * 40, 'beta.kontalk.net', ['A' * 40], revoked=True))
+        self.keyring._import_key('B' * 40)
+        self.assertTrue(self.keyring._keys['B' * 40].revoked)
+        self.assertIsNone(self.keyring._check_user_key('1' * 40, 'user1'))
+
+
+def mpi(n):
+    data = ('%x' % (n, ))
+    data = ('0' * (len(data) % 2) + data).decode('hex')
+    return struct.pack('>H', n.bit_length()) + data
+
+
+def openpgp_publickey(pkey):
+    """Builds an OpenPGP public key packet for an RSA key."""
+    key = decoder.decode(crypto.dump_privatekey(crypto.FILETYPE_ASN1, pkey))[0]
+    body = struct.pack('>BIB', 4, 0, 1) + mpi(long(key[1])) + mpi(long(key[2]))
+    # old format packet, 2 bytes length
+    return struct.pack('>BH', 0x99, len(body)) + body
+
+
+class TestVerifyCertificate(unittest.TestCase):
+
+    def setUp(self):
+        self.extension = keyring.get_pgp_publickey_extension
+        keyring._certificates.clear()
+
+    def tearDown(self):
+        keyring.get_pgp_publickey_extension = self.extension
+        keyring._certificates.clear()
+
+    def certificate(self, pkey):
+        cert = crypto.X509()
+        cert.get_subject().CN = 'user@kontalk.net'
+        cert.set_serial_number(1)
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(3600)
+        cert.set_issuer(cert.get_subject())
+        cert.set_pubkey(pkey)
+        cert.sign(pkey, 'sha256')
+        return cert
+
+    def testVerify(self):
+        """Tests public keys are compared in-process and results cached."""
+        pkey, other = crypto.PKey(), crypto.PKey()
+        pkey.generate_key(crypto.TYPE_RSA, 1024)
+        other.generate_key(crypto.TYPE_RSA, 1024)
+        cert = self.certificate(pkey)
+        self.assertEqual(keyring.openpgp_rsa_publickey(openpgp_publickey(pkey)),
+            keyring.x509_rsa_publickey(cert))
+
+        extensions = {cert.get_serial_number(): openpgp_publickey(pkey)}
+        keyring.get_pgp_publickey_extension = lambda c: extensions[c.get_serial_number()]
+        self.assertTrue(keyring.verify_certificate(cert))
+
+        # result is cached
+        extensions[1] = openpgp_publickey(other)
+        self.assertTrue(keyring.verify_certificate(cert))
+
+        # key not matching
+        keyring._certificates.clear()
+        self.assertFalse(keyring.verify_certificate(cert))
+        self.assertEqual(len(keyring._certificates), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from twisted.internet import defer
+from twisted.words.protocols.jabber import jid, xmlstream
+from twisted.words.xish import domish
+
+from kontalk.xmppserver.component.resolver import PresenceStub, JIDCache
+from kontalk.xmppserver import xmlstream2
+
+
+def presence(sender, ptype=None, show=None, status=None, priority=None, stamp=None):
+    p = domish.Element((None, 'presence'))
+    p['from'] = sender
+    if ptype:
+        p['type'] = ptype
+    if show:
+        p.addElement((None, 'show'), content=show)
+    if status:
+        p.addElement((None, 'status'), content=status)
+    if priority is not None:
+        p.addElement((None, 'priority'), content=str(priority))
+    if stamp:
+        d = p.addElement((xmlstream2.NS_XMPP_DELAY, 'delay'))
+        d['stamp'] = stamp
+    return p
+
+
+class TestPresenceStub(unittest.TestCase):
+
+    def testStamp(self):
+        self.assertEqual(xmlstream2.parse_stamp('2014-02-03T04:05:06Z'), 1391400306)
+        self.assertEqual(xmlstream2.format_stamp(1391400306), '2014-02-03T04:05:06Z')
+        self.assertIsNone(xmlstream2.parse_stamp('2014-02-03 04:05:06'))
+        self.assertIsNone(xmlstream2.parse_stamp(None))
+
+    def testPush(self):
+        """Tests available presences and resource JIDs."""
+        stub = PresenceStub.fromElement(presence('user@prime.kontalk.net/a', show='away', status=u'è qui', priority=5))
+        stub.push(presence('user@prime.kontalk.net/b', show='invalid'))
+        self.assertTrue(stub.available())
+        self.assertEqual(stub.jid, jid.JID('user@prime.kontalk.net'))
+        self.assertEqual(sorted(j.full() for j in stub.jids()),
+            ['user@prime.kontalk.net/a', 'user@prime.kontalk.net/b'])
+        # resource JIDs are cached
+        self.assertIs(stub.jids()[0], stub.jids()[0])
+        self.assertIs(stub.show, None)
+
+        elements = dict((e['from'], e) for e in stub.presence())
+        a = elements['user@prime.kontalk.net/a']
+        self.assertEqual(str(a.show), 'away')
+        self.assertEqual(unicode(a.status), u'è qui')
+        self.assertEqual(str(a.priority), '5')
+        self.assertFalse(a.hasAttribute('type'))
+        self.assertIsNone(elements['user@prime.kontalk.net/b'].show)
+        # presences are generated every time
+        self.assertIsNot(stub.presence()[0], stub.presence()[0])
+
+    def testUnavailable(self):
+        """Tests unavailable presences."""
+        stub = PresenceStub.fromElement(presence('user@prime.kontalk.net/a'))
+        self.assertEqual(stub.pop('a')['from'], 'user@prime.kontalk.net/a')
+        self.assertFalse(stub.available())
+        self.assertEqual(stub.jids(), [])
+        self.assertEqual(stub.type, 'unavailable')
+        self.assertIsNotNone(stub.delay)
+        self.assertIsNone(stub.pop('a'))
+
+        stub.delay = 1391400306
+        # older presence
+        stub.update(presence('user@prime.kontalk.net', 'unavailable', status='old', stamp='2014-02-03T04:05:05Z'))
+        self.assertIsNone(stub.status)
+        stub.update(presence('user@prime.kontalk.net', 'unavailable', status='new', stamp='2014-02-03T04:05:07Z'))
+        self.assertEqual(stub.status, 'new')
+
+        p = stub.presence()[0]
+        self.assertEqual(p['type'], 'unavailable')
+        self.assertEqual(p['from'], 'user@prime.kontalk.net')
+        self.assertEqual(p.delay['stamp'], '2014-02-03T04:05:07Z')
+
+
+class FakeKeyring(object):
+
+    def hostlist(self):
+        return ('prime.kontalk.net', 'beta.kontalk.net')
+
+
+class FakeResolver(object):
+
+    logTraffic = False
+    keyring = FakeKeyring()
+    network = 'kontalk.net'
+
+    def __init__(self):
+        self.xmlstream = xmlstream2.XmlStream(xmlstream.Authenticator())
+        self.correlator = xmlstream2.StanzaCorrelator(self.xmlstream)
+        self.multicasts = []
+
+    def translate_sender(self, stanza):
+        stanza['from'] = 'resolver.prime.kontalk.net'
+
+    def multicast(self, stanza, recipients):
+        self.multicasts.append((stanza, recipients))
+
+
+class TestJIDCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = JIDCache()
+        self.cache.parent = FakeResolver()
+
+    def testHostIndex(self):
+        """Tests users are removed from cache when their server disconnects."""
+        self.cache.onPresenceAvailable(presence('user1@c2s.prime.kontalk.net/a'))
+        self.cache.onPresenceAvailable(presence('user2@c2s.prime.kontalk.net/a'))
+        self.cache.onPresenceAvailable(presence('user3@c2s.beta.kontalk.net/a'))
+        self.cache.onPresenceUnavailable(presence('user2@c2s.prime.kontalk.net/a', 'unavailable'))
+        self.assertEqual(self.cache.host_index, {
+            'c2s.prime.kontalk.net': set(('user1', 'user2')),
+            'c2s.beta.kontalk.net': set(('user3', )),
+        })
+
+        # user moves to another server
+        self.cache.onPresenceAvailable(presence('user2@c2s.beta.kontalk.net/b'))
+        self.assertEqual(self.cache.host_index['c2s.beta.kontalk.net'], set(('user2', 'user3')))
+
+        self.cache.onPresenceUnavailable(presence('c2s.prime.kontalk.net', 'unavailable'))
+        self.assertEqual(sorted(self.cache.presence_cache.keys()), ['user2', 'user3'])
+        self.assertEqual(self.cache.host_index, {'c2s.beta.kontalk.net': set(('user2', 'user3'))})
+
+    def testFind(self):
+        """Tests concurrent network lookups share the same probe."""
+        probes = []
+        def _probe(_jid, wait_factor):
+            d = defer.Deferred()
+            probes.append((_jid, d))
+            return d
+        self.cache._probe = _probe
+
+        results = []
+        user = jid.JID('user@kontalk.net')
+        for i in range(3):
+            self.cache.find(user).addCallback(results.append)
+        self.cache.find(jid.JID('other@kontalk.net'))
+        self.assertEqual(len(probes), 2)
+
+        probes[0][1].callback([[jid.JID('user@prime.kontalk.net')]])
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0], results[2])
+        self.assertEqual(self.cache.lookups.keys(), [jid.JID('other@kontalk.net')])
+
+        # fresh result is reused
+        self.cache.find(user).addCallback(results.append)
+        self.assertEqual(len(probes), 2)
+        self.assertEqual(len(results), 4)
+
+        # stale result is not
+        self.cache.lookup_freshness = 0
+        self.cache._results.clear()
+        self.cache.find(user)
+        self.assertEqual(len(probes), 3)
+
+    def testFindCached(self):
+        """Tests cached lookup results are the same as the probe ones."""
+        probes = []
+        def _probe(_jid, wait_factor):
+            d = defer.Deferred()
+            probes.append(d)
+            return d
+        self.cache._probe = _probe
+
+        results = []
+        user = jid.JID('user@kontalk.net')
+        self.cache.find(user).addCallback(results.append)
+        probes[0].callback([None, None])
+        self.cache.unknown.clear()
+        self.cache.find(user).addCallback(results.append)
+        self.assertEqual(results, [None, None])
+        self.assertEqual(len(probes), 1)
+
+        # presence drops recent results for the user
+        self.cache.onPresenceAvailable(presence('user@prime.kontalk.net/a'))
+        self.assertEqual(self.cache._results, {})
+        self.cache.find(user)
+        self.assertEqual(len(probes), 2)
+
+    def testProbe(self):
+        """Tests network presence probes."""
+        parent = self.cache.parent
+        results = []
+        self.cache.find(jid.JID('user@kontalk.net')).addCallback(results.append)
+        probe, rcpts = parent.multicasts[0]
+        self.assertEqual(probe['type'], 'probe')
+        self.assertEqual([r[0] for r in rcpts], ['user@prime.kontalk.net', 'user@beta.kontalk.net'])
+
+        reply = presence('user@prime.kontalk.net/a')
+        reply['id'] = rcpts[0][1]
+        group = reply.addElement((xmlstream2.NS_XMPP_STANZA_GROUP, 'group'))
+        group['id'] = rcpts[0][1]
+        group['count'] = '1'
+        parent.xmlstream.dispatch(reply)
+
+        error = domish.Element((None, 'presence'), attribs={'type': 'error', 'id': rcpts[1][1]})
+        parent.xmlstream.dispatch(error)
+        self.assertEqual(results, [[[jid.JID('user@prime.kontalk.net/a')], []]])
+        self.assertEqual(len(parent.correlator), 0)
+
+    def testUnknown(self):
+        """Tests users not on the network are not looked up again."""
+        probes = []
+        def _probe(_jid, wait_factor):
+            d = defer.Deferred()
+            probes.append(d)
+            return d
+        self.cache._probe = _probe
+        self.cache.lookup_freshness = 0
+
+        user = jid.JID('user@kontalk.net')
+        self.cache.find(user)
+        probes[0].callback([[], None])
+        self.assertIn('user', self.cache.unknown)
+
+        results = []
+        self.cache.find(user).addCallback(results.append)
+        self.assertEqual(results, [None])
+        self.assertEqual(len(probes), 1)
+        self.assertEqual(self.cache.unknown_hits, 1)
+        self.assertEqual(self.cache.unknown_misses, 1)
+
+        # presence invalidates the entry
+        self.cache.onPresenceAvailable(presence('user@prime.kontalk.net/a'))
+        self.assertNotIn('user', self.cache.unknown)
+        self.cache.find(user)
+        self.assertEqual(len(probes), 2)
+
+        # expired entries
+        self.cache.set_unknown(jid.JID('other@kontalk.net'))
+        self.assertTrue(self.cache.is_unknown(jid.JID('other@kontalk.net')))
+        self.cache.unknown['other'] = 0
+        self.assertFalse(self.cache.is_unknown(jid.JID('other@kontalk.net')))
+        self.assertNotIn('other', self.cache.unknown)
+
+        # size limit
+        self.cache.unknown_size = 2
+        for userid in ('a', 'b', 'c'):
+            self.cache.set_unknown(jid.JID(userid + '@kontalk.net'))
+        self.assertEqual(self.cache.unknown.keys(), ['b', 'c'])
+        self.assertEqual(self.cache.stats()['unknown'], 2)
+
+    def testFindAll(self):
+        """Tests batched network lookups."""
+        parent = self.cache.parent
+        self.cache.onPresenceAvailable(presence('user1@c2s.prime.kontalk.net/a'))
+        users = [jid.JID('user%d@kontalk.net' % (i, )) for i in range(1, 5)]
+
+        results = []
+        self.cache.find_all(users).addCallback(results.append)
+        # one stanza for the whole network
+        self.assertEqual(len(parent.multicasts), 1)
+        iq, rcpts = parent.multicasts[0]
+        self.assertEqual([r[0] for r in rcpts], list(parent.keyring.hostlist()))
+        self.assertEqual(len(list(iq.query.elements(uri=xmlstream2.NS_PRESENCE_PROBE, name='item'))), 4)
+
+        reply = domish.Element((None, 'iq'), attribs={'type': 'result', 'id': rcpts[0][1]})
+        query = reply.addElement((xmlstream2.NS_PRESENCE_PROBE, 'query'))
+        query.addChild(presence('user2@c2s.prime.kontalk.net/b'))
+        query.addChild(presence('user3@c2s.prime.kontalk.net', 'unavailable', stamp='2014-02-03T04:05:06Z'))
+        # not requested
+        query.addChild(presence('user9@c2s.prime.kontalk.net/b'))
+        parent.xmlstream.dispatch(reply)
+        self.assertEqual(results, [])
+
+        reply = domish.Element((None, 'iq'), attribs={'type': 'result', 'id': rcpts[1][1]})
+        reply.addElement((xmlstream2.NS_PRESENCE_PROBE, 'query'))
+        parent.xmlstream.dispatch(reply)
+        self.assertEqual(results, [set(('user2', 'user3'))])
+
+        self.assertTrue(self.cache.lookup(users[1]).available())
+        self.assertFalse(self.cache.lookup(users[2]).available())
+        self.assertIsNone(self.cache.lookup(jid.JID('user9@kontalk.net')))
+        self.assertEqual(self.cache.host_index['c2s.prime.kontalk.net'], set(('user1', 'user2', 'user3')))
+        self.assertEqual(self.cache.unknown.keys(), ['user4'])
+        self.assertEqual(len(parent.correlator), 0)
+
+    def testFindAllShared(self):
+        """Tests concurrent batched lookups do not probe the same users twice."""
+        parent = self.cache.parent
+        user1, user2, user3 = [jid.JID('user%d@kontalk.net' % (i, )) for i in range(1, 4)]
+
+        first = []
+        second = []
+        self.cache.find_all([user1, user2]).addCallback(first.append)
+        self.cache.find_all([user2, user3]).addCallback(second.append)
+        self.assertEqual(len(parent.multicasts), 2)
+        iq, rcpts1 = parent.multicasts[0]
+        iq, rcpts2 = parent.multicasts[1]
+        # only user3 is probed again
+        self.assertEqual([item['jid'] for item in iq.query.elements(uri=xmlstream2.NS_PRESENCE_PROBE, name='item')],
+            ['user3@kontalk.net'])
+        self.assertEqual(sorted(self.cache.batch_lookups.keys()), ['user1', 'user2', 'user3'])
+
+        def reply(rcpts, *presences):
+            for server, stanzaId in rcpts:
+                reply = domish.Element((None, 'iq'), attribs={'type': 'result', 'id': stanzaId})
+                query = reply.addElement((xmlstream2.NS_PRESENCE_PROBE, 'query'))
+                if server == 'prime.kontalk.net':
+                    for p in presences:
+                        query.addChild(p)
+                parent.xmlstream.dispatch(reply)
+
+        reply(rcpts1, presence('user2@c2s.prime.kontalk.net/a'))
+        self.assertEqual(first, [set(('user2', ))])
+        self.assertEqual(second, [])
+        reply(rcpts2, presence('user3@c2s.prime.kontalk.net/a'))
+        self.assertEqual(second, [set(('user2', 'user3'))])
+        self.assertEqual(self.cache.batch_lookups, {})
+        self.assertEqual(self.cache.unknown.keys(), ['user1'])
+
+    def testFindAllFailure(self):
+        """Tests failures of a shared batched lookup reach all callers."""
+        lookup = defer.Deferred()
+        self.cache.batch_lookups['user1'] = lookup
+
+        errors = []
+        self.cache.find_all([jid.JID('user1@kontalk.net')]).addErrback(errors.append)
+        lookup.errback(RuntimeError('lookup failed'))
+        self.assertEqual(len(errors), 1)
+        lookup.addErrback(lambda f: None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,279 @@
+import unittest
+import demjson
+
+from twisted.internet import defer
+from twisted.words.protocols.jabber import jid
+from twisted.words.xish import domish, utility
+
+from kontalk.xmppserver.component.resolver import Resolver, PrivacyListHandler
+from kontalk.xmppserver import log, xmlstream2
+
+
+class TestPrivacyListSync(unittest.TestCase):
+
+    def setUp(self):
+        # load configuration
+        fp = open('../resolver.conf', 'r')
+        self.config = demjson.decode(fp.read(), allow_comments=True)
+        fp.close()
+        # init logging
+        log.init(self.config)
+        self.resolver = self.createResolver()
+        self.peer = self.createResolver()
+
+    def createResolver(self):
+        resolver = Resolver(self.config)
+        # collect outgoing stanzas
+        resolver.sent = []
+        resolver.send = resolver.sent.append
+        resolver.multicast = lambda stanza, rcpts: resolver.sent.append(stanza)
+        return resolver
+
+    def tearDown(self):
+        for resolver in (self.resolver, self.peer):
+            if resolver.privacydb._flush_call:
+                resolver.privacydb._flush_call.cancel()
+            if resolver._privacy_broadcast_call:
+                resolver._privacy_broadcast_call.cancel()
+
+    def handler(self, resolver):
+        return [h for h in resolver if isinstance(h, PrivacyListHandler)][0]
+
+    def sync(self, since):
+        """Transfers privacy lists from resolver to peer."""
+        chunks = list(self.resolver.privacy_sync_chunks('resolver.beta.kontalk.net', since))
+        stanzas = self.resolver.sent[-len(chunks):]
+        for iq in stanzas:
+            iq['from'] = 'resolver.beta.kontalk.net'
+            self.handler(self.peer).sync(iq)
+        return stanzas
+
+    def testVersions(self):
+        """Tests only local changes are versioned."""
+        user1, user2, user3 = [jid.JID('user%d@kontalk.net' % (i, )) for i in (1, 2, 3)]
+        self.resolver.add_whitelist(user1, user2)
+        version = self.resolver.privacy_versions['user1']
+
+        # no change, same version
+        self.resolver.add_whitelist(user1, user2)
+        self.assertEqual(self.resolver.privacy_versions['user1'], version)
+
+        self.resolver.add_blacklist(user1, user3)
+        self.assertGreater(self.resolver.privacy_versions['user1'], version)
+
+        # changes from remote resolvers
+        self.resolver.add_whitelist(user2, user1, broadcast=False)
+        self.assertIn('user1@kontalk.net', self.resolver.whitelists['user2'])
+        self.assertNotIn('user2', self.resolver.privacy_versions)
+
+    def testSync(self):
+        """Tests privacy lists are transferred in chunks and only when changed."""
+        self.resolver.PRIVACY_SYNC_CHUNK = 2
+        users = [jid.JID('user%d@kontalk.net' % (i, )) for i in range(5)]
+        for user in users[:3]:
+            self.resolver.add_whitelist(user, users[4])
+        self.resolver.add_blacklist(users[0], users[3])
+
+        stanzas = self.sync(0)
+        self.assertEqual(len(stanzas), 2)
+        self.assertIsNone(stanzas[0].sync.getAttribute('version'))
+        self.assertEqual(self.peer.whitelists, self.resolver.whitelists)
+        self.assertEqual(self.peer.blacklists, self.resolver.blacklists)
+        version = self.peer.privacy_synced['resolver.beta.kontalk.net']
+        self.assertEqual(version, self.resolver._privacy_version)
+        # remote users are not versioned on the peer
+        self.assertEqual(self.peer.privacy_versions, {})
+
+        # nothing changed
+        stanzas = self.sync(version)
+        self.assertEqual(len(stanzas), 1)
+        self.assertEqual(len(stanzas[0].sync.children), 0)
+        self.assertEqual(stanzas[0].sync['version'], str(version))
+
+        # only changed users are sent, with their whole lists
+        self.resolver.remove_blacklist(users[0], users[3])
+        stanzas = self.sync(version)
+        self.assertEqual(len(stanzas), 1)
+        user = stanzas[0].sync.firstChildElement()
+        self.assertEqual(user['jid'], 'user0@kontalk.net')
+        self.assertNotIn('user0', self.peer.blacklists)
+        self.assertEqual(self.peer.whitelists['user0'], set(('user4@kontalk.net', )))
+
+    def testWarmStart(self):
+        """Tests local changes made before a restart are still transferred."""
+        users = [jid.JID('user%d@kontalk.net' % (i, )) for i in range(3)]
+        self.resolver.add_whitelist(users[0], users[1])
+        self.resolver.add_blacklist(users[1], users[2])
+        version = self.resolver._privacy_version
+        db = self.resolver.privacydb
+        rows = [key for key, value in db._pending.iteritems() if value]
+        versions = db._versions.items()
+
+        # restart
+        db._flush_call.cancel()
+        self.resolver = self.createResolver()
+        def _loaded(unused):
+            self.resolver._privacy_loading = None
+        loading = self.resolver._privacy_loading = defer.Deferred().addCallback(_loaded)
+        self.resolver._load_privacy_lists(rows)
+        self.resolver._load_privacy_versions(versions)
+        self.assertEqual(self.resolver._privacy_version, version)
+
+        # sync requests wait for loading to complete
+        requests = []
+        def privacy_sync_chunks(peer, since):
+            requests.append(since)
+            return iter(())
+        self.resolver.privacy_sync_chunks = privacy_sync_chunks
+        self.resolver.privacy_sync('resolver.beta.kontalk.net', 0)
+        self.assertEqual(requests, [])
+        loading.callback(None)
+        self.assertEqual(requests, [0])
+        del self.resolver.privacy_sync_chunks
+
+        self.sync(0)
+        self.assertEqual(self.peer.whitelists, self.resolver.whitelists)
+        self.assertEqual(self.peer.blacklists, self.resolver.blacklists)
+        self.assertEqual(self.peer.privacy_synced['resolver.beta.kontalk.net'], version)
+
+    def testSyncWhileLoading(self):
+        """Tests privacy lists received while loading are applied afterwards."""
+        users = [jid.JID('user%d@kontalk.net' % (i, )) for i in range(3)]
+        self.resolver.add_whitelist(users[0], users[1])
+        def _loaded(unused):
+            self.peer._privacy_loading = None
+        loading = self.peer._privacy_loading = defer.Deferred().addCallback(_loaded)
+
+        self.sync(0)
+        self.assertEqual(self.peer.whitelists, {})
+        self.assertNotIn('resolver.beta.kontalk.net', self.peer.privacy_synced)
+
+        # entries loaded later must not be taken as removed
+        self.peer._load_privacy_lists([('user0', Resolver.WHITELIST, 'user2@kontalk.net')])
+        loading.callback(None)
+        self.assertEqual(self.peer.whitelists, self.resolver.whitelists)
+        self.assertEqual(self.peer.privacy_synced['resolver.beta.kontalk.net'], self.resolver._privacy_version)
+
+    def testRemoveWhileLoading(self):
+        """Tests entries removed while loading are not loaded afterwards."""
+        users = [jid.JID('user%d@kontalk.net' % (i, )) for i in range(3)]
+        db = self.resolver.privacydb
+        rows = [
+            ('user0', Resolver.WHITELIST, 'user1@kontalk.net'),
+            ('user0', Resolver.WHITELIST, 'user2@kontalk.net'),
+        ]
+
+        # loading started, user0 lists not loaded yet
+        db._removed = set()
+        self.resolver._privacy_loading = defer.Deferred()
+        self.resolver.remove_whitelist(users[0], users[1])
+        self.assertNotIn('user0', self.resolver.whitelists)
+        self.assertIn('user0', self.resolver.privacy_versions)
+
+        self.resolver._load_privacy_lists(rows)
+        self.assertEqual(self.resolver.whitelists['user0'], set(('user2@kontalk.net', )))
+        self.assertIs(db.pending('user0', Resolver.WHITELIST, 'user1@kontalk.net'), False)
+
+    def testBroadcast(self):
+        """Tests privacy list changes are broadcast in batches."""
+        handler = self.handler(self.resolver)
+        iq = domish.Element((None, 'iq'), attribs={'type': 'set', 'from': 'user0@c2s.prime.kontalk.net/res', 'id': 'allow'})
+        allow = iq.addElement((xmlstream2.NS_IQ_BLOCKING, 'allow'))
+        for i in range(1, 201):
+            allow.addElement('item', content='user%d@kontalk.net' % (i, ))
+        handler.allow(iq)
+        self.assertEqual(len(self.resolver.whitelists['user0']), 200)
+        # only the result so far
+        self.assertEqual(len(self.resolver.sent), 1)
+
+        self.resolver.add_blacklist(jid.JID('user0@kontalk.net'), jid.JID('user300@kontalk.net'))
+        self.resolver.remove_whitelist(jid.JID('user0@kontalk.net'), jid.JID('user1@kontalk.net'))
+        self.resolver.add_whitelist(jid.JID('user0@kontalk.net'), jid.JID('user1@kontalk.net'))
+        self.resolver._flush_privacy_broadcasts()
+        self.assertIs(self.resolver._privacy_broadcast_call, None)
+
+        broadcasts = self.resolver.sent[1:]
+        self.assertEqual([b.firstChildElement().name for b in broadcasts], ['allow', 'block'])
+        self.assertEqual(len(broadcasts[0].allow.children), 200)
+        self.assertEqual(broadcasts[0]['from'], 'user0@resolver.prime.kontalk.net')
+
+        # remote resolver applies the whole list at once
+        broadcasts[0]['from'] = 'user0@resolver.beta.kontalk.net'
+        self.handler(self.peer).allow(broadcasts[0])
+        self.assertEqual(self.peer.whitelists, self.resolver.whitelists)
+        # no result and no broadcast for remote changes
+        self.assertEqual(self.peer.sent, [])
+        self.assertEqual(len(self.peer._privacy_broadcasts), 0)
+
+    def testStats(self):
+        """Tests component statistics cover all subsystems."""
+        self.resolver.correlator = xmlstream2.StanzaCorrelator(utility.EventDispatcher())
+        stats = self.resolver.stats()
+        self.assertEqual(sorted(stats.keys()), ['cache', 'correlator', 'keyring'])
+        self.assertEqual(stats['correlator']['pending'], 0)
+        self.resolver.log_stats()
+
+    def testRequest(self):
+        """Tests sync requests carry the last synced version."""
+        self.resolver.privacy_synced['resolver.beta.kontalk.net'] = 1234
+        self.resolver.request_privacy_sync('resolver.beta.kontalk.net')
+        iq = self.resolver.sent[-1]
+        self.assertEqual(iq['type'], 'get')
+        self.assertEqual(iq.sync.uri, xmlstream2.NS_PRIVACY_SYNC)
+        self.assertEqual(iq.sync['since'], '1234')
+
+        # requests from local resolver are ignored
+        iq['from'] = 'resolver.prime.kontalk.net'
+        self.handler(self.peer).sync_request(iq)
+        self.assertEqual(self.peer.sent, [])
+
+
+class TestPresenceAllowed(unittest.TestCase):
+
+    def setUp(self):
+        # load configuration
+        fp = open('../resolver.conf', 'r')
+        config = demjson.decode(fp.read(), allow_comments=True)
+        fp.close()
+        log.init(config)
+        self.resolver = Resolver(config)
+        for userid in ('user1', 'user2', 'user3'):
+            self.resolver.cache.presence_cache[userid] = object()
+
+    def tearDown(self):
+        if self.resolver.privacydb._flush_call:
+            self.resolver.privacydb._flush_call.cancel()
+        if self.resolver._privacy_broadcast_call:
+            self.resolver._privacy_broadcast_call.cancel()
+
+    def testDecision(self):
+        """Tests presence decisions on local, network and foreign JIDs."""
+        J = jid.JID
+        user1, user2, user3 = [J('user%d@kontalk.net' % (i, )) for i in (1, 2, 3)]
+        self.resolver.add_whitelist(user1, user2)
+        self.resolver.add_blacklist(user1, user3)
+
+        allowed = self.resolver.is_presence_allowed
+        self.assertEqual(allowed(user2, user1), 1)
+        # server JIDs are translated to network JIDs
+        self.assertEqual(allowed(J('user2@c2s.beta.kontalk.net/res'), J('user1@c2s.prime.kontalk.net')), 1)
+        self.assertEqual(allowed(J('user3@resolver.prime.kontalk.net'), user1), -1)
+        # hosts not in the network are used unchanged
+        self.assertEqual(allowed(J('user2@c2s.example.com'), user1), 0)
+        self.assertEqual(allowed(user1, user2), 0)
+        self.assertEqual(allowed(J('user2@c2s.prime.kontalk.net'), user2), 1)
+        self.assertEqual(allowed(J('prime.kontalk.net'), user2), 1)
+        self.assertEqual(allowed(user1, J('user4@kontalk.net')), -2)
+
+        pairs = [(user2, user1), (user3, user1), (user1, user2), (user1, J('user4@kontalk.net'))]
+        self.assertEqual(self.resolver.is_presence_allowed_batch(pairs), [1, -1, 0, -2])
+
+        # server list changed
+        self.resolver.keyring._db.get_list = lambda: {'C' * 40: 'gamma.kontalk.net'}
+        self.resolver.keyring._reload()
+        self.assertEqual(allowed(J('user2@c2s.beta.kontalk.net'), user1), 0)
+        self.assertEqual(allowed(J('user2@c2s.gamma.kontalk.net'), user1), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,7 +4,7 @@ import demjson
 
 from twisted.words.protocols.jabber import jid
 
-from kontalk.xmppserver.component.resolver import Resolver
+from kontalk.xmppserver.component.resolver import Resolver, SubscriptionRegistry
 from kontalk.xmppserver import log, util
 
 class TestResolverSubscriptions(unittest.TestCase):
@@ -39,8 +39,11 @@ class TestResolverSubscriptions(unittest.TestCase):
         self.resolver.subscribe(self.resolver.translateJID(jid_from),
             self.resolver.translateJID(jid_to), gid, False)
 
-        subscriptions = { jid.JID('user2@kontalk.net') : [ jid.JID('user1@kontalk.net') ] }
-        self.assertDictEqual(self.resolver.subscriptions, subscriptions, 'Subscriptions not maching.')
+        subscriptions = { jid.JID('user2@kontalk.net') : set([ jid.JID('user1@kontalk.net') ]) }
+        self.assertDictEqual(self.resolver.subscriptions.subscribers, subscriptions, 'Subscriptions not maching.')
+        watched = { jid.JID('user1@kontalk.net') : set([ jid.JID('user2@kontalk.net') ]) }
+        self.assertDictEqual(self.resolver.subscriptions.watched, watched, 'Subscriptions not maching.')
+        self.assertEqual(self.resolver.subscriptions.edges, 1)
 
     def testUnsubscribe(self):
         # execute subscription first
@@ -52,6 +55,39 @@ class TestResolverSubscriptions(unittest.TestCase):
             self.resolver.translateJID(jid_from))
 
         self.assertEqual(len(self.resolver.subscriptions), 0, 'Subscriptions not maching.')
+        self.assertEqual(len(self.resolver.subscriptions.watched), 0, 'Subscriptions not maching.')
+        self.assertEqual(self.resolver.subscriptions.edges, 0)
+
+
+class TestSubscriptionRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = SubscriptionRegistry()
+
+    def testSubscriptions(self):
+        u1, u2, u3 = [jid.JID('user%d@kontalk.net' % (i, )) for i in (1, 2, 3)]
+        self.assertTrue(self.registry.add(u1, u2))
+        self.assertFalse(self.registry.add(u1, u2))
+        self.registry.add(u1, u3)
+        self.registry.add(u2, u3)
+        self.assertEqual(self.registry.edges, 3)
+        self.assertEqual(self.registry.max_fanout, 2)
+        self.assertEqual(self.registry.get(u1), set((u2, u3)))
+        self.assertEqual(self.registry.watched[u3], set((u1, u2)))
+
+        # unsubscribe-all
+        self.assertEqual(self.registry.remove_subscriber(u3), 2)
+        self.assertEqual(self.registry.edges, 1)
+        self.assertEqual(self.registry.max_fanout, 1)
+        self.assertNotIn(u2, self.registry)
+        self.assertNotIn(u3, self.registry.watched)
+
+        self.assertFalse(self.registry.remove(u2, u1))
+        self.assertTrue(self.registry.remove(u1, u2))
+        self.assertEqual(len(self.registry), 0)
+        self.assertEqual(self.registry.watched, {})
+        self.assertEqual(self.registry.edges, 0)
+        self.assertEqual(self.registry.max_fanout, 0)
 
 
 if __name__ == "__main__":
@@ -2,12 +2,47 @@
 import unittest
 import demjson
 
+from twisted.internet import reactor
+from twisted.test import proto_helpers
 from twisted.words.protocols.jabber import jid, xmlstream
+from twisted.words.xish import domish, utility
 
-from kontalk.xmppserver.component.router import Router
+from kontalk.xmppserver.component.router import Router, RouterXmlStream, scan_element
 from kontalk.xmppserver import log, util
 
 
+class FakeTransport(object):
+    """A transport keeping track of producers."""
+
+    def __init__(self):
+        self.producer = None
+        self.reading = True
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def pauseProducing(self):
+        self.reading = False
+
+    def resumeProducing(self):
+        self.reading = True
+
+
+class FakeStream(utility.EventDispatcher):
+    """A stream collecting everything sent to it."""
+
+    def __init__(self, transport=None):
+        utility.EventDispatcher.__init__(self)
+        self.transport = transport
+        self.sent = []
+
+    def send(self, obj):
+        self.sent.append(obj)
+
+
 class TestRouter(unittest.TestCase):
 
     def setUp(self):
@@ -44,6 +79,271 @@ class TestRouter(unittest.TestCase):
         """Tests additional name bindings."""
         pass
 
+    def testScanElement(self):
+        """Tests top-level element scanning."""
+        data = "<message to='alice@prime.kontalk.net' type=\"chat\"><body>a > b</body><x/></message><iq"
+        end, name, attrs = scan_element(data)
+        self.assertEqual(data[:end], "<message to='alice@prime.kontalk.net' type=\"chat\"><body>a > b</body><x/></message>")
+        self.assertEqual(name, 'message')
+        self.assertDictEqual(attrs, {'to': 'alice@prime.kontalk.net', 'type': 'chat'})
+
+        # nested elements with the same name
+        data = "<message to='a&apos;b@kontalk.net'><message><message/></message></message>"
+        end, name, attrs = scan_element(data)
+        self.assertEqual(end, len(data))
+        self.assertEqual(attrs['to'], "a'b@kontalk.net")
+
+        # incomplete elements
+        self.assertIsNone(scan_element("<iq"))
+        self.assertIsNone(scan_element("<iq to='kontalk.net'><query"))
+        self.assertIsNone(scan_element("<iq to='kontalk.net'><query/>"))
+
+        # unsupported markup
+        self.assertRaises(ValueError, scan_element, "<!-- comment -->")
+        self.assertRaises(ValueError, scan_element, "</stream:stream>")
+        self.assertRaises(ValueError, scan_element, "<iq><![CDATA[test]]></iq>")
+
+    def testScanResume(self):
+        """Tests scanning of elements received in pieces."""
+        data = "<message to='alice@kontalk.net'><body>test</body><x><y/>"
+        state = []
+        self.assertIsNone(scan_element(data, 0, state))
+        self.assertEqual(state[2], len(data))
+        self.assertEqual(state[3], 2)
+
+        # scan resumes from the saved state
+        data += "</x></message>"
+        end, name, attrs = scan_element(data, 0, state)
+        self.assertEqual(end, len(data))
+        self.assertEqual(name, 'message')
+        self.assertEqual(attrs, {'to': 'alice@kontalk.net'})
+
+        # partial tags are scanned again
+        data = "<message><body>test</bo"
+        state = []
+        self.assertIsNone(scan_element(data, 0, state))
+        self.assertEqual(state[2], len("<message><body>"))
+
+    def testRawStream(self):
+        """Tests pass-through scanning of stanzas split across reads."""
+        c2s = FakeStream()
+        self.router.routes['c2s.prime.kontalk.net'] = c2s
+        self.router.max_stanza_size = 100
+
+        factory = FakeStream()
+        factory.router = self.router
+        xs = RouterXmlStream(xmlstream.Authenticator())
+        xs.factory = factory
+        xs.makeConnection(proto_helpers.StringTransport())
+        # authenticated stream
+        xs._headerSent = True
+        xs._rawMode = True
+
+        data = " <message to='alice@c2s.prime.kontalk.net'><body>test</body></message>"
+        for i in range(0, len(data), 7):
+            xs.dataReceived(data[i:i+7])
+        self.assertEqual(c2s.sent, [data[1:]])
+        self.assertEqual(xs._rawBuffer, '')
+
+        # stanza too big
+        xs.dataReceived("<message to='alice@c2s.prime.kontalk.net'><body>")
+        xs.dataReceived("x" * 100)
+        self.assertTrue(xs.transport.disconnecting)
+        self.assertIn('policy-violation', xs.transport.value())
+
+    def testRouteRaw(self):
+        """Tests header-only stanza routing."""
+        c2s = FakeStream()
+        resolver = FakeStream()
+        self.router.routes['c2s.prime.kontalk.net'] = c2s
+        self.router.routes['resolver.prime.kontalk.net'] = resolver
+        self.router.private['kontalk.net'] = resolver
+
+        data = "<message to='alice@c2s.prime.kontalk.net/res'><body>test</body></message>"
+        self.assertTrue(self.router.route_raw(data, 'message', {'to': 'alice@c2s.prime.kontalk.net/res'}, resolver))
+        self.assertEqual(c2s.sent, [data])
+
+        data = "<presence to='alice@kontalk.net'/>"
+        self.assertTrue(self.router.route_raw(data, 'presence', {'to': 'alice@kontalk.net'}, c2s))
+        self.assertEqual(resolver.sent, [data])
+
+        # stanzas requiring the full parse path
+        self.assertFalse(self.router.route_raw("<presence/>", 'presence', {}, c2s))
+        self.assertFalse(self.router.route_raw("<bind name='test'/>", 'bind', {'name': 'test'}, c2s))
+        self.assertFalse(self.router.route_raw("<iq type='error' to='kontalk.net'/>", 'iq',
+            {'type': 'error', 'to': 'kontalk.net'}, c2s))
+        self.assertFalse(self.router.route_raw("<iq to='unknown.kontalk.net'/>", 'iq',
+            {'to': 'unknown.kontalk.net'}, c2s))
+
+    def testMulticast(self):
+        """Tests multicast stanza expansion."""
+        c2s = FakeStream()
+        prime = FakeStream()
+        beta = FakeStream()
+        self.router.routes['c2s.prime.kontalk.net'] = c2s
+        self.router.routes['prime.kontalk.net'] = prime
+        self.router.routes['beta.kontalk.net'] = beta
+
+        envelope = domish.Element((None, 'multicast'))
+        envelope.addElement((None, 'address'))['jid'] = 'alice@prime.kontalk.net'
+        address = envelope.addElement((None, 'address'))
+        address['jid'] = 'alice@beta.kontalk.net'
+        address['id'] = 'beta1'
+        envelope.addElement((None, 'address'))['jid'] = 'alice@unknown.kontalk.net'
+        payload = envelope.addElement((None, 'presence'))
+        payload['type'] = 'probe'
+        payload['from'] = 'kontalk.net'
+
+        self.router.multicast(envelope, c2s)
+        self.assertEqual(len(prime.sent), 1)
+        end, name, attrs = scan_element(prime.sent[0])
+        self.assertEqual(name, 'presence')
+        self.assertDictEqual(attrs, {'to': 'alice@prime.kontalk.net', 'type': 'probe', 'from': 'kontalk.net'})
+        self.assertEqual(len(beta.sent), 1)
+        end, name, attrs = scan_element(beta.sent[0])
+        self.assertDictEqual(attrs, {'to': 'alice@beta.kontalk.net', 'id': 'beta1', 'type': 'probe', 'from': 'kontalk.net'})
+
+        # unroutable address bounced back
+        self.assertEqual(len(c2s.sent), 1)
+        self.assertEqual(c2s.sent[0]['type'], 'error')
+        self.assertEqual(c2s.sent[0]['from'], 'alice@unknown.kontalk.net')
+
+    def testBindConflict(self):
+        """Tests binding a name already bound by another stream."""
+        resolver1 = FakeStream()
+        resolver2 = FakeStream()
+        self.router.addRoute("resolver.prime.kontalk.net", resolver1)
+        self.router.addRoute("resolver.beta.kontalk.net", resolver2)
+
+        def bind(xs, name):
+            bind = domish.Element((None, 'bind'))
+            bind['name'] = name
+            bind.addElement((None, 'private'))
+            self.router.bind(bind, xs)
+            return xs.sent[-1]
+
+        self.assertFalse(bind(resolver1, 'kontalk.net').hasAttribute('error'))
+        self.assertEqual(bind(resolver2, 'kontalk.net').getAttribute('error'), 'conflict')
+        self.assertIs(self.router.lookup('kontalk.net'), resolver1)
+
+        self.router.removeRoute("resolver.prime.kontalk.net", resolver1)
+        self.assertNotIn('kontalk.net', self.router.private)
+
+    def testReconnect(self):
+        """Tests a component connecting again replaces its old stream."""
+        c2s = FakeStream()
+        resolver1 = FakeStream()
+        resolver2 = FakeStream()
+        self.router.addRoute("c2s.prime.kontalk.net", c2s)
+        self.router.addRoute("resolver.prime.kontalk.net", resolver1)
+        self.router.addRoute("resolver.prime.kontalk.net", resolver2)
+        self.assertIs(self.router.routes["resolver.prime.kontalk.net"], resolver2)
+        self.assertIs(self.router.lookup("resolver.prime.kontalk.net"), resolver2)
+
+        # old stream going away does not affect the new one
+        self.router.flush_announcements()
+        del c2s.sent[:]
+        self.router.removeRoute("resolver.prime.kontalk.net", resolver1)
+        self.assertIs(self.router.routes["resolver.prime.kontalk.net"], resolver2)
+        self.router.flush_announcements()
+        self.assertEqual(c2s.sent, [])
+
+        self.router.removeRoute("resolver.prime.kontalk.net", resolver2)
+        self.assertNotIn("resolver.prime.kontalk.net", self.router.routes)
+        self.router.flush_announcements()
+        self.assertEqual(len(c2s.sent), 1)
+        self.assertEqual(c2s.sent[0].route['type'], 'unavailable')
+
+    def testBackpressure(self):
+        """Tests outbound queues and producers pausing."""
+        self.router.queue_high_water = 3
+        self.router.queue_low_water = 1
+        c2s = FakeStream(FakeTransport())
+        resolver = FakeStream(FakeTransport())
+        self.router.addRoute("c2s.prime.kontalk.net", c2s)
+        self.router.addRoute("resolver.prime.kontalk.net", resolver)
+        queue = c2s.transport.producer
+        self.router.flush_announcements()
+        del c2s.sent[:]
+
+        # transport buffer is full: stanzas are queued
+        queue.pauseProducing()
+        for i in range(3):
+            data = "<message to='user@c2s.prime.kontalk.net' id='%d'/>" % (i, )
+            self.assertTrue(self.router.route_raw(data, 'message',
+                {'to': 'user@c2s.prime.kontalk.net', 'id': str(i)}, resolver))
+        self.assertEqual(c2s.sent, [])
+        self.assertFalse(resolver.transport.reading)
+
+        # control traffic skips the backlog
+        self.router.addRoute("net.prime.kontalk.net", FakeStream(FakeTransport()))
+        self.router.flush_announcements()
+        queue.resumeProducing()
+        self.assertEqual(len(c2s.sent), 4)
+        end, name, attrs = scan_element(c2s.sent[0])
+        self.assertEqual(name, 'routes')
+        self.assertEqual(c2s.sent[1], "<message to='user@c2s.prime.kontalk.net' id='0'/>")
+        self.assertTrue(resolver.transport.reading)
+
+        # disconnecting destination resumes producers
+        queue.pauseProducing()
+        for i in range(3):
+            self.router.route_raw("<message/>", 'message', {'to': 'user@c2s.prime.kontalk.net'}, resolver)
+        self.assertFalse(resolver.transport.reading)
+        self.router.removeRoute("c2s.prime.kontalk.net", c2s)
+        self.assertTrue(resolver.transport.reading)
+
+    def testAnnouncements(self):
+        """Tests coalesced route announcements."""
+        c2s = FakeStream()
+        net = FakeStream()
+        self.router.addRoute("c2s.prime.kontalk.net", c2s)
+        self.router.addRoute("net.prime.kontalk.net", net)
+        self.router.routes["beta.kontalk.net"] = net
+        resolver = FakeStream()
+        self.router.addRoute("resolver.prime.kontalk.net", resolver)
+        self.router.removeRoute("resolver.prime.kontalk.net", resolver)
+        self.router.addRoute("resolver.prime.kontalk.net", resolver)
+        self.router.addRoute("resolver.prime.kontalk.net", resolver)
+        self.router.flush_announcements()
+
+        # a single snapshot for each component
+        self.assertEqual(len(c2s.sent), 1)
+        routes = [(r['name'], r['to'], r.getAttribute('type')) for r in c2s.sent[0].elements()]
+        self.assertEqual(routes, [
+            ('net.prime.kontalk.net', 'c2s.prime.kontalk.net', None),
+            ('resolver.prime.kontalk.net', 'c2s.prime.kontalk.net', None),
+        ])
+
+        # one announcement for each name bound by the component
+        self.assertEqual(len(net.sent), 1)
+        routes = set((r['name'], r['to']) for r in net.sent[0].elements())
+        self.assertEqual(routes, set([
+            ('c2s.prime.kontalk.net', 'net.prime.kontalk.net'),
+            ('resolver.prime.kontalk.net', 'net.prime.kontalk.net'),
+            ('resolver.prime.kontalk.net', 'beta.kontalk.net'),
+        ]))
+
+        self.assertEqual(len(resolver.sent), 1)
+
+    def testAnnouncementsDelay(self):
+        """Tests announcements are held back only after a recent flush."""
+        c2s = FakeStream()
+        self.router.addRoute("c2s.prime.kontalk.net", c2s)
+        self.router.flush_announcements()
+
+        self.router._announce_time = 0
+        self.router.announce(c2s, "resolver.prime.kontalk.net", "c2s.prime.kontalk.net", False)
+        self.assertAlmostEqual(self.router._announce_call.getTime(), reactor.seconds(), 2)
+        self.router.flush_announcements()
+
+        # announcements were just sent: hold back the next ones
+        self.router.announce(c2s, "resolver.prime.kontalk.net", "c2s.prime.kontalk.net", True)
+        self.assertAlmostEqual(self.router._announce_call.getTime(),
+            self.router._announce_time + self.router.advertise_delay, 2)
+        self.router.flush_announcements()
+        self.assertEqual(len(c2s.sent), 2)
+
 
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
@@ -0,0 +1,183 @@
+import unittest
+
+from twisted.internet import task
+from twisted.test import proto_helpers
+from twisted.words.protocols.jabber import jid, xmlstream
+from twisted.words.xish import domish
+
+from kontalk.xmppserver import xmlstream2, timer
+from kontalk.xmppserver.component import sm
+
+
+class FakeRouter(object):
+    """A c2s component with no optional services."""
+
+    logTraffic = False
+    push_manager = None
+    registration = None
+
+    def __init__(self):
+        self.config = {}
+        self.sent = []
+        self.presence = []
+
+    def upload_enabled(self):
+        return False
+
+    def send(self, stanza):
+        self.sent.append(stanza)
+
+    def local_presence(self, user, stanza):
+        self.presence.append((user, stanza))
+
+    def uptime(self):
+        return 0
+
+
+class FakeTransport(proto_helpers.StringTransport):
+    """A transport with no client certificate."""
+
+    def getPeerCertificate(self):
+        return None
+
+
+class FakeFactory(object):
+
+    def connectionInitialized(self, xs):
+        pass
+
+    def connectionLost(self, xs, reason):
+        pass
+
+
+def connect(router, userid='user'):
+    """Creates an authenticated client session."""
+    xs = xmlstream2.XmlStream(xmlstream.Authenticator())
+    xs.manager = sm.C2SManager(xs, FakeFactory(), router, 'kontalk.net', 'prime.kontalk.net')
+    xs.makeConnection(FakeTransport())
+    xs.otherEntity = jid.JID('%s@kontalk.net/test' % (userid, ))
+    xs.dispatch(xs, xmlstream.STREAM_AUTHD_EVENT)
+    return xs
+
+
+class TestC2SManager(unittest.TestCase):
+
+    def setUp(self):
+        self.router = FakeRouter()
+        self.streams = []
+
+    def tearDown(self):
+        for xs in self.streams:
+            xs.connectionLost(None)
+
+    def connect(self, userid='user'):
+        xs = connect(self.router, userid)
+        self.streams.append(xs)
+        return xs
+
+    def testSharedTable(self):
+        """Tests sessions share handlers and observers."""
+        xs1 = self.connect('user1')
+        xs2 = self.connect('user2')
+        self.assertIs(xs1.manager.table, xs2.manager.table)
+        self.assertIsNot(xs1.manager.session, xs2.manager.session)
+
+        table = xs1.manager.table
+        self.assertIsInstance(table.handlers[-1], sm.DiscoveryHandler)
+        self.assertFalse([h for h in table.handlers if isinstance(h, sm.UploadHandler)])
+        # one table observer for every priority level
+        observers = [o for o in xs1._xpathObservers.itervalues() for q, cl in o.iteritems()
+            for c in cl.callbacks if c == table.dispatch]
+        self.assertEqual(len(observers), len(table.observers))
+
+    def testSessionState(self):
+        """Tests per-session state is kept separately."""
+        xs1 = self.connect('user1')
+        xs2 = self.connect('user2')
+
+        presence = domish.Element((None, 'presence'))
+        xs1.dispatch(presence)
+        self.assertIs(xs1.manager._presence, presence)
+        self.assertIs(xs2.manager._presence, None)
+        self.assertTrue(xs1.manager.session.initial)
+        self.assertEqual(len(self.router.presence), 1)
+
+        # further presence is not initial
+        xs1.dispatch(domish.Element((None, 'presence')))
+        self.assertEqual(len(self.router.presence), 1)
+
+        roster = domish.Element((None, 'iq'), attribs={'type': 'get', 'id': 'roster'})
+        roster.addElement((xmlstream2.NS_IQ_ROSTER, 'query'))
+        xs2.dispatch(roster)
+        self.assertTrue(xs2.manager.compatibility_mode)
+        self.assertFalse(xs1.manager.compatibility_mode)
+        self.assertEqual(self.router.sent[-1]['to'], 'kontalk.net')
+
+    def testDispatch(self):
+        """Tests stanzas reach handlers through the shared table."""
+        xs = self.connect()
+        transport = xs.transport
+
+        ping = domish.Element((None, 'iq'), attribs={'type': 'get', 'id': 'ping'})
+        ping.addElement((xmlstream2.NS_XMPP_PING, 'ping'))
+        transport.clear()
+        xs.dispatch(ping)
+        self.assertIn("id='ping'", transport.value())
+        self.assertIn("type='result'", transport.value())
+
+        info = domish.Element((None, 'iq'), attribs={'type': 'get', 'id': 'info', 'to': 'kontalk.net'})
+        info.addElement((xmlstream2.NS_DISCO_INFO, 'query'))
+        transport.clear()
+        xs.dispatch(info)
+        self.assertIn(xmlstream2.NS_XMPP_PING, transport.value())
+
+    def testConnectionLost(self):
+        """Tests session timers are stopped on disconnection."""
+        xs = self.connect()
+        keepalive = xs.manager.session.keepalive
+        self.assertTrue(keepalive.active())
+
+        self.streams.remove(xs)
+        xs.connectionLost(None)
+        self.assertFalse(keepalive.active())
+        self.assertIs(xs.manager.session.keepalive, None)
+
+    def testKeepalive(self):
+        """Tests clients are pinged only when idle."""
+        clock = task.Clock()
+        table = sm.C2SManager.handler_table(self.router, 'kontalk.net', 'prime.kontalk.net')
+        handler = [h for h in table.handlers if isinstance(h, sm.PingHandler)][0]
+        handler.wheel = timer.TimerWheel(clock=clock)
+
+        xs = self.connect()
+        xs.lastReceived = clock.seconds()
+        transport = xs.transport
+        self.assertEqual(len(handler.wheel), 1)
+
+        # client sent data: no ping
+        clock.advance(100)
+        xs.lastReceived = clock.seconds()
+        transport.clear()
+        clock.pump([1] * (handler.PING_DELAY - 1))
+        self.assertEqual(transport.value(), '')
+
+        # idle client: ping
+        clock.advance(1)
+        self.assertIn(xmlstream2.NS_XMPP_PING, transport.value())
+        self.assertEqual(len(xs.manager.correlator), 1)
+
+        # pong
+        pong = domish.Element((None, 'iq'), attribs={'type': 'result', 'id': xs.manager.correlator.pending.keys()[0][1]})
+        xs.lastReceived = clock.seconds()
+        xs.dispatch(pong)
+        self.assertTrue(pong.consumed)
+        self.assertEqual(len(xs.manager.correlator), 0)
+        self.assertEqual(len(handler.wheel), 1)
+
+        # no reply to next ping: timeout
+        clock.pump([1] * (handler.PING_DELAY + handler.PING_TIMEOUT + 5))
+        self.assertTrue(transport.disconnecting)
+        self.assertEqual(len(handler.wheel), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+import unittest
+
+from twisted.internet import defer
+
+from kontalk.xmppserver import storage
+
+
+class FakeTransaction(object):
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def executemany(self, query, args):
+        self.pool.writes.append((query.split()[0], sorted(args)))
+
+
+class FakePool(object):
+    """A connection pool serving privacy list rows from memory."""
+
+    def __init__(self, rows=()):
+        self.rows = sorted(rows)
+        self.queries = []
+        self.writes = []
+        # if set, interactions wait for these deferreds
+        self.running = None
+
+    def runQuery(self, query, args=()):
+        self.queries.append(args)
+        limit = int(query.split()[-1])
+        # keyset arguments: userid, userid, type, type, target
+        last = tuple(args[::2])
+        rows = [r for r in self.rows if not args or r > last]
+        return defer.succeed(rows[:limit])
+
+    def runInteraction(self, fn, *args):
+        if self.running is None:
+            return defer.succeed(fn(FakeTransaction(self), *args))
+
+        d = defer.Deferred()
+        d.addCallback(lambda unused: fn(FakeTransaction(self), *args))
+        self.running.append(d)
+        return d
+
+
+class TestPrivacyListStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = storage.dbpool = FakePool()
+        self.db = storage.MySQLPrivacyListStorage()
+
+    def tearDown(self):
+        storage.dbpool = None
+        if self.db._flush_call:
+            self.db._flush_call.cancel()
+
+    def testWriteBehind(self):
+        """Tests changes are buffered and written in batches."""
+        self.db.add('user1', 1, 'user2@kontalk.net')
+        self.db.add('user1', 2, 'user3@kontalk.net')
+        self.db.remove('user1', 2, 'user3@kontalk.net')
+        self.db.remove('user1', 1, 'user4@kontalk.net')
+        self.assertEqual(self.pool.writes, [])
+        self.assertTrue(self.db._flush_call.active())
+        self.assertIs(self.db.pending('user1', 2, 'user3@kontalk.net'), False)
+        self.assertIs(self.db.pending('user1', 1, 'user2@kontalk.net'), True)
+
+        self.db.flush()
+        self.assertIs(self.db._flush_call, None)
+        self.assertEqual(self.pool.writes, [
+            ('INSERT', [('user1', 1, 'user2@kontalk.net')]),
+            ('DELETE', [('user1', 1, 'user4@kontalk.net'), ('user1', 2, 'user3@kontalk.net')]),
+        ])
+        self.assertIs(self.db.pending('user1', 1, 'user2@kontalk.net'), None)
+
+        # nothing to write
+        self.db.flush()
+        self.assertEqual(len(self.pool.writes), 2)
+
+    def testFlushOrder(self):
+        """Tests writes are not reordered and failed writes are retried."""
+        self.pool.running = []
+        self.db.add('user1', 1, 'user2@kontalk.net')
+        self.db.flush()
+        self.db.remove('user1', 1, 'user2@kontalk.net')
+        self.db.add('user1', 1, 'user3@kontalk.net')
+        self.db.flush()
+        # second write waits for the first one
+        self.assertEqual(len(self.pool.running), 1)
+        self.pool.running[0].callback(None)
+        self.assertEqual(len(self.pool.running), 2)
+        self.pool.running[1].callback(None)
+        self.assertEqual(self.pool.writes, [
+            ('INSERT', [('user1', 1, 'user2@kontalk.net')]),
+            ('INSERT', [('user1', 1, 'user3@kontalk.net')]),
+            ('DELETE', [('user1', 1, 'user2@kontalk.net')]),
+        ])
+        self.assertIs(self.db._flushing, None)
+
+        # failed write, one of the entries is changed in the meantime
+        self.db.add('user1', 1, 'user4@kontalk.net')
+        self.db.add('user1', 1, 'user5@kontalk.net')
+        self.db.flush()
+        self.db.remove('user1', 1, 'user5@kontalk.net')
+        self.pool.running[2].errback(RuntimeError('lost connection'))
+        self.assertIs(self.db.pending('user1', 1, 'user4@kontalk.net'), True)
+        self.assertIs(self.db.pending('user1', 1, 'user5@kontalk.net'), False)
+        self.assertTrue(self.db._flush_call.active())
+
+    def testVersions(self):
+        """Tests privacy lists versions are written with the entries."""
+        self.db.add('user1', 1, 'user2@kontalk.net')
+        self.db.set_version('user1', 1000)
+        self.db.set_version('user1', 1001)
+        self.db.flush()
+        self.assertEqual(self.pool.writes, [
+            ('INSERT', [('user1', 1, 'user2@kontalk.net')]),
+            ('INSERT', [('user1', 1001)]),
+        ])
+
+    def testFlushSize(self):
+        """Tests changes are written when too many are buffered."""
+        self.db.FLUSH_SIZE = 3
+        for i in range(3):
+            self.db.add('user1', 1, 'user%d@kontalk.net' % (i, ))
+        self.assertEqual(len(self.pool.writes), 1)
+        self.assertEqual(len(self.pool.writes[0][1]), 3)
+
+    def testLoad(self):
+        """Tests entries are loaded in chunks."""
+        rows = [('user%d' % (i / 2, ), i % 2 + 1, 'user%d@kontalk.net' % (i, )) for i in range(25)]
+        self.pool.rows = sorted(rows)
+        self.db.LOAD_CHUNK = 10
+
+        chunks = []
+        result = []
+        self.db.load(chunks.append).addCallback(result.append)
+        self.assertEqual(result, [25])
+        self.assertEqual([len(c) for c in chunks], [10, 10, 5])
+        self.assertEqual(sorted(sum(chunks, [])), sorted(rows))
+        self.assertEqual(len(self.pool.queries), 3)
+
+    def testLoadRemoved(self):
+        """Tests entries removed while loading are reported until loading ends."""
+        self.pool.running = []
+        self.pool.rows = [('user1', 1, 'user2@kontalk.net')]
+        queries = []
+        def runQuery(query, args=()):
+            queries.append(defer.Deferred())
+            return queries[-1]
+        self.pool.runQuery = runQuery
+
+        result = []
+        self.db.load(lambda rows: None).addCallback(result.append)
+        self.db.remove('user1', 1, 'user2@kontalk.net')
+        self.db.flush()
+        self.pool.running[0].callback(None)
+        # pending changes have been written, removal is still remembered
+        self.assertIs(self.db.pending('user1', 1, 'user2@kontalk.net'), None)
+        self.assertTrue(self.db.removed('user1', 1, 'user2@kontalk.net'))
+
+        queries[0].callback(self.pool.rows)
+        self.assertEqual(result, [1])
+        self.assertFalse(self.db.removed('user1', 1, 'user2@kontalk.net'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import unittest
+
+from twisted.internet import task
+
+from kontalk.xmppserver.timer import TimerWheel
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = TimerWheel(resolution=1.0, size=8, clock=self.clock)
+        self.fired = []
+
+    def schedule(self, delay, name):
+        return self.wheel.schedule(delay, self.fired.append, name)
+
+    def testSchedule(self):
+        """Tests timers fire in order, also after more than one round."""
+        self.schedule(3, 'a')
+        self.schedule(1.5, 'b')
+        self.schedule(20, 'c')
+        self.assertEqual(len(self.wheel), 3)
+
+        self.clock.advance(1)
+        self.assertEqual(self.fired, [])
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ['b'])
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ['b', 'a'])
+        self.clock.pump([1] * 16)
+        self.assertEqual(self.fired, ['b', 'a'])
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ['b', 'a', 'c'])
+        self.assertEqual(self.wheel.fired, 3)
+
+        # wheel stops ticking when no timers are armed
+        self.assertEqual(len(self.wheel), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def testCancel(self):
+        """Tests cancelled timers do not fire."""
+        timer = self.schedule(2, 'a')
+        self.schedule(4, 'b')
+        self.assertTrue(timer.active())
+        timer.cancel()
+        self.assertFalse(timer.active())
+        self.assertEqual(len(self.wheel), 1)
+
+        self.clock.pump([1] * 4)
+        self.assertEqual(self.fired, ['b'])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def testCancelInTick(self):
+        """Tests timers cancelled by a callback of the same tick."""
+        timers = []
+        def callback(name):
+            self.fired.append(name)
+            for timer in timers:
+                timer.cancel()
+
+        timers.append(self.wheel.schedule(2, callback, 'a'))
+        timers.append(self.wheel.schedule(2, callback, 'b'))
+        self.schedule(5, 'c')
+
+        self.clock.pump([1] * 2)
+        self.assertEqual(len(self.fired), 1)
+        self.assertEqual(len(self.wheel), 1)
+        self.clock.pump([1] * 3)
+        self.assertEqual(self.fired[1:], ['c'])
+        self.assertEqual(self.wheel.fired, 2)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def testLate(self):
+        """Tests timers armed between ticks never fire early."""
+        self.schedule(3, 'a')
+        self.clock.advance(0.5)
+        self.schedule(1, 'b')
+        self.clock.advance(0.5)
+        self.assertEqual(self.fired, [])
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ['b'])
+
+    def testReschedule(self):
+        """Tests timers armed by timer callbacks."""
+        def callback():
+            self.fired.append(self.clock.seconds())
+            if len(self.fired) < 3:
+                self.wheel.schedule(2, callback)
+
+        self.wheel.schedule(2, callback)
+        self.clock.pump([1] * 10)
+        self.assertEqual(self.fired, [2, 4, 6])
+        self.assertEqual(len(self.wheel), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
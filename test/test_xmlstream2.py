@@ -0,0 +1,184 @@
+
+import unittest
+
+from twisted.internet import task
+from twisted.words.xish import domish, utility
+
+from kontalk.xmppserver import xmlstream2
+
+
+class IndexedDispatcher(xmlstream2.IndexedDispatcherMixin, utility.EventDispatcher):
+    pass
+
+
+QUERIES = (
+    "/iq",
+    "/iq[@type='get']",
+    "/iq[@type='get']/query[@xmlns='jabber:iq:roster']",
+    "/iq[@type='set']/query[@xmlns='jabber:iq:roster']",
+    "/iq[@type='get']/vcard[@xmlns='urn:ietf:params:xml:ns:vcard-4.0']",
+    "/iq[@id='abc']",
+    "/iq[@type='result'][@id='abc']",
+    "/presence",
+    "/presence[not(@type)]",
+    "/presence[@type='unavailable']",
+    "/presence[@type='probe'][@to='kontalk.net']",
+    "/presence/group[@id='abc']",
+    "/message[@type='chat']/body",
+    "/message/request[@xmlns='urn:xmpp:server-receipts']",
+    "/*",
+    "//body",
+)
+
+
+def _stanza(name, attrs, *children):
+    stanza = domish.Element((None, name), attribs=attrs)
+    for uri, child in children:
+        stanza.addElement((uri, child))
+    return stanza
+
+
+STANZAS = (
+    _stanza('iq', {'type': 'get', 'id': 'abc'}, ('jabber:iq:roster', 'query')),
+    _stanza('iq', {'type': 'set', 'id': 'xyz'}, ('jabber:iq:roster', 'query')),
+    _stanza('iq', {'type': 'get'}, ('urn:ietf:params:xml:ns:vcard-4.0', 'vcard')),
+    _stanza('iq', {'type': 'result', 'id': 'abc'}),
+    _stanza('presence', {}),
+    _stanza('presence', {'type': 'unavailable'}),
+    _stanza('presence', {'type': 'probe', 'to': 'kontalk.net'}, (None, 'group')),
+    _stanza('message', {'type': 'chat'}, (None, 'body'), ('urn:xmpp:server-receipts', 'request')),
+    _stanza('message', {'type': 'normal'}, ('urn:xmpp:server-receipts', 'request')),
+)
+
+
+class TestIndexedDispatcher(unittest.TestCase):
+
+    def _register(self, dispatcher, calls):
+        for priority, query in enumerate(QUERIES):
+            dispatcher.addObserver(query, lambda stanza, query=query: calls.append(query), priority)
+
+    def testDispatch(self):
+        """Tests indexed dispatch calls the same observers in the same order."""
+        expected = []
+        reference = utility.EventDispatcher()
+        self._register(reference, expected)
+
+        calls = []
+        dispatcher = IndexedDispatcher()
+        self._register(dispatcher, calls)
+
+        for stanza in STANZAS:
+            del expected[:]
+            del calls[:]
+            self.assertEqual(dispatcher.dispatch(stanza), reference.dispatch(stanza))
+            self.assertEqual(calls, expected)
+
+    def testOnetimeObserver(self):
+        """Tests one-time and removed observers are dropped from the index."""
+        calls = []
+        dispatcher = IndexedDispatcher()
+
+        def observer(stanza):
+            calls.append(stanza)
+
+        dispatcher.addOnetimeObserver("/iq[@id='abc']", observer)
+        dispatcher.addObserver("/presence[not(@type)]", observer)
+        stanza = _stanza('iq', {'type': 'result', 'id': 'abc'})
+        self.assertTrue(dispatcher.dispatch(stanza))
+        self.assertFalse(dispatcher.dispatch(stanza))
+        self.assertEqual(len(calls), 1)
+
+        dispatcher.removeObserver("/presence[not(@type)]", observer)
+        self.assertFalse(dispatcher.dispatch(_stanza('presence', {})))
+        self.assertEqual(dispatcher._xpathIndex, {})
+
+    def testObserverDuringDispatch(self):
+        """Tests observers added while dispatching."""
+        calls = []
+        dispatcher = IndexedDispatcher()
+
+        def observer(stanza):
+            calls.append(stanza)
+            dispatcher.addObserver("/iq", observer)
+
+        dispatcher.addOnetimeObserver("/iq", observer)
+        stanza = _stanza('iq', {'type': 'get'})
+        dispatcher.dispatch(stanza)
+        dispatcher.dispatch(stanza)
+        self.assertEqual(len(calls), 2)
+
+
+class TestStanzaCorrelator(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.reactor = xmlstream2.reactor
+        xmlstream2.reactor = self.clock
+        self.dispatcher = IndexedDispatcher()
+        self.correlator = xmlstream2.StanzaCorrelator(self.dispatcher)
+
+    def tearDown(self):
+        xmlstream2.reactor = self.reactor
+
+    def testExpect(self):
+        """Tests responses are correlated by id, name and type."""
+        calls = []
+        def callback(stanza, tag):
+            calls.append((tag, stanza))
+
+        self.correlator.expect('abc', callback, name='iq', stype='result', args=(1, ))
+        self.correlator.expect('xyz', callback, kwargs={'tag': 2})
+        self.assertEqual(len(self.correlator), 2)
+
+        self.dispatcher.dispatch(_stanza('presence', {'id': 'abc'}))
+        self.dispatcher.dispatch(_stanza('iq', {'type': 'error', 'id': 'abc'}))
+        self.assertEqual(calls, [])
+
+        stanza = _stanza('iq', {'type': 'result', 'id': 'abc'})
+        self.dispatcher.dispatch(stanza)
+        self.dispatcher.dispatch(stanza)
+        self.assertEqual(calls, [(1, stanza)])
+        self.assertEqual(self.correlator.stats(), {'pending': 1, 'responses': 1, 'timeouts': 0})
+
+        self.correlator.cancel('xyz')
+        self.assertEqual(len(self.correlator), 0)
+        self.assertEqual(self.correlator.pending, {})
+
+    def testGroup(self):
+        """Tests responses matched by stanza group id."""
+        calls = []
+        request = self.correlator.expect('abc', calls.append, once=False, group=True)
+
+        stanza = _stanza('presence', {'id': 'xyz'})
+        self.dispatcher.dispatch(stanza)
+        group = stanza.addElement((xmlstream2.NS_XMPP_STANZA_GROUP, 'group'))
+        group['id'] = 'abc'
+        self.dispatcher.dispatch(stanza)
+        self.dispatcher.dispatch(stanza)
+        self.assertEqual(len(calls), 2)
+
+        self.correlator.remove(request)
+        self.dispatcher.dispatch(stanza)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(self.correlator), 0)
+
+    def testTimeout(self):
+        """Tests pending requests expire."""
+        calls = []
+        expired = []
+        self.correlator.expect('abc', calls.append, timeout=10, onTimeout=lambda: expired.append(True))
+        self.correlator.expect('xyz', calls.append, timeout=10)
+
+        self.dispatcher.dispatch(_stanza('iq', {'type': 'result', 'id': 'xyz'}))
+        self.clock.advance(10)
+        self.assertEqual(expired, [True])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.correlator.stats(), {'pending': 0, 'responses': 1, 'timeouts': 1})
+
+        self.dispatcher.dispatch(_stanza('iq', {'type': 'result', 'id': 'abc'}))
+        self.assertEqual(len(calls), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -51,6 +51,13 @@ class KontalkRouterServiceMaker(object):
 
         engine = router.Router()
         engine.logTraffic = config['debug']
+        if 'passthrough' in config:
+            engine.passthrough = config['passthrough']
+        if 'max_stanza_size' in config:
+            engine.max_stanza_size = config['max_stanza_size']
+        if 'queue' in config:
+            engine.queue_high_water = config['queue']['high_water']
+            engine.queue_low_water = config['queue']['low_water']
 
         factory = router.XMPPRouterFactory(engine, config['secret'])
         factory.logTraffic = config['debug']